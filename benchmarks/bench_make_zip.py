@@ -0,0 +1,51 @@
+"""
+Compares the throughput of the serial and the parallel make_zip.
+
+Usage: API_CONFIG=test python benchmarks/bench_make_zip.py [-d TILE_DIR] [-w 1 2 4 8] [-r 3]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from routing_packager_app.utils.file_utils import make_zip  # noqa: E402
+
+parser = ArgumentParser(description="Benchmarks make_zip with different numbers of workers.")
+parser.add_argument(
+    "-d",
+    "--tile-dir",
+    type=Path,
+    default=Path(__file__).parent.parent.joinpath("tests", "data", "andorra_tiles"),
+    help="Valhalla tile directory to compress, defaults to the Andorra test tiles.",
+)
+parser.add_argument(
+    "-w", "--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count()], help="Worker counts."
+)
+parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per worker count, best counts.")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    tile_dir = args.tile_dir.resolve()
+    tile_paths = set(tile_dir.rglob("*.gph"))
+    in_size = sum(p.stat().st_size for p in tile_paths)
+    print(f"{len(tile_paths)} tiles with {in_size / 1e6:.1f} MB from {tile_dir}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for workers in sorted(set(args.workers)):
+            out_fp = os.path.join(tmp_dir, f"{workers}.zip")
+            best = float("inf")
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                make_zip(tile_paths, tile_dir, out_fp, workers=workers)
+                best = min(best, time.perf_counter() - start)
+            out_size = os.path.getsize(out_fp)
+            print(
+                f"workers={workers:>3}: {best:7.2f} s, {in_size / 1e6 / best:8.1f} MB/s, "
+                f"ratio {out_size / in_size:.3f}"
+            )
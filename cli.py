@@ -1,63 +1,223 @@
 import asyncio
+import fcntl
 import logging
+import os
+import signal
+import subprocess
 import sys
 import time
 from argparse import ArgumentParser
 from asyncio import TimeoutError
-from typing import List, Sequence
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
 
 from arq import ArqRedis, create_pool
 from arq.connections import RedisSettings
 from arq.jobs import ResultNotFound
 from fastapi import HTTPException
+import requests
 from sqlmodel import select
 
 from routing_packager_app import SETTINGS
 from routing_packager_app.api_v1.models import Job, User
-from routing_packager_app.db import get_db
+from routing_packager_app.db import get_db, upgrade_db
 from routing_packager_app.logger import LOGGER, AppSmtpHandler, get_smtp_details
-from routing_packager_app.utils.geom_utils import wkbe_to_geom, wkbe_to_str
-
-JOB_TIMEOUT = 60 * 60  # one hour to compress a single graph
+from routing_packager_app.utils.event_utils import JobStatusWaiter
+from routing_packager_app.utils.geom_utils import wkbe_to_bbox, wkbe_to_geom, wkbe_to_str
+from routing_packager_app.utils.queue_utils import choose_queue
+from routing_packager_app.utils.schedule_utils import estimate_makespan, sort_longest_first
+from routing_packager_app.utils.snapshot_utils import collect_snapshots, make_snapshot
+from routing_packager_app.utils.tile_manifest import TileManifest, get_manifest, write_manifest
+from routing_packager_app.utils.valhalla_utils import get_current_valhalla_dir, write_active_build
 
 description = "Runs the worker to update the ZIP packages."
 parser = ArgumentParser(description=description)
+subparsers = parser.add_subparsers(dest="command")
+update_parser = subparsers.add_parser(
+    "update", help="Update all packages which are due according to their cadence (default)."
+)
+update_parser.add_argument(
+    "-c",
+    "--concurrency",
+    type=int,
+    default=SETTINGS.UPDATE_CONCURRENCY,
+    help="How many updates run at the same time, should match the worker capacity.",
+)
+update_parser.add_argument(
+    "-j",
+    "--job",
+    type=int,
+    action="append",
+    dest="job_ids",
+    help="Update only this job's package now, regardless of its cadence. Can be repeated.",
+)
+manifest_parser = subparsers.add_parser("manifest", help="Write the tile manifest of a Valhalla graph.")
+manifest_parser.add_argument("valhalla_dir", type=Path, help="The Valhalla tile directory.")
+snapshot_parser = subparsers.add_parser(
+    "snapshot", help="Snapshot a Valhalla graph for packaging and remove unused old snapshots."
+)
+snapshot_parser.add_argument("valhalla_dir", type=Path, help="The Valhalla tile directory.")
+activate_parser = subparsers.add_parser(
+    "activate",
+    help="Serve a new Valhalla graph, stop the old service and update the packages in the background.",
+)
+activate_parser.add_argument("valhalla_config", type=Path, help="The new graph's valhalla.json.")
+activate_parser.add_argument("port", type=int, help="The port the new graph is served on.")
+activate_parser.add_argument("--old-pid", type=int, default=None, help="The PID of the old service.")
+activate_parser.add_argument(
+    "--no-update", action="store_false", dest="update", help="Don't update the packages afterwards."
+)
 
+VALHALLA_START_TIMEOUT = 5 * 60
+# only one update run at a time holds it, in the tmp data directory
+UPDATE_LOCK_NAME = ".update.lock"
+# left by update runs which found the lock taken, the run holding it then runs again
+UPDATE_PENDING_NAME = ".update.pending"
 
-def _sort_jobs(jobs_: Sequence[Job]):
-    out = list()
-    for job in jobs_:
-        out.append((wkbe_to_geom(job.bbox).area, job))
 
-    out = sorted(out, key=lambda x: x[0], reverse=True)
-    return [x[1] for x in out]
+def activate(valhalla_config: Path, port: int, old_pid: Optional[int], update: bool = True) -> int:
+    """
+    Starts serving a new Valhalla graph, stops the old service once the new one is up and
+    publishes the new build as the active one. Only then the packages are updated in the
+    background, so the new graph goes live regardless of how many packages there are.
 
+    :param valhalla_config: The new graph's valhalla.json.
+    :param port: The port the new graph is served on.
+    :param old_pid: The PID of the service which served the previous graph.
+    :param update: Whether to update the packages in the background.
 
-async def update_jobs(jobs_: List[Job], user_email_: str):
-    pool: ArqRedis = await create_pool(RedisSettings.from_dsn(SETTINGS.REDIS_URL))
-    success_count: int = 0
-    start_time = time.time()
+    :returns: the new service's PID
+    """
+    # stdout only returns the PID to the build loop, everything else logs to stderr
+    service = subprocess.Popen(
+        ["valhalla_service", str(valhalla_config), "1"], stdout=sys.stderr, start_new_session=True
+    )
+    # the build loop exports a proxy for downloads
+    http = requests.Session()
+    http.trust_env = False
+    deadline = time.time() + VALHALLA_START_TIMEOUT
+    while True:
+        if service.poll() is not None:
+            raise RuntimeError(f"Valhalla on port {port} exited with {service.returncode}.")
+        try:
+            if http.get(f"http://localhost:{port}/status", timeout=5).ok:
+                break
+        except requests.RequestException:
+            pass
+        if time.time() > deadline:
+            service.kill()
+            raise TimeoutError(f"Valhalla on port {port} didn't start within {VALHALLA_START_TIMEOUT}s.")
+        time.sleep(1)
+
+    if old_pid:
+        try:
+            os.kill(old_pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    # the worker reads the active build from here instead of probing both services
+    valhalla_dir = valhalla_config.parent
+    manifest = get_manifest(valhalla_dir)
+    write_active_build(valhalla_dir, port, manifest.build_id if manifest else None)
+
+    # package updates pick up the new build, since it's the only one being served now
+    if update:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "update"],
+            stdout=sys.stderr,
+            start_new_session=True,
+        )
+
+    return service.pid
+
+
+def _sort_jobs(jobs_: Sequence[Job], manifest: Optional[TileManifest]) -> List[Tuple[float, Job]]:
+    """
+    Sorts the jobs by the bytes of their tiles, largest first, so the biggest packages start early.
+    Falls back to the bbox area if there's no tile manifest.
+    """
+    if manifest is None:
+        return sort_longest_first(jobs_, lambda job: wkbe_to_geom(job.bbox).area)
+
+    return sort_longest_first(
+        jobs_, lambda job: sum(entry.size for entry in manifest.get_tiles(wkbe_to_bbox(job.bbox)))
+    )
+
+
+def _set_next_due(job_id: int, since: Optional[datetime], next_due: Optional[datetime] = None):
+    """
+    Sets when the job's package is due for its next update.
+
+    :param job_id: the job's ID.
+    :param since: when the update run started, to schedule the job according to its cadence.
+    :param next_due: the due date to set if there's no "since".
+
+    :returns: when the job was due before
+    """
+    with next(get_db()) as session:
+        job = session.get(Job, job_id)
+        previous = job.next_due
+        if since is not None:
+            job.schedule_update(since)
+        else:
+            job.next_due = next_due
+        session.commit()
+
+    return previous
 
-    # loop through all jobs "synchronously" by waiting for each job's result
-    for job in jobs_:
+
+async def _update_job(
+    pool: ArqRedis,
+    job: Job,
+    user_email_: str,
+    semaphore: asyncio.Semaphore,
+    waiter: JobStatusWaiter,
+    run_start: Optional[datetime] = None,
+) -> bool:
+    """
+    Enqueues a single package update once there's capacity and waits for its result. Due jobs
+    are only scheduled for their next update once they're enqueued, so a run which stops early
+    leaves the rest due.
+    """
+    async with semaphore:
         print(f"Updating package {job.arq_id} as user {user_email_}", file=sys.stderr)
         log_extra = {"user": user_email_, "job_id": job.id}
-        async_job = await pool.enqueue_job(
-            "create_package",
-            job.id,
-            job.arq_id,
-            job.description,
-            wkbe_to_str(job.bbox),
-            job.zip_path,
-            job.user_id,
-            True,
-            # TODO: possibly we can't use the same ID, since arq won't process
-            #   the same ID twice, which would be needed for updating every package
-            # _job_id=job.arq_id,
-        )
+        waiter.expect(job.id)
+        # scheduled before enqueueing, so the worker can still make a failed update due again
+        previous_due = _set_next_due(job.id, run_start) if run_start is not None else None
+        try:
+            async_job = await pool.enqueue_job(
+                "create_package",
+                job.id,
+                job.arq_id,
+                job.description,
+                wkbe_to_str(job.bbox),
+                job.zip_path,
+                job.user_id,
+                True,
+                _queue_name=choose_queue(None, scheduled=True),
+                # TODO: possibly we can't use the same ID, since arq won't process
+                #   the same ID twice, which would be needed for updating every package
+                # _job_id=job.arq_id,
+            )
+        except BaseException:
+            if run_start is not None:
+                _set_next_due(job.id, None, previous_due)
+            raise
+        # the worker publishes the final status, polling the result is only a fallback
+        #   for jobs which fail before they publish anything
+        event = asyncio.ensure_future(waiter.wait(job.id))
+        result = asyncio.ensure_future(async_job.result(timeout=SETTINGS.JOB_TIMEOUT, poll_delay=30))
         # catch all possible exceptions and send emails
         try:
-            await async_job.result(timeout=JOB_TIMEOUT, poll_delay=10)
+            done, _ = await asyncio.wait((event, result), return_when=asyncio.FIRST_COMPLETED)
+            if result not in done:
+                # arq stores the result right after the worker published the final status
+                result.cancel()
+                result = asyncio.ensure_future(async_job.result(timeout=60, poll_delay=0.1))
+            await result
+            return True
         except ResultNotFound:
             LOGGER.critical(f"Job {job.name} is missing from queue.", extra=log_extra)
         except TimeoutError:
@@ -66,17 +226,56 @@ async def update_jobs(jobs_: List[Job], user_email_: str):
             LOGGER.critical(f"Updating job {job.name} failed with '{e.detail}'", extra=log_extra)
         except Exception as e:
             LOGGER.critical(f"Updating job {job.name} failed with '{e}'", extra=log_extra)
+        finally:
+            event.cancel()
+
+        return False
+
 
-        success_count += 1
+async def update_jobs(
+    jobs_: List[Job], user_email_: str, concurrency: int = 1, run_start: Optional[datetime] = None
+):
+    pool: ArqRedis = await create_pool(RedisSettings.from_dsn(SETTINGS.REDIS_URL))
+    start_time = time.time()
+
+    # keep up to "concurrency" jobs in flight, they start in the order of jobs_
+    semaphore = asyncio.Semaphore(concurrency)
+    async with JobStatusWaiter(pool) as waiter:
+        results = await asyncio.gather(
+            *(_update_job(pool, job, user_email_, semaphore, waiter, run_start) for job in jobs_)
+        )
+    success_count = sum(results)
+    await pool.aclose()
 
     total_time = (time.time() - start_time) / 60
-    if success_count == len(jobs):
+    if success_count == len(jobs_):
         LOGGER.info(f"Updated {success_count} packages in {total_time} minutes.")
     else:
-        LOGGER.warning(f"Updated {success_count} of {len(jobs)} packages in {total_time} minutes.")
+        LOGGER.warning(f"Updated {success_count} of {len(jobs_)} packages in {total_time} minutes.")
 
 
-if __name__ == "__main__":
+def _try_lock_updates() -> Optional[int]:
+    """
+    Takes the lock of the update run without waiting for it, so two runs never build the same
+    packages at the same time.
+
+    :returns: the lock file's descriptor, closing it releases the lock; None if another run
+        holds it
+    """
+    fd = os.open(SETTINGS.get_tmp_data_dir().joinpath(UPDATE_LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def run_updates(job_ids: Optional[List[int]], concurrency: int):
+    """Updates the given jobs' packages or, without job IDs, all packages which are due."""
+    # the graph build may finish before the app started since an upgrade
+    upgrade_db()
     with next(get_db()) as session:
         # Run the updates as software owner/admin
         user_email = session.exec(select(User).where(User.email == SETTINGS.ADMIN_EMAIL)).first().email
@@ -85,9 +284,67 @@ if __name__ == "__main__":
             handler.setLevel(logging.INFO)
             LOGGER.addHandler(handler)
 
-        jobs = session.exec(select(Job).where(Job.update == True)).all()  # noqa: E712
-        jobs = _sort_jobs(jobs)
+        run_start = None
+        if job_ids:
+            jobs = session.exec(select(Job).where(Job.id.in_(job_ids))).all()  # type: ignore
+        else:
+            # the next run is due one cadence after this one started
+            run_start = datetime.now(timezone.utc)
+            jobs = Job.get_due_jobs(session, run_start)
+        current_valhalla_dir = get_current_valhalla_dir()
+        tile_manifest = get_manifest(current_valhalla_dir) if current_valhalla_dir else None
+        sorted_jobs = _sort_jobs(jobs, tile_manifest)
+        jobs = [job for _, job in sorted_jobs]
 
         print(f"INFO: Updating {len(jobs)} packages with user {user_email}...", file=sys.stderr)
 
-        asyncio.run(update_jobs(jobs, user_email))
+        if tile_manifest is not None and jobs:
+            sizes = [size for size, _ in sorted_jobs]
+            makespan = estimate_makespan(sizes, concurrency)
+            print(
+                f"INFO: {sum(sizes) / 1024**2:.1f} MB of tiles, the busiest of {concurrency} workers "
+                f"compresses an estimated {makespan / 1024**2:.1f} MB.",
+                file=sys.stderr,
+            )
+        asyncio.run(update_jobs(jobs, user_email, concurrency, run_start))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.command == "manifest":
+        manifest_path = write_manifest(args.valhalla_dir.resolve())
+        print(f"INFO: Wrote tile manifest {manifest_path}", file=sys.stderr)
+        sys.exit(0)
+    elif args.command == "activate":
+        print(activate(args.valhalla_config.resolve(), args.port, args.old_pid, args.update))
+        sys.exit(0)
+    elif args.command == "snapshot":
+        snapshot_path = make_snapshot(args.valhalla_dir.resolve())
+        removed = collect_snapshots()
+        print(f"INFO: Created snapshot {snapshot_path}, removed {removed} old ones", file=sys.stderr)
+        sys.exit(0)
+
+    job_ids = getattr(args, "job_ids", None)
+    concurrency = getattr(args, "concurrency", SETTINGS.UPDATE_CONCURRENCY)
+    pending_path = SETTINGS.get_tmp_data_dir().joinpath(UPDATE_PENDING_NAME)
+    pending_path.parent.mkdir(parents=True, exist_ok=True)
+    if not job_ids:
+        # the run in progress updates what's due for this one, too, once it's done
+        pending_path.touch()
+    lock_fd = _try_lock_updates()
+    if lock_fd is None and job_ids:
+        print("ERROR: Another update run is in progress, try again once it's done.", file=sys.stderr)
+        sys.exit(1)
+    elif lock_fd is None:
+        print("INFO: Another update run is in progress, it runs the due updates next.", file=sys.stderr)
+        sys.exit(0)
+
+    if job_ids:
+        run_updates(job_ids, concurrency)
+        sys.exit(0)
+    while lock_fd is not None:
+        pending_path.unlink(missing_ok=True)
+        run_updates(None, concurrency)
+        os.close(lock_fd)
+        # a run which started meanwhile found the lock taken and left it to this one
+        lock_fd = _try_lock_updates() if pending_path.exists() else None
@@ -7,7 +7,7 @@ from sqlmodel import SQLModel
 
 from routing_packager_app import create_app
 from routing_packager_app.constants import Providers
-from routing_packager_app.db import engine, get_db
+from routing_packager_app.db import engine, get_db, upgrade_db
 from routing_packager_app.config import SETTINGS
 from routing_packager_app.api_v1.models import User
 
@@ -15,6 +15,7 @@ from routing_packager_app.api_v1.models import User
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     SQLModel.metadata.create_all(engine, checkfirst=True)
+    upgrade_db(engine)
     app.state.redis_pool = await create_pool(RedisSettings.from_dsn(SETTINGS.REDIS_URL))
     User.add_admin_user(next(get_db()))
 
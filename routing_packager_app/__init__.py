@@ -3,10 +3,10 @@ from fastapi import FastAPI
 from starlette.types import Lifespan
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.cors import CORSMiddleware
-from starlette.middleware.gzip import GZipMiddleware
 
 from .api_v1 import api_v1_router
 from .config import SETTINGS
+from .middlewares import GZipMiddleware
 
 
 def create_app(lifespan: Optional[Lifespan[FastAPI]]):
@@ -30,8 +30,12 @@ def register_router(app: FastAPI):
 
 
 def register_middlewares(app: FastAPI):
-    # only from 1kb we'll do gzipping
-    app.add_middleware(GZipMiddleware, minimum_size=1000)
+    # only from 1kb we'll do gzipping, but never the ZIP and tile downloads
+    app.add_middleware(
+        GZipMiddleware,
+        minimum_size=1000,
+        exclude_paths=[r"/api/v1/jobs/\d+/package", r"/api/v1/jobs/\d+/tiles/.+"],
+    )
     if SETTINGS.CORS_ORIGINS:
         app.add_middleware(
             CORSMiddleware,
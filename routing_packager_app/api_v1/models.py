@@ -1,18 +1,18 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from fastapi.security import HTTPBasicCredentials
 from geoalchemy2 import Geography
 from pydantic import EmailStr
-from sqlalchemy import Column
+from sqlalchemy import BigInteger, Column
 from sqlalchemy_utils import PasswordType
 from sqlmodel import AutoString, DateTime, Field, Relationship, Session, SQLModel, and_, select, or_
 
 from routing_packager_app.api_v1.auth import hmac_hash
 
 from ..config import SETTINGS
-from ..constants import Providers, Statuses
+from ..constants import Cadences, PackageFormats, Providers, Statuses
 from ..utils.geom_utils import wkbe_to_str
 
 
@@ -102,6 +102,19 @@ class JobBase(SQLModel):
     )
     description: str = Field(nullable=True, default="")
     update: bool = Field(nullable=False, default=False)
+    cadence: Cadences = Field(nullable=False, default=Cadences.ON_DEMAND)
+    package_format: PackageFormats = Field(nullable=False, default=PackageFormats.ZIP)
+
+
+class JobProgress(SQLModel):
+    tiles_done: int
+    tiles_total: int
+    bytes_read: int
+    bytes_written: int
+    # input bytes per second
+    throughput: float
+    elapsed: float
+    updated: datetime
 
 
 class JobRead(JobBase):
@@ -113,10 +126,37 @@ class JobRead(JobBase):
     zip_path: Optional[str]
     last_started: Optional[datetime]
     last_finished: Optional[datetime]
+    next_due: Optional[datetime] = None
+    build_id: Optional[str] = None
+    raw_size: Optional[int] = None
+    zip_size: Optional[int] = None
+    delta_size: Optional[int] = None
+    duration: Optional[float] = None
+    # the last reported progress of the ZIP being built
+    progress: Optional[JobProgress] = None
 
 
 class JobCreate(JobBase):
-    pass
+    # defaults to "build" if update is set, else "on_demand"
+    cadence: Optional[Cadences] = None
+
+
+class JobEstimate(SQLModel):
+    tiles: int
+    raw_size: int
+    zip_size: int
+    # seconds
+    duration: float
+    build_id: str
+    # identical packages of the same build have the same fingerprint
+    fingerprint: str
+    # whether the package fits into MAX_JOB_BYTES
+    admitted: bool
+
+
+CADENCE_INTERVALS = {Cadences.DAILY: timedelta(days=1), Cadences.WEEKLY: timedelta(weeks=1)}
+# graph builds don't finish at the same time every day, so packages are due a little early
+CADENCE_SLACK = timedelta(hours=2)
 
 
 class Job(JobBase, table=True):
@@ -127,10 +167,24 @@ class Job(JobBase, table=True):
     user_id: int | None = Field(default=None, foreign_key="users.id")
     status: Statuses = Field(nullable=False)
     zip_path: str = Field(nullable=True)
+    # hash over the packaged tiles, so unchanged packages can be skipped
+    fingerprint: str | None = Field(nullable=True, default=None)
+    # the Valhalla build the package was made from
+    build_id: str | None = Field(nullable=True, default=None)
+    # bytes of the packaged tiles and of their ZIP, seconds it took to build the ZIP
+    raw_size: int | None = Field(sa_column=Column(BigInteger(), nullable=True), default=None)
+    zip_size: int | None = Field(sa_column=Column(BigInteger(), nullable=True), default=None)
+    # bytes of the delta to the previous build, for updated packages
+    delta_size: int | None = Field(sa_column=Column(BigInteger(), nullable=True), default=None)
+    duration: float | None = Field(nullable=True, default=None)
     last_started: datetime | None = Field(nullable=True)  # did it ever run?
     last_finished: datetime | None = Field(
         sa_column=Column(DateTime(), nullable=True)
     )  # did it ever finish?
+    # when cli.py updates the package next, never for on-demand packages
+    next_due: datetime | None = Field(
+        sa_column=Column(DateTime(), nullable=True, index=True), default=None
+    )
 
     user: "User" = Relationship(back_populates="jobs")
 
@@ -142,6 +196,63 @@ class Job(JobBase, table=True):
         """Converts a WKBElement to a bbox string"""
         self.bbox = wkbe_to_str(self.bbox)  # type: ignore
 
+    def schedule_update(self, since: datetime):
+        """Sets when the package is due for its next update according to its cadence."""
+        if self.cadence == Cadences.ON_DEMAND:
+            self.next_due = None
+        elif self.cadence == Cadences.BUILD:
+            self.next_due = since
+        else:
+            self.next_due = since + CADENCE_INTERVALS[self.cadence] - CADENCE_SLACK
+
+    @staticmethod
+    def get_duplicate(
+        db: Session, provider: Providers, build_id: str, fingerprint: str
+    ) -> Optional["Job"]:
+        """Returns the latest completed job with exactly the same tiles from the same build."""
+        statement = (
+            select(Job)
+            .where(
+                Job.status == Statuses.COMPLETED,
+                Job.provider == provider,
+                Job.build_id == build_id,
+                Job.fingerprint == fingerprint,
+            )
+            .order_by(Job.last_finished.desc())  # type: ignore
+        )
+
+        return db.exec(statement).first()
+
+    @staticmethod
+    def get_due_jobs(db: Session, now: datetime) -> List["Job"]:
+        """Returns the jobs whose packages are due for an update, the longest overdue first."""
+        statement = (
+            select(Job)
+            .where(Job.next_due <= now)  # type: ignore
+            .order_by(Job.next_due)  # type: ignore
+        )
+
+        return list(db.exec(statement).all())
+
+    @staticmethod
+    def get_compression_stats(db: Session, limit: int = 50) -> Optional[Tuple[float, float]]:
+        """
+        Returns the compression ratio and the input bytes per second over the last finished
+        jobs which built a ZIP, or None if there are none yet.
+        """
+        statement = (
+            select(Job.raw_size, Job.zip_size, Job.duration)
+            .where(Job.status == Statuses.COMPLETED, Job.duration > 0, Job.raw_size > 0)
+            .order_by(Job.last_finished.desc())  # type: ignore
+            .limit(limit)
+        )
+        rows = db.exec(statement).all()
+        if not rows:
+            return None
+        raw_size = sum(row[0] for row in rows)
+
+        return sum(row[1] for row in rows) / raw_size, raw_size / sum(row[2] for row in rows)
+
 
 class UserBase(SQLModel):
     email: EmailStr = Field(index=True, unique=True, nullable=False, sa_type=AutoString)
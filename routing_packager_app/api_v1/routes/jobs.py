@@ -1,4 +1,7 @@
 import os
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
 from shutil import rmtree
 from typing import Tuple, List, Optional
 
@@ -7,35 +10,73 @@ from arq.constants import job_key_prefix
 from fastapi import Depends, HTTPException, APIRouter
 from fastapi.security import HTTPBasicCredentials
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from starlette.status import (
+    HTTP_400_BAD_REQUEST,
     HTTP_401_UNAUTHORIZED,
     HTTP_409_CONFLICT,
     HTTP_204_NO_CONTENT,
+    HTTP_304_NOT_MODIFIED,
     HTTP_404_NOT_FOUND,
+    HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    HTTP_503_SERVICE_UNAVAILABLE,
 )
 
 from sqlalchemy import func
 from sqlmodel import Session, select
 
-from ..models import APIKeys, APIPermission, JobRead, JobCreate, Job, User
+from ..models import APIKeys, APIPermission, JobEstimate, JobRead, JobCreate, Job, User
 from ..dependencies import split_bbox, get_validated_name
 from ...utils.db_utils import delete_or_abort, add_or_abort
 from ...db import get_db
 from ...config import SETTINGS, TestSettings
 from ..auth import BasicAuth, HeaderKey
 from ...utils.geom_utils import bbox_to_wkt
-from ...utils.file_utils import make_package_path
-from ...constants import Providers, Statuses
+from ...utils.download_utils import PackageResponse, accepts_encoding, etag_matches, open_package
+from ...utils.event_utils import (
+    FINAL_STATUSES,
+    format_sse,
+    make_job_event,
+    publish_job_status,
+    read_job_event,
+    subscribe_job_events,
+    unsubscribe_job_events,
+)
+from ...utils.estimate_utils import estimate_package
+from ...utils.file_utils import gzip_deflated, make_package_path
+from ...utils.package_manifest import (
+    diff_package_manifests,
+    find_package_tile,
+    read_package_manifest,
+    read_package_tile,
+)
+from ...utils.progress_utils import read_job_progress
+from ...utils.queue_utils import choose_queue
+from ...constants import Cadences, Providers, Statuses
 
 router = APIRouter()
 
+# seconds between SSE comments which keep idle connections open
+SSE_KEEPALIVE = 15
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+# tiles are addressed by their build, so they never change
+TILE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+async def _with_progress(req: Request, jobs: List[Job]) -> List[JobRead]:
+    """Adds the last reported progress to the jobs."""
+    progress = await read_job_progress(getattr(req.app.state, "redis_pool", None), (j.id for j in jobs))
+    return [JobRead.model_validate(job, update={"progress": progress.get(job.id)}) for job in jobs]
+
 
 @router.get("/", response_model=List[JobRead])
 async def get_jobs(
+    req: Request,
     provider: Optional[Providers] = None,
     status: Optional[Statuses] = None,
     update: bool | None = None,
+    cadence: Optional[Cadences] = None,
     bbox: Tuple[float, float, float, float] = Depends(split_bbox),
     db: Session = Depends(get_db),
     auth: HTTPBasicCredentials = Depends(BasicAuth),
@@ -62,12 +103,14 @@ async def get_jobs(
         filters.append(Job.status == status)
     if update is not None:
         filters.append(Job.update == update)
+    if cadence:
+        filters.append(Job.cadence == cadence)
 
     jobs = db.exec(select(Job).filter(*filters)).all()
     for job in jobs:
         job.convert_bbox()
 
-    return jobs
+    return await _with_progress(req, jobs)
 
 
 @router.post("/", response_model=JobRead)
@@ -97,10 +140,30 @@ async def post_job(
     else:
         user_id = current_user.id
 
+    # the update flag is the shorthand for updating after every graph build
+    if job.cadence is None:
+        job.cadence = Cadences.BUILD if job.update else Cadences.ON_DEMAND
+    job.update = job.cadence != Cadences.ON_DEMAND
+
     # keep the input bbox string around for the response
     bbox_str = job.bbox
     job.bbox = bbox_to_wkt(split_bbox(bbox_str))
 
+    # the estimate decides the queue and rejects packages over the byte budget
+    estimate = await run_in_threadpool(
+        estimate_package, split_bbox(bbox_str), Job.get_compression_stats(db)
+    )
+    if estimate and not estimate["admitted"]:
+        raise HTTPException(
+            HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"'bbox' selects {estimate['raw_size']} bytes of tiles, "
+            f"the limit is {SETTINGS.MAX_JOB_BYTES} bytes.",
+        )
+    # the worker links an existing package with exactly the same tiles instead of zipping them
+    duplicate = None
+    if estimate and estimate["tiles"]:
+        duplicate = Job.get_duplicate(db, job.provider, estimate["build_id"], estimate["fingerprint"])
+
     try:
         zip_path = make_package_path(SETTINGS.get_output_path(), job.name, job.provider.lower())
         arq_id = zip_path.stem
@@ -115,6 +178,7 @@ async def post_job(
     db_job.arq_id = arq_id
     db_job.user_id = user_id
     db_job.zip_path = str(zip_path.resolve())
+    db_job.schedule_update(datetime.now(timezone.utc))
     add_or_abort(db, db_job)
 
     # launch Redis task and update db entries there
@@ -130,15 +194,149 @@ async def post_job(
             str(zip_path.resolve()),
             user_id,
             _job_id=db_job.arq_id,
+            # linking a duplicate is cheap
+            _queue_name=choose_queue(estimate["raw_size"] if estimate and not duplicate else None),
+            source_zip_path=duplicate.zip_path if duplicate else None,
         )
+        await publish_job_status(pool, db_job.id, Statuses.QUEUED)
 
     # At this point it'd be a geoalchemy2.WKBElement but the output model requires a string
     db_job.convert_bbox()
     return db_job
 
 
+@router.get("/estimate", response_model=JobEstimate)
+async def get_estimate(
+    bbox: Tuple[float, float, float, float] = Depends(split_bbox),
+    db: Session = Depends(get_db),
+    auth: HTTPBasicCredentials = Depends(BasicAuth),
+    key: str = Depends(HeaderKey),
+):
+    """
+    Dry run of a new job: estimates the package's tiles, its raw and ZIP size and the build
+    duration from the active Valhalla build and past jobs, without creating anything.
+    """
+    # check api key is valid and active
+    matched_key = APIKeys.check_key(db, key, APIPermission.READ)
+
+    # alternatively, allow basic auth
+    current_user = User.get_user(db, auth)
+    if not current_user and not matched_key:
+        raise HTTPException(
+            HTTP_401_UNAUTHORIZED,
+            "No valid authentication method provided. Possible authentication methods: API key"
+            "(x-key header) username/password (basic auth).",
+        )
+    if not bbox:
+        raise HTTPException(HTTP_400_BAD_REQUEST, "'bbox' is required.")
+
+    estimate = await run_in_threadpool(estimate_package, bbox, Job.get_compression_stats(db))
+    if estimate is None:
+        raise HTTPException(
+            HTTP_503_SERVICE_UNAVAILABLE, "No Valhalla build with a tile manifest is active."
+        )
+
+    return estimate
+
+
+@router.get("/events")
+async def get_jobs_events(
+    req: Request,
+    db: Session = Depends(get_db),
+    auth: HTTPBasicCredentials = Depends(BasicAuth),
+    key: str = Depends(HeaderKey),
+):
+    """Streams the status transitions of all jobs as Server-Sent Events."""
+    # check api key is valid and active
+    matched_key = APIKeys.check_key(db, key, APIPermission.READ)
+
+    # alternatively, allow basic auth
+    current_user = User.get_user(db, auth)
+    if not current_user and not matched_key:
+        raise HTTPException(
+            HTTP_401_UNAUTHORIZED,
+            "No valid authentication method provided. Possible authentication methods: API key"
+            "(x-key header) username/password (basic auth).",
+        )
+
+    redis = getattr(req.app.state, "redis_pool", None)
+    if redis is None:
+        raise HTTPException(HTTP_503_SERVICE_UNAVAILABLE, "Job events are not available.")
+    pubsub = await subscribe_job_events(redis)
+
+    async def stream():
+        try:
+            while not await req.is_disconnected():
+                event = await read_job_event(pubsub, timeout=SSE_KEEPALIVE)
+                yield format_sse(event) if event else ": keepalive\n\n"
+        finally:
+            await unsubscribe_job_events(pubsub)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.get("/{job_id}/events")
+async def get_job_events(
+    req: Request,
+    job_id: int,
+    db: Session = Depends(get_db),
+    auth: HTTPBasicCredentials = Depends(BasicAuth),
+    key: str = Depends(HeaderKey),
+):
+    """
+    Streams a single job's status transitions as Server-Sent Events, starting with its current
+    status. The stream ends once the job completed, failed or was deleted.
+    """
+    # check api key is valid and active
+    matched_key = APIKeys.check_key(db, key, APIPermission.READ)
+
+    # alternatively, allow basic auth
+    current_user = User.get_user(db, auth)
+    if not current_user and not matched_key:
+        raise HTTPException(
+            HTTP_401_UNAUTHORIZED,
+            "No valid authentication method provided. Possible authentication methods: API key"
+            "(x-key header) username/password (basic auth).",
+        )
+    job = db.get(Job, job_id)
+    if not job:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"Couldn't find job id {job_id}")
+
+    pubsub = None
+    if job.status not in FINAL_STATUSES:
+        redis = getattr(req.app.state, "redis_pool", None)
+        if redis is None:
+            raise HTTPException(HTTP_503_SERVICE_UNAVAILABLE, "Job events are not available.")
+        pubsub = await subscribe_job_events(redis)
+        # read the status again, the job might have changed before we subscribed
+        db.refresh(job)
+    status = job.status
+
+    async def stream():
+        try:
+            yield format_sse(make_job_event(job_id, status))
+            if status in FINAL_STATUSES:
+                return
+            while not await req.is_disconnected():
+                event = await read_job_event(pubsub, timeout=SSE_KEEPALIVE)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                if event["job_id"] != job_id:
+                    continue
+                yield format_sse(event)
+                if Statuses(event["status"]) in FINAL_STATUSES:
+                    return
+        finally:
+            if pubsub is not None:
+                await unsubscribe_job_events(pubsub)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
 @router.get("/{job_id}", response_model=JobRead)
 async def get_job(
+    req: Request,
     job_id: int,
     db: Session = Depends(get_db),
     auth: HTTPBasicCredentials = Depends(BasicAuth),
@@ -162,7 +360,184 @@ async def get_job(
 
     job.convert_bbox()
 
-    return job
+    return (await _with_progress(req, [job]))[0]
+
+
+@router.api_route("/{job_id}/package", methods=["GET", "HEAD"], response_class=PackageResponse)
+async def get_job_package(
+    job_id: int,
+    db: Session = Depends(get_db),
+    auth: HTTPBasicCredentials = Depends(BasicAuth),
+    key: str = Depends(HeaderKey),
+):
+    """
+    Downloads a job's package ZIP. Supports single and multi-range requests to resume
+    downloads, as well as conditional requests with the ETag or Last-Modified.
+    """
+    # check api key is valid and active
+    matched_key = APIKeys.check_key(db, key, APIPermission.READ)
+
+    # alternatively, allow basic auth
+    current_user = User.get_user(db, auth)
+    if not current_user and not matched_key:
+        raise HTTPException(
+            HTTP_401_UNAUTHORIZED,
+            "No valid authentication method provided. Possible authentication methods: API key"
+            "(x-key header) username/password (basic auth).",
+        )
+    job = db.get(Job, job_id)
+    if not job:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"Couldn't find job id {job_id}")
+
+    try:
+        if not job.zip_path:
+            raise FileNotFoundError()
+        return await run_in_threadpool(open_package, Path(job.zip_path))
+    except FileNotFoundError:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"Job id {job_id} has no package yet.")
+
+
+@router.get("/{job_id}/manifest")
+async def get_job_manifest(
+    job_id: int,
+    build_id: Optional[str] = None,
+    db: Session = Depends(get_db),
+    auth: HTTPBasicCredentials = Depends(BasicAuth),
+    key: str = Depends(HeaderKey),
+):
+    """
+    GET the tile manifest of a job's package: the path, size and CRC32 of each tile and where
+    its raw deflate stream lies in the ZIP. Defaults to the package's current build.
+    """
+    # check api key is valid and active
+    matched_key = APIKeys.check_key(db, key, APIPermission.READ)
+
+    # alternatively, allow basic auth
+    current_user = User.get_user(db, auth)
+    if not current_user and not matched_key:
+        raise HTTPException(
+            HTTP_401_UNAUTHORIZED,
+            "No valid authentication method provided. Possible authentication methods: API key"
+            "(x-key header) username/password (basic auth).",
+        )
+    job = db.get(Job, job_id)
+    if not job:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"Couldn't find job id {job_id}")
+
+    build_id = build_id or job.build_id
+    manifest = None
+    if job.zip_path and build_id:
+        manifest = await run_in_threadpool(read_package_manifest, Path(job.zip_path), build_id)
+    if manifest is None:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"Job id {job_id} has no manifest of build {build_id}.")
+
+    return manifest
+
+
+@router.get("/{job_id}/manifest/diff")
+async def get_job_manifest_diff(
+    job_id: int,
+    from_build_id: str,
+    to_build_id: Optional[str] = None,
+    db: Session = Depends(get_db),
+    auth: HTTPBasicCredentials = Depends(BasicAuth),
+    key: str = Depends(HeaderKey),
+):
+    """
+    GET the tiles of a job's package which were added, changed or removed between two builds.
+    Defaults to the package's current build.
+    """
+    # check api key is valid and active
+    matched_key = APIKeys.check_key(db, key, APIPermission.READ)
+
+    # alternatively, allow basic auth
+    current_user = User.get_user(db, auth)
+    if not current_user and not matched_key:
+        raise HTTPException(
+            HTTP_401_UNAUTHORIZED,
+            "No valid authentication method provided. Possible authentication methods: API key"
+            "(x-key header) username/password (basic auth).",
+        )
+    job = db.get(Job, job_id)
+    if not job:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"Couldn't find job id {job_id}")
+
+    manifests = []
+    for build_id in (from_build_id, to_build_id or job.build_id):
+        manifest = None
+        if job.zip_path and build_id:
+            manifest = await run_in_threadpool(read_package_manifest, Path(job.zip_path), build_id)
+        if manifest is None:
+            raise HTTPException(
+                HTTP_404_NOT_FOUND, f"Job id {job_id} has no manifest of build {build_id}."
+            )
+        manifests.append(manifest)
+
+    return diff_package_manifests(*manifests)
+
+
+@router.get("/{job_id}/tiles/{build_id}/{level}/{tile_id:path}")
+async def get_job_tile(
+    req: Request,
+    job_id: int,
+    build_id: str,
+    level: int,
+    tile_id: str,
+    db: Session = Depends(get_db),
+    auth: HTTPBasicCredentials = Depends(BasicAuth),
+    key: str = Depends(HeaderKey),
+):
+    """
+    GET a single tile of a job's package, e.g. /tiles/<build_id>/2/000/762/485. It's sent as
+    stored in the ZIP with gzip framing if the client accepts gzip, else it's inflated.
+    """
+    # check api key is valid and active
+    matched_key = APIKeys.check_key(db, key, APIPermission.READ)
+
+    # alternatively, allow basic auth
+    current_user = User.get_user(db, auth)
+    if not current_user and not matched_key:
+        raise HTTPException(
+            HTTP_401_UNAUTHORIZED,
+            "No valid authentication method provided. Possible authentication methods: API key"
+            "(x-key header) username/password (basic auth).",
+        )
+    job = db.get(Job, job_id)
+    if not job:
+        raise HTTPException(HTTP_404_NOT_FOUND, f"Couldn't find job id {job_id}")
+
+    tile_path = f"{level}/{tile_id.removesuffix('.gph')}.gph"
+    tile = None
+    if job.zip_path:
+        tile = await run_in_threadpool(find_package_tile, Path(job.zip_path), build_id, tile_path)
+    if tile is None:
+        raise HTTPException(
+            HTTP_404_NOT_FOUND, f"Job id {job_id} has no tile {tile_path} of build {build_id}."
+        )
+
+    headers = {
+        "ETag": f'"{build_id}-{tile["crc32"]:08x}"',
+        "Cache-Control": TILE_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(req.headers.get("if-none-match", ""), headers["ETag"]):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+    try:
+        data = await run_in_threadpool(read_package_tile, Path(job.zip_path), tile)
+    except (OSError, ValueError):
+        raise HTTPException(HTTP_404_NOT_FOUND, f"Job id {job_id} was updated since build {build_id}.")
+
+    if accepts_encoding(req.headers.get("accept-encoding", ""), "gzip"):
+        return Response(
+            gzip_deflated(data, tile["crc32"], tile["size"]),
+            media_type="application/octet-stream",
+            headers={**headers, "Content-Encoding": "gzip"},
+        )
+    return Response(
+        await run_in_threadpool(zlib.decompress, data, -15),
+        media_type="application/octet-stream",
+        headers=headers,
+    )
 
 
 @router.delete("/{job_id}")
@@ -189,6 +564,7 @@ async def delete_job(
         # try to delete the Redis job or don't care if there is none
         if pool.keys(job_arq_id):
             await pool.delete(job_arq_id)
+        await publish_job_status(pool, job_id, Statuses.DELETED)
 
     delete_or_abort(db, db_job)
     dir_path = os.path.dirname(db_job.zip_path)
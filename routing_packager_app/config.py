@@ -7,7 +7,7 @@ from pydantic_settings import BaseSettings as _BaseSettings
 from pydantic_settings import SettingsConfigDict
 from starlette.datastructures import CommaSeparatedStrings
 
-from routing_packager_app.constants import Providers
+from routing_packager_app.constants import Providers, Queues
 
 BASE_DIR = Path(__file__).parent.parent.resolve()
 ENV_FILE = BASE_DIR.joinpath(".env")
@@ -30,6 +30,26 @@ class BaseSettings(_BaseSettings):
     VALHALLA_URL: str = "http://localhost"
 
     ENABLED_PROVIDERS: list[str] = list(CommaSeparatedStrings("osm"))
+    # how many processes compress a single package, 1 compresses in the worker process
+    ZIP_WORKERS: int = 1
+    # size limit of the compressed tile cache per Valhalla build in bytes, 0 disables it
+    TILE_CACHE_MAX_BYTES: int = 10 * 1024**3
+    # how many package updates cli.py keeps in flight, should match the bulk workers' capacity
+    UPDATE_CONCURRENCY: int = 1
+    # "thread" or "process", where the worker builds packages off its event loop
+    PACKAGE_EXECUTOR: str = "thread"
+    # how many packages a single worker process builds at the same time
+    PACKAGE_MAX_JOBS: int = 2
+    # seconds before the worker aborts building a single package
+    JOB_TIMEOUT: int = 60 * 60
+    # the most tile bytes a new package may have, 0 accepts any size
+    MAX_JOB_BYTES: int = 0
+    # the queue a worker process works off, start one worker per queue
+    WORKER_QUEUE: Queues = Queues.INTERACTIVE
+    # new packages with more tile bytes go to the bulk queue, 0 keeps all new packages interactive
+    INTERACTIVE_MAX_BYTES: int = 1024**3
+    # zstd level of the tile_extract tars' transport copy, 0 disables it, needs the zstd extra
+    TILE_EXTRACT_ZSTD_LEVEL: int = 0
 
     # DATABASES ###
     POSTGRES_HOST: str = "localhost"
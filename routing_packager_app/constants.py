@@ -13,3 +13,21 @@ class Statuses(str, Enum):
     FAILED = "Failed"
     DELETED = "Deleted"
     COMPLETED = "Completed"
+
+
+class Queues(str, Enum):
+    INTERACTIVE = "interactive"
+    BULK = "bulk"
+
+
+class PackageFormats(str, Enum):
+    ZIP = "zip"
+    # an uncompressed tar with an index, which Valhalla can memory-map, next to the ZIP
+    TILE_EXTRACT = "tile_extract"
+
+
+class Cadences(str, Enum):
+    BUILD = "build"
+    DAILY = "daily"
+    WEEKLY = "weekly"
+    ON_DEMAND = "on_demand"
@@ -1,12 +1,18 @@
 import os
+from datetime import datetime, timezone
 from typing import Generator
 
+from sqlalchemy import Engine, Enum, inspect, text
+from sqlalchemy.orm import sessionmaker
 from sqlmodel import create_engine, Session
 
 from .config import SETTINGS as S
 
 SQLALCHEMY_DATABASE_URI: str = f"postgresql://{S.POSTGRES_USER}:{S.POSTGRES_PASS}@{S.POSTGRES_HOST}:{S.POSTGRES_PORT}/{S.POSTGRES_DB}"
 
+# any constant, only upgrade_db takes this advisory lock
+UPGRADE_LOCK_KEY = 0x6A6F6273
+
 engine = create_engine(SQLALCHEMY_DATABASE_URI, echo=bool(os.getenv("DEBUG")), future=True)
 
 
@@ -17,3 +23,47 @@ def get_db() -> Generator[Session, None, None]:
         yield db
     finally:
         db.close()
+
+
+def make_session_factory() -> sessionmaker:
+    """Returns a factory of DB sessions which share the engine's connection pool."""
+    return sessionmaker(engine, class_=Session, autoflush=False)
+
+
+def upgrade_db(engine_: Engine = engine):
+    """
+    Adds the columns and indexes of the jobs table which are missing in databases from earlier
+    versions, create_all only creates missing tables. Runs on every start and only changes
+    what's missing. Packages which were updated by their "update" flag get the "build" cadence.
+    """
+    from .api_v1.models import Job
+    from .constants import Cadences, PackageFormats
+
+    # existing rows need a value for the NOT NULL columns
+    defaults = {"cadence": Cadences.ON_DEMAND.name, "package_format": PackageFormats.ZIP.name}
+    table = Job.__table__  # type: ignore
+    with engine_.begin() as conn:
+        # gunicorn starts several app workers at once
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": UPGRADE_LOCK_KEY})
+        existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+        if not existing:
+            return
+        preparer = conn.dialect.identifier_preparer
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if isinstance(column.type, Enum):
+                column.type.create(conn, checkfirst=True)
+            ddl = f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} "
+            ddl += column.type.compile(dialect=conn.dialect)
+            if not column.nullable:
+                ddl += f" NOT NULL DEFAULT '{defaults[column.name]}'"
+            conn.execute(text(ddl))
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+        if "cadence" not in existing:
+            conn.execute(
+                text('UPDATE jobs SET cadence = :cadence, next_due = :now WHERE "update"'),
+                {"cadence": Cadences.BUILD.name, "now": datetime.now(timezone.utc)},
+            )
@@ -0,0 +1,29 @@
+import re
+from typing import Sequence
+
+from starlette.middleware.gzip import GZipMiddleware as _GZipMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+class GZipMiddleware(_GZipMiddleware):
+    """
+    GZips responses except for the paths which serve already compressed files, like the package
+    downloads. Compressing a ZIP again only wastes CPU and breaks range requests.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 500,
+        compresslevel: int = 9,
+        exclude_paths: Sequence[str] = (),
+    ) -> None:
+        super().__init__(app, minimum_size, compresslevel)
+        self.exclude_paths = [re.compile(path) for path in exclude_paths]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and any(p.fullmatch(scope["path"]) for p in self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+
+        await super().__call__(scope, receive, send)
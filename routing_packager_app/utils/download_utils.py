@@ -0,0 +1,280 @@
+import json
+import os
+import re
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import blake2b
+from pathlib import Path
+from secrets import token_hex
+from typing import BinaryIO, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# the ASGI extension servers advertise if they can send file descriptors with os.sendfile()
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+# more ranges than that are served as a whole, it's no resumed download anymore
+MAX_RANGES = 50
+
+_RANGE_SPEC = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+def parse_ranges(http_range: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a Range header into sorted, coalesced byte ranges.
+
+    :param http_range: the Range header's value, e.g. "bytes=0-99,-100".
+    :param size: the file size in bytes.
+
+    :returns: (start, end) pairs with an exclusive end, an empty list if no range is
+        satisfiable; None if the header is malformed or has too many ranges, i.e. it's ignored
+    """
+    units, _, specs = http_range.partition("=")
+    if units.strip().lower() != "bytes" or not specs:
+        return None
+
+    ranges = []
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+    for spec in specs:
+        match = _RANGE_SPEC.match(spec)
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if not first:
+            # the last n bytes
+            start, end = max(size - int(last), 0), size
+        else:
+            start, end = int(first), size if not last else min(int(last) + 1, size)
+            if last and int(last) < start:
+                return None
+        if start < end:
+            ranges.append((start, end))
+
+    coalesced: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if coalesced and start <= coalesced[-1][1]:
+            coalesced[-1] = (coalesced[-1][0], max(end, coalesced[-1][1]))
+        else:
+            coalesced.append((start, end))
+
+    return coalesced
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks an If-None-Match header against a resource's ETag with the weak comparison.
+
+    :param if_none_match: the header's value, e.g. 'W/"abc", "def"' or "*".
+    :param etag: the resource's quoted ETag.
+
+    :returns: whether one of the header's ETags or "*" matches
+    """
+    etags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in etags or etag.removeprefix("W/") in etags
+
+
+def accepts_encoding(accept_encoding: str, coding: str) -> bool:
+    """
+    Checks whether an Accept-Encoding header allows a content coding. The coding's own entry
+    takes precedence over "*", a quality of 0 rules it out.
+
+    :param accept_encoding: the header's value, e.g. "gzip;q=0.5, br" or "*;q=0".
+    :param coding: the content coding, e.g. "gzip".
+
+    :returns: whether the coding is acceptable
+    """
+    qualities = {}
+    for entry in accept_encoding.split(","):
+        name, *params = (part.strip() for part in entry.split(";"))
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        # x-gzip and x-compress are aliases
+        qualities[name.lower().removeprefix("x-")] = quality
+
+    quality = qualities.get(coding.lower(), qualities.get("*", 0.0))
+    return quality > 0
+
+
+def get_package_validators(zip_path: Path, stat_result: os.stat_result) -> Tuple[str, datetime]:
+    """
+    Derives the strong ETag and the modification time of a package from its meta JSON. The ETag
+    only changes with the package's tiles, so downloads resume across package updates which
+    didn't change anything.
+
+    :param zip_path: the package's ZIP path.
+    :param stat_result: the stat of the opened ZIP, used if the meta JSON is missing.
+
+    :returns: the ETag and the last modification time
+    """
+    try:
+        meta = json.loads(zip_path.with_suffix(".json").read_text())
+    except (OSError, ValueError):
+        meta = dict()
+    # meta JSONs before the fingerprint was recorded
+    version = meta.get("fingerprint") or str(stat_result.st_mtime_ns)
+    hasher = blake2b(digest_size=16)
+    hasher.update(f"{meta.get('build_id')}:{version}:{stat_result.st_size}".encode())
+
+    try:
+        last_modified = datetime.fromisoformat(meta["last_modified"])
+    except (KeyError, TypeError, ValueError):
+        last_modified = datetime.fromtimestamp(stat_result.st_mtime, timezone.utc)
+
+    return f'"{hasher.hexdigest()}"', last_modified
+
+
+class PackageResponse(Response):
+    """
+    Sends a package ZIP with support for conditional, single and multi-range requests. The
+    file is sent with os.sendfile() if the ASGI server supports the zero-copy send extension,
+    otherwise it's read in chunks off the event loop. The response owns the opened file.
+    """
+
+    media_type = "application/zip"
+    chunk_size = 1024**2
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        size: int,
+        etag: str,
+        last_modified: datetime,
+        filename: str,
+    ):
+        self.file = file
+        self.size = size
+        self.status_code = 200
+        self.background = None
+        self.init_headers({
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "last-modified": formatdate(last_modified.timestamp(), usegmt=True),
+            "content-disposition": f'attachment; filename="{filename}"',
+        })
+        self.last_modified = last_modified
+
+    def _is_not_modified(self, headers: Headers) -> bool:
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            return etag_matches(if_none_match, self.headers["etag"])
+        try:
+            if_modified_since = parsedate_to_datetime(headers["if-modified-since"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        return self.last_modified.replace(microsecond=0) <= if_modified_since
+
+    def _use_range(self, headers: Headers) -> bool:
+        if_range = headers.get("if-range")
+        # a weak ETag never matches If-Range
+        return if_range is None or if_range in (self.headers["etag"], self.headers["last-modified"])
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self._respond(scope, receive, send)
+        finally:
+            await run_in_threadpool(self.file.close)
+
+    async def _respond(self, scope: Scope, receive: Receive, send: Send):
+        headers = Headers(scope=scope)
+        header_only = scope["method"].upper() == "HEAD"
+        zerocopy = ZEROCOPY_EXTENSION in scope.get("extensions", {})
+
+        if self._is_not_modified(headers):
+            await send({"type": "http.response.start", "status": 304, "headers": self.raw_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        ranges = None
+        if "range" in headers and self._use_range(headers):
+            ranges = parse_ranges(headers["range"], self.size)
+        if ranges == []:
+            await Response(
+                status_code=416,
+                headers={"content-range": f"bytes */{self.size}", "accept-ranges": "bytes"},
+            )(scope, receive, send)
+            return
+
+        status = 200
+        parts: List[Tuple[bytes, int, int]] = [(b"", 0, self.size)]
+        trailer = b""
+        if ranges is not None and len(ranges) == 1:
+            status = 206
+            start, end = ranges[0]
+            self.headers["content-range"] = f"bytes {start}-{end - 1}/{self.size}"
+            parts = [(b"", start, end)]
+        elif ranges is not None:
+            status = 206
+            boundary = token_hex(13)
+            self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+            parts = []
+            for start, end in ranges:
+                # the line break before a boundary belongs to the boundary
+                part = (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {self.media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end - 1}/{self.size}\r\n\r\n"
+                ).encode("latin-1")
+                parts.append((b"\r\n" + part if parts else part, start, end))
+            trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        length = sum(len(part) + end - start for part, start, end in parts) + len(trailer)
+        self.headers["content-length"] = str(length)
+
+        await send({"type": "http.response.start", "status": status, "headers": self.raw_headers})
+        if header_only:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        for part, start, end in parts:
+            if part:
+                await send({"type": "http.response.body", "body": part, "more_body": True})
+            await self._send_file(send, start, end, zerocopy)
+        await send({"type": "http.response.body", "body": trailer})
+
+    async def _send_file(self, send: Send, start: int, end: int, zerocopy: bool):
+        if zerocopy:
+            await send({
+                "type": ZEROCOPY_EXTENSION,
+                "file": self.file,
+                "offset": start,
+                "count": end - start,
+                "more_body": True,
+            })
+            return
+        fd = self.file.fileno()
+        while start < end:
+            chunk = await run_in_threadpool(os.pread, fd, min(self.chunk_size, end - start), start)
+            if not chunk:
+                raise RuntimeError(f"{self.file.name} was truncated while it was sent.")
+            start += len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+
+def open_package(zip_path: Path) -> PackageResponse:
+    """
+    Opens a package for download. The open file stays valid while the package is updated.
+
+    :param zip_path: the package's ZIP path.
+
+    :returns: the response sending the package
+    :raises FileNotFoundError: if there's no package (yet)
+    """
+    file = open(zip_path, "rb")
+    try:
+        stat_result = os.fstat(file.fileno())
+        etag, last_modified = get_package_validators(zip_path, stat_result)
+    except BaseException:
+        file.close()
+        raise
+
+    return PackageResponse(file, stat_result.st_size, etag, last_modified, zip_path.name)
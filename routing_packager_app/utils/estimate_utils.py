@@ -0,0 +1,44 @@
+from typing import Dict, Optional, Tuple
+
+from ..config import SETTINGS
+from .tile_manifest import get_fingerprint, get_manifest
+from .valhalla_utils import get_current_valhalla_dir
+
+# used until there are finished jobs to learn from, measured on the Andorra test tiles
+DEFAULT_COMPRESSION_RATIO = 0.47
+# input bytes per second of building a ZIP
+DEFAULT_THROUGHPUT = 20 * 1024**2
+
+
+def estimate_package(
+    bbox: Tuple[float, float, float, float], stats: Optional[Tuple[float, float]] = None
+) -> Optional[Dict]:
+    """
+    Estimates the size and build duration of a package from the active build's tile manifest,
+    without touching the tiles.
+
+    :param bbox: the bbox as a list of floats in [minx, miny, maxx, maxy].
+    :param stats: the compression ratio and input bytes per second of past jobs.
+
+    :returns: the number of tiles, their raw and estimated ZIP size in bytes, the estimated
+        duration in seconds, the build ID, the tiles' fingerprint and whether the package fits
+        into MAX_JOB_BYTES; None if there's no active build or it has no tile manifest yet
+    """
+    valhalla_dir = get_current_valhalla_dir()
+    manifest = get_manifest(valhalla_dir) if valhalla_dir else None
+    if manifest is None:
+        return None
+    ratio, throughput = stats or (DEFAULT_COMPRESSION_RATIO, DEFAULT_THROUGHPUT)
+
+    entries = manifest.get_tiles(bbox)
+    raw_size = sum(entry.size for entry in entries)
+
+    return {
+        "tiles": len(entries),
+        "raw_size": raw_size,
+        "zip_size": round(raw_size * ratio),
+        "duration": raw_size / throughput,
+        "build_id": manifest.build_id,
+        "fingerprint": get_fingerprint(entries),
+        "admitted": SETTINGS.MAX_JOB_BYTES <= 0 or raw_size <= SETTINGS.MAX_JOB_BYTES,
+    }
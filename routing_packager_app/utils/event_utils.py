@@ -0,0 +1,111 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from redis.asyncio import Redis
+from redis.asyncio.client import PubSub
+
+from ..constants import Statuses
+
+JOB_EVENTS_CHANNEL = "routing_packager:job_events"
+FINAL_STATUSES = (Statuses.COMPLETED, Statuses.FAILED, Statuses.DELETED)
+
+
+def make_job_event(job_id: int, status: Statuses) -> Dict:
+    """Returns the payload of a status transition."""
+    return {"job_id": job_id, "status": status.value, "time": datetime.now(timezone.utc).isoformat()}
+
+
+def format_sse(event: Dict) -> str:
+    """Formats a job event as a Server-Sent Event."""
+    return f"event: status\ndata: {json.dumps(event)}\n\n"
+
+
+async def publish_job_status(redis: Optional[Redis], job_id: int, status: Statuses):
+    """
+    Publishes a job's status transition to everyone listening on the job events channel.
+
+    :param redis: The Redis connection, nothing is published if it's None, e.g. in tests.
+    :param job_id: The job's database ID.
+    :param status: The job's new status.
+    """
+    if redis is None:
+        return
+    await redis.publish(JOB_EVENTS_CHANNEL, json.dumps(make_job_event(job_id, status)))
+
+
+async def subscribe_job_events(redis: Redis) -> PubSub:
+    """Subscribes to the job events channel, pass the result to unsubscribe_job_events when done."""
+    pubsub = redis.pubsub()
+    await pubsub.subscribe(JOB_EVENTS_CHANNEL)
+
+    return pubsub
+
+
+async def unsubscribe_job_events(pubsub: PubSub):
+    """Ends a subscription from subscribe_job_events."""
+    await pubsub.unsubscribe(JOB_EVENTS_CHANNEL)
+    await pubsub.aclose()
+
+
+async def read_job_event(pubsub: PubSub, timeout: float) -> Optional[Dict]:
+    """
+    Waits for the next job event.
+
+    :param pubsub: A subscription from subscribe_job_events.
+    :param timeout: Seconds to wait for an event.
+
+    :returns: the event or None if there was none within timeout
+    """
+    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+    if message is None:
+        return None
+
+    return json.loads(message["data"])
+
+
+class JobStatusWaiter:
+    """
+    Lets many tasks wait for their jobs to finish with a single subscription to the job events.
+
+    Call expect() before enqueueing a job, so its final status can't be missed.
+    """
+
+    def __init__(self, redis: Redis):
+        self._redis = redis
+        self._futures: Dict[int, asyncio.Future] = dict()
+        self._reader: Optional[asyncio.Task] = None
+        self._pubsub: Optional[PubSub] = None
+
+    def expect(self, job_id: int):
+        """Starts collecting the job's events."""
+        if job_id not in self._futures:
+            self._futures[job_id] = asyncio.get_running_loop().create_future()
+
+    async def _read(self, pubsub: PubSub):
+        while True:
+            event = await read_job_event(pubsub, timeout=60)
+            if event is None or Statuses(event["status"]) not in FINAL_STATUSES:
+                continue
+            # ignore the jobs nobody is waiting for
+            future = self._futures.get(event["job_id"])
+            if future is not None and not future.done():
+                future.set_result(Statuses(event["status"]))
+
+    async def __aenter__(self) -> "JobStatusWaiter":
+        self._pubsub = await subscribe_job_events(self._redis)
+        self._reader = asyncio.create_task(self._read(self._pubsub))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._reader.cancel()
+        await unsubscribe_job_events(self._pubsub)
+
+    async def wait(self, job_id: int) -> Statuses:
+        """Returns the job's final status as soon as it's published."""
+        self.expect(job_id)
+        status = await asyncio.shield(self._futures[job_id])
+        # a package can be updated again later on
+        self._futures.pop(job_id, None)
+        return status
@@ -1,6 +1,94 @@
+import io
+import multiprocessing
+import os
+import struct
+import sys
+import tarfile
+import tempfile
 import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Set
+from threading import Event, Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from .progress_utils import ZipProgress
+from .tile_cache import TileCache
+from .tile_manifest import TileEntry, TileManifest
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# signature, versions, flags, compression, time, date, CRC, sizes, name & extra field lengths
+LOCAL_FILE_HEADER = struct.Struct("<4s2B4HL2L2H")
+
+# magic, deflate, no flags, no modification time, no extra flags, unknown OS
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+# the worker runs threads, forked processes could inherit locks which those threads held
+PROCESS_CONTEXT = multiprocessing.get_context("forkserver")
+
+# one deflate pool per process and number of workers, they exit with the process
+_DEFLATE_POOLS: Dict[int, ProcessPoolExecutor] = {}
+_DEFLATE_POOLS_LOCK = Lock()
+
+# the Python versions whose zipfile internals write_deflated was checked against, others recompress
+RAW_WRITE_VERSIONS = ((3, 11), (3, 13))
+
+# the first member of Valhalla's tile_extract, one entry per tile: offset in the tar, graph ID, size
+TILE_EXTRACT_INDEX_NAME = "index.bin"
+TILE_EXTRACT_INDEX_ENTRY = struct.Struct("<QLL")
+# tiles start on a page boundary in the tar, so Valhalla can use the mapped tar as is
+TILE_EXTRACT_ALIGNMENT = 4096
+
+
+class ZipCancelled(Exception):
+    """Raised by make_zip when its cancel event is set."""
+
+
+def _check_cancel(cancel: Optional[Event]):
+    if cancel is not None and cancel.is_set():
+        raise ZipCancelled("Building the ZIP was cancelled.")
+
+
+def make_tmp_path(out_fp: str) -> str:
+    """
+    Creates an empty, uniquely named file next to out_fp to write it to, before it's atomically
+    moved there. Concurrent writers of the same file don't clobber each other's data this way.
+
+    :param out_fp: the file which is about to be written.
+
+    :returns: the temporary file's path
+    """
+    fd, tmp_fp = tempfile.mkstemp(
+        dir=os.path.dirname(out_fp) or None, prefix=f".{os.path.basename(out_fp)}.", suffix=".tmp"
+    )
+    os.close(fd)
+    # mkstemp only lets the owner read it
+    os.chmod(tmp_fp, 0o644)
+
+    return tmp_fp
+
+
+def remove_tmp_files(dir_path: Path) -> int:
+    """
+    Removes the temporary files make_tmp_path left in a directory and its subdirectories, e.g.
+    when a build process died before it could clean up.
+
+    :param dir_path: the directory, e.g. a package's.
+
+    :returns: how many files were removed
+    """
+    count = 0
+    for tmp_path in dir_path.rglob(".*.tmp"):
+        tmp_path.unlink(missing_ok=True)
+        count += 1
+
+    return count
 
 
 def make_package_path(base_dir: Path, name: str, provider: str) -> Path:
@@ -22,14 +110,425 @@ def make_package_path(base_dir: Path, name: str, provider: str) -> Path:
     return out_dir.joinpath(file_name + ".zip").resolve()
 
 
-def make_zip(source_paths: Set[Path], parent_path: Path, out_fp: str):
+def deflate_file(path: Path) -> Tuple[int, int, bytes]:
+    """
+    Compresses a file the same way as zipfile.ZIP_DEFLATED does.
+
+    :param path: the file to compress.
+
+    :returns: the CRC32, the uncompressed size and the raw deflate stream
+    """
+    data = path.read_bytes()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    return zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
+
+
+def gzip_deflated(data: bytes, crc: int, size: int) -> bytes:
+    """
+    Wraps a raw deflate stream, e.g. a ZIP member's, into a gzip stream without recompressing
+    it. gzip ends with the same CRC32 and size which ZIPs store.
+
+    :param data: the raw deflate stream.
+    :param crc: the CRC32 of the uncompressed data.
+    :param size: the size of the uncompressed data.
+
+    :returns: the gzip stream
+    """
+    return GZIP_HEADER + data + struct.pack("<2L", crc, size & 0xFFFFFFFF)
+
+
+def _get_deflate_pool(workers: int) -> ProcessPoolExecutor:
+    """Returns this process' deflate pool with that many workers, starting one is expensive."""
+    with _DEFLATE_POOLS_LOCK:
+        if workers not in _DEFLATE_POOLS:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=PROCESS_CONTEXT)
+            _DEFLATE_POOLS[workers] = pool
+        return _DEFLATE_POOLS[workers]
+
+
+def _deflate_files(paths: Iterable[Path], workers: int) -> Iterator[Tuple[int, int, bytes]]:
+    """Deflates the files in a process pool and yields the results in order."""
+    executor = _get_deflate_pool(workers)
+    # keep only a few results per process in memory
+    pending = deque()
+    try:
+        for path in paths:
+            pending.append(executor.submit(deflate_file, path))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        # e.g. a process was killed, the next call starts a new pool
+        with _DEFLATE_POOLS_LOCK:
+            if _DEFLATE_POOLS.get(workers) is executor:
+                del _DEFLATE_POOLS[workers]
+        raise
+    finally:
+        # don't leave work behind for the shared pool when stopping early
+        for future in pending:
+            future.cancel()
+
+
+def read_deflated(archive: zipfile.ZipFile, zinfo: zipfile.ZipInfo) -> bytes:
+    """
+    Reads a member's raw deflate stream without decompressing it.
+
+    :param archive: the ZIP file opened for reading.
+    :param zinfo: the deflated member's info.
+
+    :returns: the raw deflate stream
+    """
+    archive.fp.seek(zinfo.header_offset)
+    header = LOCAL_FILE_HEADER.unpack(archive.fp.read(LOCAL_FILE_HEADER.size))
+    # skip the local file name and extra field, they can differ from the central directory
+    archive.fp.seek(header[-2] + header[-1], os.SEEK_CUR)
+
+    return archive.fp.read(zinfo.compress_size)
+
+
+def write_deflated(archive: zipfile.ZipFile, zinfo: zipfile.ZipInfo, data: bytes):
+    """
+    Writes an already deflated member to the archive. Mirrors what ZipFile.write() does
+    after it compressed a file, so the archive is byte-identical to a serially written one.
+
+    :param archive: the ZIP file opened for writing.
+    :param zinfo: the member's info with filename, date_time, CRC and file_size set.
+    :param data: the raw deflate stream.
+    """
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.compress_size = len(data)
+    zinfo.flag_bits = 0x00
+    if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+
+    if not _can_write_raw(archive):
+        # recompressing yields the same stream, just slower
+        archive.writestr(zinfo, zlib.decompress(data, -15))
+        return
+
+    # zipfile has no public API to add pre-compressed data
+    archive.fp.seek(archive.start_dir)
+    zinfo.header_offset = archive.fp.tell()
+    archive._writecheck(zinfo)
+    archive._didModify = True
+    archive.fp.write(zinfo.FileHeader(zip64))
+    archive.fp.write(data)
+    archive.start_dir = archive.fp.tell()
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+
+
+def _can_write_raw(archive: zipfile.ZipFile) -> bool:
+    """Whether write_deflated can rely on the zipfile internals of this Python version."""
+    return RAW_WRITE_VERSIONS[0] <= sys.version_info[:2] <= RAW_WRITE_VERSIONS[1] and all(
+        hasattr(archive, attr) for attr in ("start_dir", "_writecheck", "_didModify", "NameToInfo")
+    )
+
+
+def make_delta_zip(source_fp: str, out_fp: str, arcnames: Iterable[str], extra: Dict[str, str]) -> int:
+    """
+    Copies some members of a ZIP into a new one without recompressing them. The archive is
+    written next to out_fp and atomically moved there.
+
+    :param source_fp: the ZIP to copy the members from, they have to be deflated.
+    :param out_fp: full path to the resulting ZIP file.
+    :param arcnames: the members to copy.
+    :param extra: more members to add by their arcname, e.g. a JSON describing the archive.
+
+    :returns: the size of the resulting ZIP in bytes
     """
-    ZIPs the input paths.
+    tmp_fp = make_tmp_path(out_fp)
+    try:
+        with (
+            zipfile.ZipFile(source_fp) as source,
+            zipfile.ZipFile(tmp_fp, "w", zipfile.ZIP_DEFLATED) as out,
+        ):
+            for arcname in arcnames:
+                old_zinfo = source.getinfo(arcname)
+                zinfo = zipfile.ZipInfo(arcname, old_zinfo.date_time)
+                zinfo.CRC = old_zinfo.CRC
+                zinfo.file_size = old_zinfo.file_size
+                zinfo.external_attr = old_zinfo.external_attr
+                write_deflated(out, zinfo, read_deflated(source, old_zinfo))
+            for arcname, content in extra.items():
+                out.writestr(arcname, content)
+        os.replace(tmp_fp, out_fp)
+    except BaseException:
+        if os.path.exists(tmp_fp):
+            os.unlink(tmp_fp)
+        raise
+
+    return os.path.getsize(out_fp)
+
+
+def _get_reusable_members(
+    previous_fp: str,
+    previous_hashes: Dict[str, str],
+    arcnames: Dict[Path, str],
+    manifest: TileManifest,
+    parent_path: Path,
+) -> Dict[Path, zipfile.ZipInfo]:
+    """
+    Returns the previous package's members which didn't change. A CRC32 can collide, so the
+    tiles' content hashes have to match, too.
+    """
+    reusable = dict()
+    with zipfile.ZipFile(previous_fp) as previous:
+        for p, arcname in arcnames.items():
+            tile_path = str(p.relative_to(parent_path))
+            try:
+                zinfo = previous.getinfo(arcname)
+            except KeyError:
+                continue
+            entry = manifest.find_path(tile_path)
+            if (
+                entry is not None
+                and previous_hashes.get(tile_path) == f"{entry.hash:016x}"
+                and zinfo.compress_type == zipfile.ZIP_DEFLATED
+                and not zinfo.flag_bits & 0x1  # encrypted
+                and (zinfo.CRC, zinfo.file_size) == (entry.crc32, entry.size)
+            ):
+                reusable[p] = zinfo
+
+    return reusable
+
+
+def make_zip(
+    source_paths: Set[Path],
+    parent_path: Path,
+    out_fp: str,
+    workers: int = 1,
+    cache: Optional[TileCache] = None,
+    manifest: Optional[TileManifest] = None,
+    previous_fp: Optional[str] = None,
+    previous_hashes: Optional[Dict[str, str]] = None,
+    cancel: Optional[Event] = None,
+    progress: Optional[Callable[[ZipProgress], None]] = None,
+) -> List[zipfile.ZipInfo]:
+    """
+    ZIPs the input paths. The archive is written next to out_fp and atomically moved there.
 
     :param source_paths: set of paths which need zipping.
     :param parent_path: the valhalla_tiles dir, for the file's arcname.
     :param out_fp: full path to the resulting Zip file.
+    :param workers: how many processes compress the tiles, 1 compresses in this process.
+    :param cache: copy already deflated tiles from this cache and add the new ones.
+    :param manifest: the parent_path's tile manifest, needed to reuse members of previous_fp.
+    :param previous_fp: a previous version of the package, its unchanged members are copied
+        without recompressing them.
+    :param previous_hashes: the content hashes of previous_fp's tiles by their path, as in its
+        package manifest. Only tiles with the same hash are reused.
+    :param cancel: checked before each member, raises ZipCancelled once it's set. Works with
+        threading and multiprocessing.Manager events.
+    :param progress: called with the ZipProgress after each member.
+
+    :returns: the archive's members, with their CRC32 and offsets
+    """
+    paths = sorted(source_paths)
+    arcnames = {p: "valhalla_tiles/" + str(p.relative_to(parent_path)) for p in paths}
+    reusable = dict()
+    if previous_fp and previous_hashes and manifest and os.path.isfile(previous_fp):
+        reusable = _get_reusable_members(previous_fp, previous_hashes, arcnames, manifest, parent_path)
+
+    tmp_fp = make_tmp_path(out_fp)
+    try:
+        with zipfile.ZipFile(tmp_fp, "w", zipfile.ZIP_DEFLATED) as archive:
+            if workers <= 1 and cache is None and not reusable:
+                bytes_read = 0
+                for idx, p in enumerate(paths, 1):
+                    _check_cancel(cancel)
+                    archive.write(p, arcnames[p])
+                    if progress:
+                        bytes_read += archive.filelist[-1].file_size
+                        progress(ZipProgress(idx, len(paths), bytes_read, archive.fp.tell()))
+            else:
+                _write_members(
+                    archive, paths, arcnames, workers, cache, reusable, previous_fp, cancel, progress
+                )
+            members = list(archive.filelist)
+        os.replace(tmp_fp, out_fp)
+    except BaseException:
+        if os.path.exists(tmp_fp):
+            os.unlink(tmp_fp)
+        raise
+
+    return members
+
+
+def _write_members(
+    archive: zipfile.ZipFile,
+    paths: Sequence[Path],
+    arcnames: Dict[Path, str],
+    workers: int,
+    cache: Optional[TileCache],
+    reusable: Dict[Path, zipfile.ZipInfo],
+    previous_fp: Optional[str],
+    cancel: Optional[Event],
+    progress: Optional[Callable[[ZipProgress], None]],
+):
+    """Writes deflated members, reusing what's possible and compressing the rest in order."""
+    # only compress what's neither in the previous package nor cached yet
+    cached_paths = {p for p in paths if p not in reusable and cache and cache.contains(p)}
+    missing_paths = [p for p in paths if p not in reusable and p not in cached_paths]
+    if workers <= 1:
+        deflated = map(deflate_file, missing_paths)
+    else:
+        deflated = _deflate_files(missing_paths, workers)
+
+    previous = zipfile.ZipFile(previous_fp) if reusable else None
+    bytes_read = 0
+    try:
+        for idx, p in enumerate(paths, 1):
+            _check_cancel(cancel)
+            if p in reusable:
+                old_zinfo = reusable[p]
+                result = old_zinfo.CRC, old_zinfo.file_size, read_deflated(previous, old_zinfo)
+            elif p in cached_paths:
+                result = cache.get(p)
+                if result is None:
+                    # evicted in the meantime
+                    result = deflate_file(p)
+                    cache.put(p, *result)
+            else:
+                result = next(deflated)
+                if cache:
+                    cache.put(p, *result)
+
+            crc, file_size, data = result
+            zinfo = zipfile.ZipInfo.from_file(p, arcnames[p])
+            zinfo.CRC = crc
+            zinfo.file_size = file_size
+            write_deflated(archive, zinfo, data)
+            if progress:
+                bytes_read += file_size
+                progress(ZipProgress(idx, len(paths), bytes_read, archive.fp.tell()))
+    finally:
+        if workers > 1:
+            # cancels what the pool would still deflate when stopping early
+            deflated.close()
+        if previous:
+            previous.close()
+
+
+def _get_tar_padding(offset: int) -> int:
+    """Bytes to skip before the next tar header at offset, so its data starts on a page."""
+    return -(offset + tarfile.BLOCKSIZE) % TILE_EXTRACT_ALIGNMENT
+
+
+def _get_tar_size(size: int) -> int:
+    """A tar member's data size, padded to whole blocks."""
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def _add_tar_member(archive: tarfile.TarFile, name: str, data: bytes, mtime: int = 0):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = mtime
+    tarinfo.mode = 0o644
+    archive.addfile(tarinfo, io.BytesIO(data))
+
+
+def make_tile_extract(
+    entries: Sequence[TileEntry],
+    parent_path: Path,
+    out_fp: str,
+    cancel: Optional[Event] = None,
+    progress: Optional[Callable[[ZipProgress], None]] = None,
+) -> int:
+    """
+    Writes the tiles into an uncompressed tar with the index Valhalla's mjolnir.tile_extract
+    expects, so it can be memory-mapped without unpacking it. Each tile's data starts on a
+    page. The archive is written next to out_fp and atomically moved there.
+
+    :param entries: the tiles' manifest entries, their size is what's put into the index.
+    :param parent_path: the Valhalla tile directory the entries are relative to.
+    :param out_fp: full path to the resulting tar file.
+    :param cancel: checked before each tile, raises ZipCancelled once it's set.
+    :param progress: called with the ZipProgress after each tile.
+
+    :returns: the size of the tar in bytes
+    :raises ValueError: if a tile's size differs from its entry
     """
-    with zipfile.ZipFile(out_fp, "w", zipfile.ZIP_DEFLATED) as archive:
-        for p in source_paths:
-            archive.write(p, "valhalla_tiles/" + str(p.relative_to(parent_path)))
+    entries = sorted(entries, key=lambda e: (e.level, e.tile_id))
+
+    # the index comes first, so all offsets are computed before writing anything
+    index = bytearray()
+    offset = tarfile.BLOCKSIZE + _get_tar_size(len(entries) * TILE_EXTRACT_INDEX_ENTRY.size)
+    for entry in entries:
+        offset += _get_tar_padding(offset) + tarfile.BLOCKSIZE
+        index += TILE_EXTRACT_INDEX_ENTRY.pack(offset, entry.level | entry.tile_id << 3, entry.size)
+        offset += _get_tar_size(entry.size)
+
+    tmp_fp = make_tmp_path(out_fp)
+    try:
+        with tarfile.open(tmp_fp, "w", format=tarfile.USTAR_FORMAT) as archive:
+            _add_tar_member(archive, TILE_EXTRACT_INDEX_NAME, bytes(index))
+            bytes_read = 0
+            for idx, entry in enumerate(entries, 1):
+                _check_cancel(cancel)
+                padding = _get_tar_padding(archive.offset)
+                if padding:
+                    # an empty member takes one block, the rest is its data
+                    _add_tar_member(archive, ".padding", bytes(padding - tarfile.BLOCKSIZE))
+                data = parent_path.joinpath(entry.path).read_bytes()
+                if len(data) != entry.size:
+                    raise ValueError(f"Tile {entry.path} has {len(data)} bytes instead of {entry.size}.")
+                _add_tar_member(archive, entry.path, data, entry.mtime_ns // 10**9)
+                if progress:
+                    bytes_read += entry.size
+                    progress(ZipProgress(idx, len(entries), bytes_read, archive.offset))
+        os.replace(tmp_fp, out_fp)
+    except BaseException:
+        if os.path.exists(tmp_fp):
+            os.unlink(tmp_fp)
+        raise
+
+    return os.path.getsize(out_fp)
+
+
+def read_tile_extract_index(tar_fp: str) -> List[Tuple[int, int, int]]:
+    """
+    Reads the index of a tile_extract tar.
+
+    :param tar_fp: the tar made by make_tile_extract.
+
+    :returns: the offset, graph ID and size of each tile
+    """
+    with tarfile.open(tar_fp, "r:") as archive:
+        index = archive.extractfile(TILE_EXTRACT_INDEX_NAME).read()
+
+    return list(TILE_EXTRACT_INDEX_ENTRY.iter_unpack(index))
+
+
+def compress_zstd(in_fp: str, out_fp: str, level: int) -> int:
+    """
+    Writes a zstd compressed copy of a file, e.g. to transport a tile_extract tar. The copy is
+    written next to out_fp and atomically moved there.
+
+    :param in_fp: the file to compress.
+    :param out_fp: full path to the compressed copy.
+    :param level: the zstd compression level.
+
+    :returns: the size of the compressed copy in bytes
+    :raises RuntimeError: if the optional zstandard package isn't installed
+    """
+    if zstandard is None:
+        raise RuntimeError("zstd compression needs the zstandard package.")
+
+    tmp_fp = make_tmp_path(out_fp)
+    try:
+        with open(in_fp, "rb") as src, open(tmp_fp, "wb") as dst:
+            # the content size lets clients allocate the tar upfront
+            zstandard.ZstdCompressor(level=level, threads=-1).copy_stream(
+                src, dst, size=os.fstat(src.fileno()).st_size
+            )
+        os.replace(tmp_fp, out_fp)
+    except BaseException:
+        if os.path.exists(tmp_fp):
+            os.unlink(tmp_fp)
+        raise
+
+    return os.path.getsize(out_fp)
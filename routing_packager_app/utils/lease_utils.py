@@ -0,0 +1,55 @@
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+# flock(1) in run_valhalla.sh locks the same file, never delete it while it's in use
+LEASE_NAME = ".lock"
+
+
+@contextmanager
+def _lease(valhalla_dir: Path, operation: int, timeout: float) -> Iterator[None]:
+    fd = os.open(valhalla_dir.joinpath(LEASE_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Couldn't lock {valhalla_dir} within {timeout} seconds.")
+                time.sleep(0.5)
+        yield
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+def read_lease(valhalla_dir: Path, timeout: float = 60) -> Iterator[None]:
+    """
+    Context manager which keeps a Valhalla build directory from being recycled. Any number of
+    jobs can hold a read lease on the same directory at the same time.
+
+    :param valhalla_dir: The Valhalla tile directory.
+    :param timeout: Seconds to wait while the directory is being rebuilt.
+
+    :raises TimeoutError: if the directory is still being rebuilt after timeout
+    """
+    return _lease(valhalla_dir, fcntl.LOCK_SH, timeout)
+
+
+def write_lease(valhalla_dir: Path, timeout: float = 60 * 60) -> Iterator[None]:
+    """
+    Context manager which waits for all read leases to be returned and keeps new ones from being
+    handed out, while the Valhalla build directory is recycled. run_valhalla.sh takes the same
+    lease with flock(1).
+
+    :param valhalla_dir: The Valhalla tile directory.
+    :param timeout: Seconds to wait for the readers.
+
+    :raises TimeoutError: if there are still readers after timeout
+    """
+    return _lease(valhalla_dir, fcntl.LOCK_EX, timeout)
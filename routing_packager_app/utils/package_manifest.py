@@ -0,0 +1,267 @@
+import json
+import os
+import tempfile
+import zipfile
+from contextlib import nullcontext
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple
+
+from .file_utils import LOCAL_FILE_HEADER, make_delta_zip
+from .tile_manifest import TileManifest
+
+PACKAGE_MANIFESTS_DIR = "manifests"
+# how many builds of a package can be diffed against the latest one
+KEEP_PACKAGE_MANIFESTS = 10
+# the arcname prefix of all tiles in a package
+TILES_PREFIX = "valhalla_tiles/"
+# a package's added and changed tiles since its previous build, next to its ZIP
+DELTA_SUFFIX = ".delta.zip"
+# the member of a delta which lists its builds and the removed tiles
+DELTA_INFO_NAME = "delta.json"
+
+
+def get_package_manifests_dir(zip_path: Path) -> Path:
+    """Returns the directory which holds a package's tile manifest per build."""
+    return zip_path.parent.joinpath(PACKAGE_MANIFESTS_DIR)
+
+
+def get_package_delta_path(zip_path: Path) -> Path:
+    """Returns the path of a package's delta to its previous build, next to its ZIP."""
+    return zip_path.with_suffix(DELTA_SUFFIX)
+
+
+def _get_data_offset(zinfo: zipfile.ZipInfo) -> int:
+    """
+    Returns where a member's compressed data starts, i.e. after its local file header. Only for
+    members as make_zip wrote them, whose extra field is the local one.
+    """
+    extra = len(zinfo.extra)
+    if zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT:
+        # the zip64 sizes zipfile adds to the local file header
+        extra += 20
+    return zinfo.header_offset + LOCAL_FILE_HEADER.size + len(zinfo.filename.encode()) + extra
+
+
+def _read_data_offset(f: BinaryIO, zinfo: zipfile.ZipInfo) -> int:
+    """
+    Reads where a member's compressed data starts from its local file header. The central
+    directory's extra field can differ from the local one, e.g. by a zip64 offset.
+    """
+    f.seek(zinfo.header_offset)
+    header = LOCAL_FILE_HEADER.unpack(f.read(LOCAL_FILE_HEADER.size))
+
+    return zinfo.header_offset + LOCAL_FILE_HEADER.size + header[-2] + header[-1]
+
+
+def make_package_manifest(
+    members: Sequence[zipfile.ZipInfo], manifest: TileManifest, zip_path: Optional[Path] = None
+) -> Dict:
+    """
+    Describes the tiles of a package from its ZIP members and the build's tile manifest, so it
+    doesn't need to read the tiles.
+
+    :param members: the ZIP's members, e.g. as returned by make_zip.
+    :param manifest: the tile manifest of the Valhalla build the tiles are from.
+    :param zip_path: the ZIP if the members were read from its central directory, their data
+        offsets are then read from the local file headers.
+
+    :returns: the build ID and, per tile, its path, size, CRC32, 64 bit content hash and where
+        its raw deflate stream lies in the ZIP
+    """
+    tiles = list()
+    with open(zip_path, "rb") if zip_path else nullcontext() as f:
+        for zinfo in members:
+            if not zinfo.filename.startswith(TILES_PREFIX):
+                continue
+            path = zinfo.filename.removeprefix(TILES_PREFIX)
+            entry = manifest.find_path(path)
+            tiles.append({
+                "path": path,
+                "size": zinfo.file_size,
+                "crc32": zinfo.CRC,
+                # hex, JSON numbers lose precision beyond 53 bits in most clients
+                "hash": f"{entry.hash:016x}" if entry else None,
+                "offset": _read_data_offset(f, zinfo) if f else _get_data_offset(zinfo),
+                "compressed_size": zinfo.compress_size,
+            })
+
+    return {"build_id": manifest.build_id, "tiles": tiles}
+
+
+def write_package_manifest(zip_path: Path, manifest: Dict) -> Path:
+    """
+    Atomically writes a package's tile manifest and removes the ones of old builds.
+
+    :param zip_path: the package's ZIP path.
+    :param manifest: the manifest made by make_package_manifest.
+
+    :returns: the manifest's path
+    """
+    manifests_dir = get_package_manifests_dir(zip_path)
+    manifests_dir.mkdir(exist_ok=True)
+    out_path = manifests_dir.joinpath(f"{manifest['build_id']}.json")
+
+    fd, tmp_path = tempfile.mkstemp(dir=manifests_dir, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    old_paths = sorted(
+        (p for p in manifests_dir.glob("*.json") if p != out_path),
+        key=lambda p: p.stat().st_mtime_ns,
+        reverse=True,
+    )
+    for old_path in old_paths[KEEP_PACKAGE_MANIFESTS - 1 :]:
+        old_path.unlink(missing_ok=True)
+
+    return out_path
+
+
+def read_package_manifest(zip_path: Path, build_id: str) -> Optional[Dict]:
+    """
+    Reads a package's tile manifest of a build.
+
+    :param zip_path: the package's ZIP path.
+    :param build_id: the Valhalla build.
+
+    :returns: the manifest or None if the package wasn't built from that build or it's too old
+    """
+    # build IDs are hex digests, anything else could point outside the directory
+    if not build_id.isalnum():
+        return None
+    try:
+        return json.loads(get_package_manifests_dir(zip_path).joinpath(f"{build_id}.json").read_text())
+    except FileNotFoundError:
+        return None
+
+
+@lru_cache(maxsize=16)
+def _get_tile_index(manifest_path: Path, mtime_ns: int) -> Dict[str, Dict]:
+    """The tiles of a manifest by path, cached until the manifest changes."""
+    return {tile["path"]: tile for tile in json.loads(manifest_path.read_text())["tiles"]}
+
+
+def find_package_tile(zip_path: Path, build_id: str, tile_path: str) -> Optional[Dict]:
+    """
+    Looks up a tile in a package's manifest of a build.
+
+    :param zip_path: the package's ZIP path.
+    :param build_id: the Valhalla build.
+    :param tile_path: the tile's path relative to the Valhalla directory, e.g. 2/000/762/485.gph.
+
+    :returns: the tile's manifest entry or None if there's no such tile or build
+    """
+    if not build_id.isalnum():
+        return None
+    manifest_path = get_package_manifests_dir(zip_path).joinpath(f"{build_id}.json")
+    try:
+        index = _get_tile_index(manifest_path, manifest_path.stat().st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+    return index.get(tile_path)
+
+
+def read_package_tile(zip_path: Path, tile: Dict) -> bytes:
+    """
+    Reads a tile's raw deflate stream from a package without inflating it.
+
+    :param zip_path: the package's ZIP path.
+    :param tile: the tile's manifest entry.
+
+    :returns: the raw deflate stream
+    :raises ValueError: if the ZIP doesn't have this version of the tile (anymore)
+    """
+    arcname = (TILES_PREFIX + tile["path"]).encode()
+    header_offset = tile["offset"] - LOCAL_FILE_HEADER.size - len(arcname)
+    if header_offset < 0:
+        raise ValueError(f"{zip_path} has no {arcname.decode()} at {tile['offset']}.")
+    with open(zip_path, "rb") as f:
+        f.seek(header_offset)
+        header = f.read(LOCAL_FILE_HEADER.size)
+        name = f.read(len(arcname))
+        data = f.read(tile["compressed_size"])
+
+    # the package might have been updated since the manifest was read
+    if len(header) < LOCAL_FILE_HEADER.size or name != arcname:
+        raise ValueError(f"{zip_path} has no {arcname.decode()} at {tile['offset']}.")
+    signature, *_, crc, compress_size, file_size, _, extra_length = LOCAL_FILE_HEADER.unpack(header)
+    if (
+        signature != zipfile.stringFileHeader
+        or (crc, compress_size, file_size) != (tile["crc32"], tile["compressed_size"], tile["size"])
+        or extra_length
+        or len(data) != compress_size
+    ):
+        raise ValueError(f"{zip_path} has another version of {arcname.decode()}.")
+
+    return data
+
+
+def _get_tile_version(tile: Dict) -> Tuple[int, int, Optional[str]]:
+    """A CRC32 can collide, so a tile is only the same if its content hash is, too."""
+    return tile["crc32"], tile["size"], tile.get("hash")
+
+
+def diff_package_manifests(old: Dict, new: Dict) -> Dict:
+    """
+    Compares two tile manifests of a package, so clients only need to fetch what changed.
+
+    :param old: the manifest of the build the client has.
+    :param new: the manifest of the build the client wants.
+
+    :returns: both build IDs, the new manifest's entries of added and changed tiles and the
+        paths of removed tiles
+    """
+    old_tiles = {tile["path"]: tile for tile in old["tiles"]}
+    new_paths = set()
+    added: List[Dict] = []
+    changed: List[Dict] = []
+    for tile in new["tiles"]:
+        new_paths.add(tile["path"])
+        old_tile = old_tiles.get(tile["path"])
+        if old_tile is None:
+            added.append(tile)
+        elif _get_tile_version(old_tile) != _get_tile_version(tile):
+            changed.append(tile)
+
+    return {
+        "from_build_id": old["build_id"],
+        "to_build_id": new["build_id"],
+        "added": added,
+        "changed": changed,
+        "removed": sorted(path for path in old_tiles if path not in new_paths),
+    }
+
+
+def write_package_delta(zip_path: Path, old: Dict, new: Dict) -> int:
+    """
+    Writes a package's delta between two builds, so clients of the old build only need to
+    download what changed. The tiles are copied from the package's ZIP without recompressing
+    them.
+
+    :param zip_path: the package's ZIP path, which holds the new build's tiles.
+    :param old: the manifest of the previous build.
+    :param new: the manifest of the build in the ZIP.
+
+    :returns: the delta's size in bytes
+    """
+    diff = diff_package_manifests(old, new)
+    info = {
+        "from_build_id": diff["from_build_id"],
+        "to_build_id": diff["to_build_id"],
+        "removed": diff["removed"],
+    }
+
+    return make_delta_zip(
+        str(zip_path),
+        str(get_package_delta_path(zip_path)),
+        [TILES_PREFIX + tile["path"] for tile in diff["added"] + diff["changed"]],
+        {DELTA_INFO_NAME: json.dumps(info, indent=2)},
+    )
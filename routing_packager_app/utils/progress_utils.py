@@ -0,0 +1,88 @@
+import json
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, Optional
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import RedisError
+
+from ..config import SETTINGS
+from ..logger import LOGGER
+
+PROGRESS_KEY_PREFIX = "routing_packager:job_progress:"
+# seconds between two progress updates of the same job
+PROGRESS_INTERVAL = 2
+# seconds until a stale progress expires, e.g. when the worker died
+PROGRESS_TTL = 24 * 60 * 60
+
+# reported by make_zip after each member
+ZipProgress = namedtuple("ZipProgress", "tiles_done tiles_total bytes_read bytes_written")
+
+
+def get_progress_key(job_id: int) -> str:
+    return f"{PROGRESS_KEY_PREFIX}{job_id}"
+
+
+@lru_cache(maxsize=1)
+def _get_redis() -> Redis:
+    """One synchronous connection pool per process, make_zip runs outside the event loop."""
+    return Redis.from_url(SETTINGS.REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+
+
+class ProgressReporter:
+    """
+    Progress callback for make_zip, which stores a job's progress in Redis at most every
+    PROGRESS_INTERVAL seconds. Stops reporting if Redis isn't reachable.
+    """
+
+    def __init__(self, job_id: int, interval: float = PROGRESS_INTERVAL):
+        self.key = get_progress_key(job_id)
+        self.interval = interval
+        self._start_time = self._last_time = time.monotonic()
+        self._last_read = 0
+        self._enabled = True
+
+    def __call__(self, progress: ZipProgress):
+        now = time.monotonic()
+        finished = progress.tiles_done == progress.tiles_total
+        if not self._enabled or (not finished and now - self._last_time < self.interval):
+            return
+
+        elapsed = now - self._last_time
+        current = {
+            **progress._asdict(),
+            # input bytes per second since the last report
+            "throughput": (progress.bytes_read - self._last_read) / elapsed if elapsed else 0,
+            "elapsed": now - self._start_time,
+            "updated": datetime.now(timezone.utc).isoformat(),
+        }
+        self._last_time, self._last_read = now, progress.bytes_read
+        try:
+            _get_redis().set(self.key, json.dumps(current), ex=PROGRESS_TTL)
+        except RedisError as e:
+            LOGGER.warning(f"Disabled progress reports for {self.key}: {e}")
+            self._enabled = False
+
+
+async def read_job_progress(redis: Optional[AsyncRedis], job_ids: Iterable[int]) -> Dict[int, Dict]:
+    """
+    Reads the last reported progress of jobs.
+
+    :param redis: The Redis connection, nothing is read if it's None, e.g. in tests.
+    :param job_ids: The jobs' database IDs.
+
+    :returns: the progress by job ID, for the jobs which reported any
+    """
+    job_ids = list(job_ids)
+    if redis is None or not job_ids:
+        return dict()
+    try:
+        values = await redis.mget([get_progress_key(job_id) for job_id in job_ids])
+    except RedisError as e:
+        LOGGER.warning(f"Couldn't read the job progress: {e}")
+        return dict()
+
+    return {job_id: json.loads(value) for job_id, value in zip(job_ids, values) if value}
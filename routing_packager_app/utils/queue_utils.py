@@ -0,0 +1,30 @@
+from typing import Optional
+
+from arq.constants import default_queue_name
+
+from ..config import SETTINGS
+from ..constants import Queues
+
+
+def get_queue_name(queue: Queues) -> str:
+    """Returns the arq queue name of a job queue."""
+    return f"{default_queue_name}:{queue.value}"
+
+
+def choose_queue(raw_size: Optional[int], scheduled: bool = False) -> str:
+    """
+    Chooses the queue of a new job, so small interactive jobs don't wait behind package updates
+    or huge packages.
+
+    :param raw_size: the estimated tile bytes of the package, None if there's no estimate.
+    :param scheduled: whether it's a package update enqueued by cli.py.
+
+    :returns: the arq queue name
+    """
+    if scheduled:
+        return get_queue_name(Queues.BULK)
+    if SETTINGS.INTERACTIVE_MAX_BYTES > 0 and raw_size is not None:
+        if raw_size > SETTINGS.INTERACTIVE_MAX_BYTES:
+            return get_queue_name(Queues.BULK)
+
+    return get_queue_name(Queues.INTERACTIVE)
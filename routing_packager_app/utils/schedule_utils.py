@@ -0,0 +1,34 @@
+import heapq
+from typing import Callable, List, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+def sort_longest_first(items: Sequence[T], cost: Callable[[T], float]) -> List[Tuple[float, T]]:
+    """
+    Orders items by decreasing cost, i.e. the longest-processing-time-first rule. Starting the
+    biggest jobs first keeps the last job to finish short, which shortens the whole run.
+
+    :param items: the items to order.
+    :param cost: the estimated work of an item, e.g. its tiles' size in bytes.
+
+    :returns: (cost, item) pairs, largest cost first
+    """
+    return sorted(((cost(item), item) for item in items), key=lambda x: x[0], reverse=True)
+
+
+def estimate_makespan(costs: Sequence[float], workers: int) -> float:
+    """
+    Estimates the total work of the busiest worker, if each job is started by the next free worker
+    in the given order.
+
+    :param costs: the estimated work of each job in the order they're started.
+    :param workers: the number of jobs processed at the same time.
+
+    :returns: the busiest worker's total work, in the unit of costs
+    """
+    loads = [0.0] * max(min(workers, len(costs)), 1)
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+
+    return max(loads)
@@ -0,0 +1,148 @@
+import errno
+import os
+import shutil
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Set
+from uuid import uuid4
+
+from ..config import SETTINGS
+from .lease_utils import read_lease, write_lease
+from .tile_manifest import MANIFEST_NAME, TileManifest, get_manifest
+
+SNAPSHOTS_DIR_NAME = "snapshots"
+# seconds to wait for another process creating or collecting snapshots
+SNAPSHOTS_LOCK_TIMEOUT = 10 * 60
+
+
+def get_snapshots_dir() -> Path:
+    """Returns the directory holding a snapshot per Valhalla build."""
+    return SETTINGS.get_tmp_data_dir().joinpath(SNAPSHOTS_DIR_NAME)
+
+
+def _link(src: Path, dst: Path):
+    """Hardlinks src to dst, falls back to copying across file systems."""
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(src, dst)
+
+
+def _make_snapshot(valhalla_dir: Path, snapshots_dir: Path) -> Optional[Path]:
+    """Creates the snapshot of a build unless it exists, the caller holds the snapshots lock."""
+    manifest = get_manifest(valhalla_dir)
+    if manifest is None:
+        return None
+    snapshot_dir = snapshots_dir.joinpath(manifest.build_id)
+    if snapshot_dir.joinpath(MANIFEST_NAME).is_file():
+        return snapshot_dir
+
+    # only complete snapshots are moved into place
+    tmp_dir = snapshots_dir.joinpath(f".{manifest.build_id}.{uuid4().hex}")
+    try:
+        created_dirs = set()
+        for entry in manifest:
+            dst = tmp_dir.joinpath(entry.path)
+            if dst.parent not in created_dirs:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(dst.parent)
+            _link(valhalla_dir.joinpath(entry.path), dst)
+        _link(manifest.path, tmp_dir.joinpath(MANIFEST_NAME))
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        os.rename(tmp_dir, snapshot_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return snapshot_dir
+
+
+def make_snapshot(valhalla_dir: Path, snapshots_dir: Optional[Path] = None) -> Optional[Path]:
+    """
+    Creates an immutable snapshot of a Valhalla build by hardlinking its tiles and manifest.
+    New builds replace the tile files instead of writing into them, so the snapshot stays
+    intact while its build directory is recycled.
+
+    :param valhalla_dir: The Valhalla tile directory, which must not be rebuilt meanwhile.
+    :param snapshots_dir: Where the snapshots live, defaults to get_snapshots_dir().
+
+    :returns: the snapshot directory or None if there are no tiles
+    """
+    snapshots_dir = snapshots_dir or get_snapshots_dir()
+    snapshots_dir.mkdir(parents=True, exist_ok=True)
+    with write_lease(snapshots_dir, SNAPSHOTS_LOCK_TIMEOUT):
+        return _make_snapshot(valhalla_dir, snapshots_dir)
+
+
+@contextmanager
+def pin_snapshot(valhalla_dir: Path, snapshots_dir: Optional[Path] = None) -> Iterator[Optional[Path]]:
+    """
+    Context manager which pins the snapshot of a Valhalla build, so it's not collected while
+    it's being read. Creates the snapshot if needed.
+
+    :param valhalla_dir: The Valhalla tile directory.
+    :param snapshots_dir: Where the snapshots live, defaults to get_snapshots_dir().
+
+    :returns: the snapshot directory or None if there are no tiles
+    :raises TimeoutError: if the Valhalla directory is being rebuilt
+    """
+    snapshots_dir = snapshots_dir or get_snapshots_dir()
+    snapshots_dir.mkdir(parents=True, exist_ok=True)
+    with ExitStack() as stack:
+        # collect_snapshots can't run while we're checking and leasing the snapshot
+        with read_lease(valhalla_dir), write_lease(snapshots_dir, SNAPSHOTS_LOCK_TIMEOUT):
+            snapshot_dir = _make_snapshot(valhalla_dir, snapshots_dir)
+            if snapshot_dir is not None:
+                stack.enter_context(read_lease(snapshot_dir, timeout=0))
+        yield snapshot_dir
+
+
+def _get_current_build_ids() -> Set[str]:
+    """The build IDs of both Valhalla directories, one is serving and the other one is next."""
+    build_ids = set()
+    for port in (8002, 8003):
+        manifest_path = SETTINGS.get_valhalla_path(port).joinpath(MANIFEST_NAME)
+        try:
+            manifest = TileManifest(manifest_path)
+        except (FileNotFoundError, ValueError):
+            continue
+        build_ids.add(manifest.build_id)
+        manifest.close()
+
+    return build_ids
+
+
+def collect_snapshots(snapshots_dir: Optional[Path] = None, keep: Optional[Set[str]] = None) -> int:
+    """
+    Removes the snapshots of old builds once no job has them pinned anymore.
+
+    :param snapshots_dir: Where the snapshots live, defaults to get_snapshots_dir().
+    :param keep: The build IDs to keep, defaults to the builds in the Valhalla directories.
+
+    :returns: the number of removed snapshots
+    """
+    snapshots_dir = snapshots_dir or get_snapshots_dir()
+    if not snapshots_dir.is_dir():
+        return 0
+    keep = _get_current_build_ids() if keep is None else keep
+
+    removed = 0
+    with write_lease(snapshots_dir, SNAPSHOTS_LOCK_TIMEOUT):
+        for snapshot_dir in snapshots_dir.iterdir():
+            if not snapshot_dir.is_dir() or snapshot_dir.name in keep:
+                continue
+            # leftovers of interrupted snapshots
+            if snapshot_dir.name.startswith("."):
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+                continue
+            try:
+                with write_lease(snapshot_dir, timeout=0):
+                    shutil.rmtree(snapshot_dir)
+                    removed += 1
+            except TimeoutError:
+                # still pinned by a job
+                continue
+
+    return removed
@@ -0,0 +1,150 @@
+import os
+import shutil
+import struct
+import tempfile
+from pathlib import Path
+from typing import Optional, Tuple
+
+from ..config import SETTINGS
+from .lease_utils import write_lease
+from .tile_manifest import TileManifest
+
+CACHE_DIR_NAME = "tile_cache"
+# seconds to wait for another job removing the caches of old builds
+CACHE_LOCK_TIMEOUT = 60
+# CRC32 and uncompressed size in front of the raw deflate stream
+ENTRY_HEADER = struct.Struct("<IQ")
+
+
+class TileCache:
+    """
+    Content-addressed cache of deflated tiles for a single Valhalla build directory.
+
+    Entries are keyed by the tiles' content hash from the build's manifest, so overlapping
+    packages only compress a tile once. Least recently used entries are evicted once the cache
+    grows beyond max_bytes. Each build has its own directory, the ones of other builds are
+    removed under a lock, so jobs of the same build never remove each other's entries.
+    """
+
+    def __init__(self, valhalla_dir: Path, manifest: TileManifest, max_bytes: int):
+        self.valhalla_dir = valhalla_dir
+        self.cache_dir = valhalla_dir.joinpath(CACHE_DIR_NAME, manifest.build_id)
+        self.manifest = manifest
+        self.max_bytes = max_bytes
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with write_lease(self.cache_dir.parent, CACHE_LOCK_TIMEOUT):
+            for build_dir in self.cache_dir.parent.iterdir():
+                if build_dir.is_dir() and build_dir != self.cache_dir:
+                    shutil.rmtree(build_dir, ignore_errors=True)
+
+    def _entry_path(self, tile_path: Path) -> Optional[Path]:
+        """The path of a tile's cache entry or None if the tile isn't in the manifest."""
+        entry = self.manifest.find_path(str(tile_path.relative_to(self.valhalla_dir)))
+        if entry is None:
+            return None
+        key = f"{entry.hash:016x}"
+
+        return self.cache_dir.joinpath(key[:2], key)
+
+    def contains(self, tile_path: Path) -> bool:
+        entry_path = self._entry_path(tile_path)
+        return entry_path is not None and entry_path.is_file()
+
+    def get(self, tile_path: Path) -> Optional[Tuple[int, int, bytes]]:
+        """
+        Returns the deflated tile if it's cached.
+
+        :param tile_path: the tile's path in the Valhalla directory.
+
+        :returns: the CRC32, the uncompressed size and the raw deflate stream
+        """
+        entry_path = self._entry_path(tile_path)
+        if entry_path is None:
+            return None
+        try:
+            data = entry_path.read_bytes()
+            # mark as recently used
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        crc, file_size = ENTRY_HEADER.unpack_from(data)
+
+        return crc, file_size, data[ENTRY_HEADER.size :]
+
+    def put(self, tile_path: Path, crc: int, file_size: int, data: bytes):
+        """
+        Caches a deflated tile.
+
+        :param tile_path: the tile's path in the Valhalla directory.
+        :param crc: the tile's CRC32.
+        :param file_size: the uncompressed size.
+        :param data: the raw deflate stream.
+        """
+        entry_path = self._entry_path(tile_path)
+        if entry_path is None:
+            return
+        try:
+            entry_path.parent.mkdir(exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=entry_path.parent, prefix=".")
+        except FileNotFoundError:
+            # a job of a newer build removed this build's cache meanwhile
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(ENTRY_HEADER.pack(crc, file_size))
+                f.write(data)
+            os.replace(tmp_path, entry_path)
+        except FileNotFoundError:
+            # the same, while the entry was written
+            return
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used entries until the cache fits into max_bytes.
+
+        :returns: the number of removed entries
+        """
+        entries = list()
+        total_size = 0
+        # skips the temporary files of entries which are being written
+        for entry_path in self.cache_dir.glob("??/[!.]*"):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry_path))
+            total_size += stat.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, entry_path in entries:
+            if total_size <= self.max_bytes:
+                break
+            entry_path.unlink(missing_ok=True)
+            total_size -= size
+            removed += 1
+
+        return removed
+
+    def clear(self):
+        """Removes all entries of this build."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def get_tile_cache(valhalla_dir: Path, manifest: TileManifest) -> Optional[TileCache]:
+    """
+    Returns the compressed tile cache of a Valhalla build directory.
+
+    :param valhalla_dir: The Valhalla tile directory.
+    :param manifest: The directory's tile manifest.
+
+    :returns: the cache or None if it's disabled with TILE_CACHE_MAX_BYTES=0
+    """
+    if SETTINGS.TILE_CACHE_MAX_BYTES <= 0:
+        return None
+
+    return TileCache(valhalla_dir, manifest, SETTINGS.TILE_CACHE_MAX_BYTES)
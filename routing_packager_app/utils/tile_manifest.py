@@ -0,0 +1,249 @@
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+from typing import Iterable, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+from .valhalla_utils import TILE_SIZES, get_tile_ids_in_bbox, get_tile_level_id, get_tile_path
+
+MANIFEST_NAME = "tiles.manifest"
+MANIFEST_MAGIC = b"VHTILMAN"
+MANIFEST_VERSION = 1
+# magic, version, build ID, tile count
+HEADER = struct.Struct("<8sH6x16sQ")
+HEADER_SIZE = 64
+# (array typecode, name) of each column in the order they're stored, all little endian
+COLUMNS = (
+    ("B", "level"),
+    ("I", "tile_id"),
+    ("Q", "size"),
+    ("q", "mtime_ns"),
+    ("I", "crc32"),
+    ("Q", "hash"),
+)
+# level, tile ID and content hash of each tile in a fingerprint
+FINGERPRINT_ENTRY = struct.Struct("<BIQ")
+
+
+class TileEntry(namedtuple("TileEntry", [c[1] for c in COLUMNS])):
+    __slots__ = ()
+
+    @property
+    def path(self) -> str:
+        """The tile's path relative to the Valhalla directory."""
+        return get_tile_path(self.level, self.tile_id)
+
+
+# how many mapped manifests a process keeps, e.g. of both Valhalla directories and a few snapshots
+MAX_CACHED_MANIFESTS = 8
+
+_MANIFESTS: "OrderedDict[Path, Tuple[Tuple[int, int, int], TileManifest]]" = OrderedDict()
+_MANIFESTS_LOCK = Lock()
+
+
+def _padding(offset: int) -> int:
+    """The bytes needed to align offset to 8 bytes."""
+    return -offset % 8
+
+
+def hash_tile(tile_path: Path) -> Tuple[int, int]:
+    """
+    Hashes a tile's content.
+
+    :param tile_path: The tile's path.
+
+    :returns: the tile's CRC32 as stored in ZIPs and a 64 bit content hash
+    """
+    crc = 0
+    hasher = blake2b(digest_size=8)
+    with open(tile_path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            crc = zlib.crc32(chunk, crc)
+            hasher.update(chunk)
+
+    return crc, int.from_bytes(hasher.digest(), "little")
+
+
+def get_fingerprint(entries: Iterable[TileEntry]) -> str:
+    """
+    Fingerprints a set of tiles, changes whenever a tile is added, removed or changed.
+
+    :param entries: the tiles' manifest entries.
+
+    :returns: the hex digest over all tiles and their content hashes
+    """
+    hasher = blake2b(digest_size=16)
+    for entry in sorted(entries):
+        hasher.update(FINGERPRINT_ENTRY.pack(entry.level, entry.tile_id, entry.hash))
+
+    return hasher.hexdigest()
+
+
+def write_manifest(valhalla_dir: Path) -> Optional[Path]:
+    """
+    Scans a Valhalla tile directory once and writes its tile manifest atomically.
+
+    :param valhalla_dir: The Valhalla tile directory.
+
+    :returns: the manifest's path or None if there are no tiles
+    """
+    tiles = list()
+    for level in TILE_SIZES:
+        level_dir = valhalla_dir.joinpath(str(level))
+        for tile_path in level_dir.rglob("*.gph"):
+            _, tile_id = get_tile_level_id(str(tile_path.relative_to(valhalla_dir)))
+            tiles.append((level, int(tile_id.replace("/", "")), tile_path))
+    if not tiles:
+        return None
+    tiles.sort(key=lambda t: t[:2])
+
+    columns = [array(typecode) for typecode, _ in COLUMNS]
+    for level, tile_id, tile_path in tiles:
+        stat = tile_path.stat()
+        crc, hash_ = hash_tile(tile_path)
+        for column, value in zip(columns, (level, tile_id, stat.st_size, stat.st_mtime_ns, crc, hash_)):
+            column.append(value)
+
+    out_path = valhalla_dir.joinpath(MANIFEST_NAME)
+    fd, tmp_path = tempfile.mkstemp(dir=valhalla_dir, prefix=f".{MANIFEST_NAME}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            header = HEADER.pack(MANIFEST_MAGIC, MANIFEST_VERSION, uuid4().bytes, len(tiles))
+            f.write(header.ljust(HEADER_SIZE, b"\0"))
+            for column in columns:
+                data = column.tobytes()
+                f.write(data + b"\0" * _padding(len(data)))
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return out_path
+
+
+class TileManifest:
+    """
+    Memory-mapped, read-only view of a Valhalla tile directory's manifest.
+
+    The manifest stores one column per tile attribute, sorted by level and tile ID,
+    so bbox queries only need a binary search per candidate tile.
+    """
+
+    def __init__(self, manifest_path: Path):
+        with open(manifest_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, build_id, count = HEADER.unpack_from(self._mmap)
+        if magic != MANIFEST_MAGIC or version != MANIFEST_VERSION:
+            self._mmap.close()
+            raise ValueError(f"{manifest_path} is not a valid tile manifest.")
+
+        self.path = manifest_path
+        self.build_id: str = build_id.hex()
+        self._count: int = count
+
+        self._buf = memoryview(self._mmap)
+        offset = HEADER_SIZE
+        self._columns: List[memoryview] = list()
+        for typecode, _ in COLUMNS:
+            size = array(typecode).itemsize * count
+            self._columns.append(self._buf[offset : offset + size].cast(typecode))
+            offset += size + _padding(size)
+
+        # the first and last index of each level
+        levels = self._columns[0]
+        self._level_ranges = {
+            level: (bisect_left(levels, level), bisect_left(levels, level + 1)) for level in TILE_SIZES
+        }
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, idx: int) -> TileEntry:
+        return TileEntry(*(column[idx] for column in self._columns))
+
+    def __iter__(self) -> Iterator[TileEntry]:
+        return (self[idx] for idx in range(self._count))
+
+    def find(self, level: int, tile_id: int) -> Optional[TileEntry]:
+        """Returns the entry of a single tile or None if it's not in the manifest."""
+        lo, hi = self._level_ranges[level]
+        idx = bisect_left(self._columns[1], tile_id, lo, hi)
+        if idx < hi and self._columns[1][idx] == tile_id:
+            return self[idx]
+
+        return None
+
+    def find_path(self, tile_path: str) -> Optional[TileEntry]:
+        """Returns the entry of a tile path relative to the Valhalla directory, e.g. 0/003/015.gph"""
+        level, tile_id = get_tile_level_id(tile_path)
+        return self.find(int(level), int(tile_id.replace("/", "")))
+
+    def get_tiles(self, bbox: Tuple[float, float, float, float]) -> List[TileEntry]:
+        """
+        Returns the tiles intersecting the bbox without touching the tile directory.
+
+        :param bbox: the bbox as a list of floats in [minx, miny, maxx, maxy].
+        """
+        entries = list()
+        for level, tile_id in get_tile_ids_in_bbox(bbox):
+            entry = self.find(level, tile_id)
+            if entry is not None:
+                entries.append(entry)
+
+        return entries
+
+    def close(self):
+        """Releases the memory map."""
+        for column in self._columns:
+            column.release()
+        self._columns = list()
+        self._buf.release()
+        self._mmap.close()
+
+
+def get_manifest(valhalla_dir: Path) -> Optional[TileManifest]:
+    """
+    Returns the tile manifest of a Valhalla directory. The mapped manifest is cached per process
+    and only re-opened if the file changed. Replaced and least recently used manifests are dropped
+    from the cache.
+    Hashing a whole graph is too slow for a request or a job, so a missing manifest is left to
+    cli.py manifest.
+
+    :param valhalla_dir: The Valhalla tile directory.
+
+    :returns: the manifest or None if the directory has no tiles or no manifest yet
+    """
+    manifest_path = valhalla_dir.joinpath(MANIFEST_NAME)
+    try:
+        stat = manifest_path.stat()
+    except FileNotFoundError:
+        return None
+
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with _MANIFESTS_LOCK:
+        cached = _MANIFESTS.get(manifest_path)
+        if cached is not None and cached[0] == key:
+            _MANIFESTS.move_to_end(manifest_path)
+            return cached[1]
+
+        try:
+            manifest = TileManifest(manifest_path)
+        except FileNotFoundError:
+            return None
+        # other threads may still use a replaced or evicted manifest, it's unmapped once the
+        #   last of them drops it
+        _MANIFESTS[manifest_path] = (key, manifest)
+        _MANIFESTS.move_to_end(manifest_path)
+        while len(_MANIFESTS) > MAX_CACHED_MANIFESTS:
+            _MANIFESTS.popitem(last=False)
+
+    return manifest
@@ -1,17 +1,40 @@
+import json
+import os
+import tempfile
 from collections import namedtuple
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import List, Set, Tuple
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
-from math import floor
+from math import ceil, floor
+import requests
+from requests.exceptions import RequestException
+from starlette.status import HTTP_200_OK, HTTP_301_MOVED_PERMANENTLY
+
+from ..config import SETTINGS
+from ..constants import Providers
 
 Bbox = namedtuple("Bbox", "min_x min_y max_x max_y")
 TILE_SIZES = {0: 4, 1: 1, 2: 0.25}
+# written by "cli.py activate" next to the Valhalla directories
+ACTIVE_BUILD_NAME = "active.json"
+# connect and read timeouts in seconds when probing the Valhalla instances
+PROBE_TIMEOUT = (1, 2)
+
+# reused connections for the probes
+_HTTP = requests.Session()
+_ACTIVE_BUILDS: Dict[Path, Tuple[Tuple[int, int, int], Dict]] = dict()
 
 
 def get_tile_bbox(tile_path: Path) -> Bbox:
     """Returns a tile's bounding box in minx,miny,maxx,maxy format"""
     level, tile_idx = [int(x.replace("/", "")) for x in get_tile_level_id(str(tile_path))]
 
+    return get_tile_id_bbox(level, tile_idx)
+
+
+def get_tile_id_bbox(level: int, tile_idx: int) -> Bbox:
+    """Returns the bounding box of a tile ID on a level in minx,miny,maxx,maxy format"""
     tile_size = TILE_SIZES[level]
     row = floor(tile_idx / (360 / tile_size))
     col = tile_idx % (360 / tile_size)
@@ -22,6 +45,16 @@ def get_tile_bbox(tile_path: Path) -> Bbox:
     return Bbox(tile_base_x, tile_base_y, tile_base_x + tile_size, tile_base_y + tile_size)
 
 
+def _is_outside(tile_bbox: Bbox, bbox: Bbox) -> bool:
+    """Whether the tile bbox doesn't even touch the bbox"""
+    return any([
+        tile_bbox.min_x < bbox.min_x and tile_bbox.max_x < bbox.min_x,  # left of bbox
+        tile_bbox.min_y < bbox.min_y and tile_bbox.max_y < bbox.min_y,  # below bbox
+        tile_bbox.min_x > bbox.max_x and tile_bbox.max_x > bbox.max_x,  # right of bbox
+        tile_bbox.min_y > bbox.max_y and tile_bbox.max_y > bbox.max_y,  # above bbox
+    ])
+
+
 def get_tiles_with_bbox(
     all_tile_paths: List[Path], bbox: Tuple[float, float, float, float], valhalla_dir: Path
 ) -> Set[Path]:
@@ -30,12 +63,62 @@ def get_tiles_with_bbox(
     for tile_path in all_tile_paths:
         tile_bbox: Bbox = get_tile_bbox(tile_path.relative_to(valhalla_dir))
         # check if tile_bbox is outside bbox
-        if not any([
-            tile_bbox.min_x < bbox.min_x and tile_bbox.max_x < bbox.min_x,  # left of bbox
-            tile_bbox.min_y < bbox.min_y and tile_bbox.max_y < bbox.min_y,  # below bbox
-            tile_bbox.min_x > bbox.max_x and tile_bbox.max_x > bbox.max_x,  # right of bbox
-            tile_bbox.min_y > bbox.max_y and tile_bbox.max_y > bbox.max_y,  # above bbox
-        ]):
+        if not _is_outside(tile_bbox, bbox):
+            tile_paths.add(tile_path)
+
+    return tile_paths
+
+
+def get_tile_ids_in_bbox(bbox: Tuple[float, float, float, float]) -> Iterator[Tuple[int, int]]:
+    """
+    Enumerates all possible tile IDs intersecting the bbox, without looking at the disk.
+
+    :param bbox: the bbox as a list of floats in [minx, miny, maxx, maxy].
+
+    :returns: (level, tile ID) pairs, ordered by level, row and column.
+    """
+    bbox = Bbox(*bbox)
+    for level, tile_size in TILE_SIZES.items():
+        n_cols = int(360 / tile_size)
+        n_rows = int(180 / tile_size)
+        # widen by one tile on each side to not be fooled by float rounding,
+        # the exact test below weeds out the extra tiles
+        min_col = max(ceil((bbox.min_x + 180) / tile_size) - 2, 0)
+        max_col = min(floor((bbox.max_x + 180) / tile_size) + 1, n_cols - 1)
+        min_row = max(ceil((bbox.min_y + 90) / tile_size) - 2, 0)
+        max_row = min(floor((bbox.max_y + 90) / tile_size) + 1, n_rows - 1)
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                tile_idx = row * n_cols + col
+                if not _is_outside(get_tile_id_bbox(level, tile_idx), bbox):
+                    yield level, tile_idx
+
+
+def get_tile_path(level: int, tile_idx: int) -> str:
+    """Returns the relative path of a tile, e.g. 2/000/762/485.gph"""
+    tile_size = TILE_SIZES[level]
+    max_idx = int(360 / tile_size) * int(180 / tile_size) - 1
+    # Valhalla pads the tile ID to the next multiple of 3 digits of the level's max tile ID
+    n_digits = -(-len(str(max_idx)) // 3) * 3
+    padded = str(tile_idx).zfill(n_digits)
+
+    return "/".join([str(level)] + [padded[i : i + 3] for i in range(0, n_digits, 3)]) + ".gph"
+
+
+def get_tiles_in_bbox(bbox: Tuple[float, float, float, float], valhalla_dir: Path) -> Set[Path]:
+    """
+    Returns the tiles in valhalla_dir which intersect the bbox. Only the candidate tile paths
+    are checked on disk, so the cost scales with the bbox size, not with the graph's size.
+
+    :param bbox: the bbox as a list of floats in [minx, miny, maxx, maxy].
+    :param valhalla_dir: the Valhalla tile directory.
+
+    :returns: the existing tile paths
+    """
+    tile_paths = set()
+    for level, tile_idx in get_tile_ids_in_bbox(bbox):
+        tile_path = valhalla_dir.joinpath(get_tile_path(level, tile_idx))
+        if tile_path.is_file():
             tile_paths.add(tile_path)
 
     return tile_paths
@@ -44,3 +127,118 @@ def get_tiles_with_bbox(
 def get_tile_level_id(path: str) -> List[str]:
     """Returns both level and tile ID"""
     return path[:-4].split("/", 1)
+
+
+def get_active_build_path() -> Path:
+    """Returns the path of the descriptor of the Valhalla build which is currently served."""
+    return SETTINGS.get_tmp_data_dir().joinpath(Providers.OSM.lower(), ACTIVE_BUILD_NAME)
+
+
+def write_active_build(valhalla_dir: Path, port: int, build_id: Optional[str]) -> Path:
+    """
+    Atomically publishes the Valhalla build which is served from now on.
+
+    :param valhalla_dir: The Valhalla tile directory of the build.
+    :param port: The port the build is served on.
+    :param build_id: The build ID from the tile manifest.
+
+    :returns: the descriptor's path
+    """
+    out_path = get_active_build_path()
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    descriptor = {
+        "valhalla_dir": str(valhalla_dir.resolve()),
+        "port": port,
+        "build_id": build_id,
+        "activated": datetime.now(timezone.utc).isoformat(),
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=out_path.parent, prefix=f".{ACTIVE_BUILD_NAME}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(descriptor, f, indent=2)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return out_path
+
+
+def read_active_build() -> Optional[Dict]:
+    """
+    Returns the descriptor of the Valhalla build which is currently served. The parsed
+    descriptor is cached per process and only read again if the file changed.
+    """
+    path = get_active_build_path()
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _ACTIVE_BUILDS.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with open(path) as f:
+        descriptor = json.load(f)
+    _ACTIVE_BUILDS[path] = (key, descriptor)
+
+    return descriptor
+
+
+def _probe_port(port: int) -> bool:
+    """Asks a Valhalla instance whether it's up."""
+    try:
+        url = f"{SETTINGS.VALHALLA_URL}:{port}/status"
+        status = _HTTP.get(url, timeout=PROBE_TIMEOUT).status_code
+    except RequestException:
+        return False
+
+    # 301 is what the test "expects" due to the simple HTTP server
+    return status in (HTTP_200_OK, HTTP_301_MOVED_PERMANENTLY)
+
+
+def _probe_valhalla_dir() -> Optional[Path]:
+    """Asks both Valhalla instances which one is up, only needed without the descriptor."""
+    for port in (8002, 8003):
+        if _probe_port(port):
+            return Path(SETTINGS.get_valhalla_path(port)).resolve()
+
+    return None
+
+
+def _is_active(descriptor: Dict) -> bool:
+    """
+    Checks whether the descriptor's build is still in its directory. The build loop may have
+    recycled the directory since, e.g. after a restart which served the other one.
+    """
+    if not Path(descriptor["valhalla_dir"]).is_dir():
+        return False
+    if not descriptor.get("build_id"):
+        return _probe_port(descriptor["port"])
+
+    # tile_manifest imports this module
+    from .tile_manifest import get_manifest
+
+    manifest = get_manifest(Path(descriptor["valhalla_dir"]))
+    return manifest is not None and manifest.build_id == descriptor["build_id"]
+
+
+def close_probe_session():
+    """Closes the pooled connections of the HTTP probes."""
+    _HTTP.close()
+
+
+def get_current_valhalla_dir() -> Optional[Path]:
+    """
+    Returns the tile directory of the Valhalla instance which is currently serving or None.
+    Reads the descriptor published by the build loop and only falls back to probing the
+    instances over HTTP if there's none or its build isn't in its directory anymore.
+    """
+    descriptor = read_active_build()
+    if descriptor is not None and _is_active(descriptor):
+        return Path(descriptor["valhalla_dir"])
+
+    return _probe_valhalla_dir()
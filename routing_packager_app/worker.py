@@ -1,44 +1,353 @@
+import asyncio
 import json
 import logging
 import os
+import time
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import suppress
 from datetime import datetime, timezone
 from pathlib import Path
+from threading import Event
+from typing import Dict, List, Tuple
 
 from arq.connections import RedisSettings
 from fastapi import HTTPException
-import requests
-from requests.exceptions import ConnectionError
 import shutil
 from sqlmodel import Session, select
 from starlette.status import (
-    HTTP_200_OK,
     HTTP_404_NOT_FOUND,
     HTTP_500_INTERNAL_SERVER_ERROR,
-    HTTP_301_MOVED_PERMANENTLY,
+    HTTP_503_SERVICE_UNAVAILABLE,
 )
 
 from .api_v1.dependencies import split_bbox
 from .config import SETTINGS
-from .db import get_db
+from .db import engine, make_session_factory
 from .api_v1.models import User, Job
-from .constants import Statuses
+from .constants import Cadences, PackageFormats, Statuses
 from .logger import AppSmtpHandler, get_smtp_details, LOGGER
-from .utils.file_utils import make_zip
-from .utils.valhalla_utils import get_tiles_with_bbox
+from .utils.event_utils import publish_job_status
+from .utils.file_utils import (
+    PROCESS_CONTEXT,
+    ZipCancelled,
+    compress_zstd,
+    make_tile_extract,
+    make_tmp_path,
+    make_zip,
+    remove_tmp_files,
+)
+from .utils.package_manifest import (
+    get_package_delta_path,
+    make_package_manifest,
+    read_package_manifest,
+    write_package_delta,
+    write_package_manifest,
+)
+from .utils.progress_utils import ProgressReporter, get_progress_key
+from .utils.queue_utils import get_queue_name
+from .utils.snapshot_utils import collect_snapshots, pin_snapshot
+from .utils.tile_cache import get_tile_cache
+from .utils.tile_manifest import TileEntry, get_fingerprint, get_manifest
+from .utils.valhalla_utils import close_probe_session, get_current_valhalla_dir
 
 
-async def create_package(
-    ctx,
+# what build_package hands back to create_package
+BuildResult = namedtuple(
+    "BuildResult", "fingerprint unchanged build_id raw_size zip_size duration delta tile_extract"
+)
+# the package as Valhalla tile_extract and its zstd transport copy, next to the ZIP
+TILE_EXTRACT_SUFFIX = ".tar"
+ZSTD_SUFFIX = ".zst"
+
+
+def _link_duplicate(source_zip_path: str, zip_path: str, build_id: str, fingerprint: str) -> bool:
+    """
+    Hardlinks another job's ZIP if it has exactly the same tiles from the same build. The other
+    job may be updated meanwhile, it replaces its ZIP before its meta JSON.
+    """
+    meta_path = Path(source_zip_path).with_suffix(".json")
+    tmp_path = None
+    try:
+        meta_mtime = meta_path.stat().st_mtime_ns
+        meta = json.loads(meta_path.read_text())
+        if meta.get("build_id") != build_id or meta.get("fingerprint") != fingerprint:
+            return False
+        # link to a unique name, nobody else uses it once it's free again
+        tmp_path = make_tmp_path(zip_path)
+        os.unlink(tmp_path)
+        os.link(source_zip_path, tmp_path)
+        # a ZIP newer than its meta JSON is from another build
+        if os.stat(tmp_path).st_mtime_ns > meta_mtime:
+            os.unlink(tmp_path)
+            return False
+        os.replace(tmp_path, zip_path)
+    except (OSError, ValueError) as e:
+        LOGGER.warning(f"Couldn't link {source_zip_path}: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return False
+
+    return True
+
+
+def _read_meta(zip_path: str) -> Dict:
+    """Reads the package's meta JSON of its last run, if there was one."""
+    try:
+        return json.loads(Path(zip_path).with_suffix(".json").read_text())
+    except (OSError, ValueError):
+        return dict()
+
+
+def _get_previous_hashes(zip_path: str, previous_meta: Dict) -> Dict[str, str] | None:
+    """The content hashes of the package's tiles at its last run, from its package manifest."""
+    previous_build_id = previous_meta.get("build_id")
+    if not previous_build_id:
+        return None
+    previous_manifest = read_package_manifest(Path(zip_path), previous_build_id)
+    if previous_manifest is None:
+        return None
+
+    return {tile["path"]: tile["hash"] for tile in previous_manifest["tiles"] if tile.get("hash")}
+
+
+def _write_delta(zip_path: Path, manifest: Dict, previous_meta: Dict) -> Dict | None:
+    """
+    Writes the package's delta to the build of its last run. Another run from the same build
+    keeps the existing delta.
+    """
+    delta_path = get_package_delta_path(zip_path)
+    previous_build_id = previous_meta.get("build_id")
+    if previous_build_id == manifest["build_id"]:
+        delta = previous_meta.get("delta")
+        return delta if delta and delta_path.is_file() else None
+
+    old_manifest = read_package_manifest(zip_path, previous_build_id) if previous_build_id else None
+    if old_manifest is None:
+        # a delta to an older build would be wrong now
+        delta_path.unlink(missing_ok=True)
+        return None
+    size = write_package_delta(zip_path, old_manifest, manifest)
+
+    return {"filepath": delta_path.name, "from_build_id": previous_build_id, "size": size}
+
+
+def _write_tile_extract(
+    tile_entries: List[TileEntry],
+    valhalla_dir: Path,
+    zip_path: str,
+    unchanged: bool,
+    cancel: Event | None,
+) -> Dict:
+    """
+    Writes the package's tiles as Valhalla tile_extract tar next to its ZIP and a zstd copy of
+    it if TILE_EXTRACT_ZSTD_LEVEL is set. Unchanged packages only write what's missing.
+    """
+    tar_path = Path(zip_path).with_suffix(TILE_EXTRACT_SUFFIX)
+    zstd_path = tar_path.with_name(tar_path.name + ZSTD_SUFFIX)
+    if not unchanged or not tar_path.is_file():
+        make_tile_extract(tile_entries, valhalla_dir, str(tar_path), cancel=cancel)
+        zstd_path.unlink(missing_ok=True)
+    tile_extract = {"filepath": tar_path.name, "size": tar_path.stat().st_size, "zstd": None}
+
+    if SETTINGS.TILE_EXTRACT_ZSTD_LEVEL:
+        try:
+            if not zstd_path.is_file():
+                compress_zstd(str(tar_path), str(zstd_path), SETTINGS.TILE_EXTRACT_ZSTD_LEVEL)
+            tile_extract["zstd"] = {"filepath": zstd_path.name, "size": zstd_path.stat().st_size}
+        except RuntimeError as e:
+            LOGGER.warning(f"Couldn't compress {tar_path}: {e}")
+
+    return tile_extract
+
+
+def _zip_tiles(
+    valhalla_dir: Path,
+    bbox: str,
+    zip_path: str,
+    update: bool,
+    fingerprint: str | None,
+    cancel: Event | None,
+    progress: ProgressReporter | None,
+    source_zip_path: str | None = None,
+    package_format: PackageFormats = PackageFormats.ZIP,
+) -> BuildResult:
+    """
+    ZIPs the bbox's tiles of a pinned Valhalla build snapshot, or links the identical ZIP at
+    source_zip_path. Updates also write a delta to the package's previous build, tile_extract
+    packages also their tar. Only the package manifest and delta are best-effort, if the ZIP or
+    tar fails the job does, too.
+    """
+    manifest = get_manifest(valhalla_dir)
+    previous_meta = _read_meta(zip_path) if update else dict()
+    previous_hashes = _get_previous_hashes(zip_path, previous_meta)
+
+    # Gather Valhalla tile paths from the manifest, without touching the tile directory
+    tile_entries = manifest.get_tiles(split_bbox(bbox))
+    tile_paths = {valhalla_dir.joinpath(entry.path) for entry in tile_entries}
+    if not tile_paths:
+        raise HTTPException(404, f"No Valhalla tiles in bbox {bbox}")
+
+    # an update is a no-op if no tile in the bbox changed since the last run
+    new_fingerprint = get_fingerprint(tile_entries)
+    unchanged = update and new_fingerprint == fingerprint and os.path.isfile(zip_path)
+    duration = None
+    members = None
+    delta = None
+    tile_extract = None
+    try:
+        # snapshots are named after their build
+        if (
+            not unchanged
+            and source_zip_path
+            and _link_duplicate(source_zip_path, zip_path, valhalla_dir.name, new_fingerprint)
+        ):
+            LOGGER.info(f"Linked the identical package {source_zip_path} to {zip_path}.")
+        elif not unchanged:
+            start_time = time.monotonic()
+            cache = get_tile_cache(valhalla_dir, manifest)
+            members = make_zip(
+                tile_paths,
+                valhalla_dir,
+                zip_path,
+                workers=SETTINGS.ZIP_WORKERS,
+                cache=cache,
+                manifest=manifest,
+                # only recompress the tiles which changed since the last update
+                previous_fp=zip_path if update else None,
+                previous_hashes=previous_hashes,
+                cancel=cancel,
+                progress=progress,
+            )
+            duration = time.monotonic() - start_time
+            if cache:
+                cache.evict()
+        if package_format == PackageFormats.TILE_EXTRACT:
+            tile_extract = _write_tile_extract(tile_entries, valhalla_dir, zip_path, unchanged, cancel)
+    except ZipCancelled:
+        raise
+    except Exception as e:
+        # the old ZIP is still in place, which mustn't pass for this build
+        raise HTTPException(HTTP_500_INTERNAL_SERVER_ERROR, f"Couldn't build {zip_path}: {e}")
+    fingerprint = new_fingerprint
+
+    # the ZIP has this build's tiles now, clients can still download it without its manifest
+    try:
+        if members is None:
+            # unchanged and linked packages only need the ZIP's central directory
+            with zipfile.ZipFile(zip_path) as archive:
+                members = archive.infolist()
+            package_manifest = make_package_manifest(members, manifest, Path(zip_path))
+        else:
+            package_manifest = make_package_manifest(members, manifest)
+        write_package_manifest(Path(zip_path), package_manifest)
+        if update:
+            delta = _write_delta(Path(zip_path), package_manifest, previous_meta)
+    except Exception as e:
+        LOGGER.warning(f"Couldn't write the package manifest or delta of {zip_path}: {e}")
+        # a delta to the previous build would be wrong now
+        get_package_delta_path(Path(zip_path)).unlink(missing_ok=True)
+
+    return BuildResult(
+        fingerprint,
+        unchanged,
+        valhalla_dir.name,
+        sum(entry.size for entry in tile_entries),
+        os.path.getsize(zip_path),
+        duration,
+        delta,
+        tile_extract,
+    )
+
+
+def build_package(
     job_id: int,
     job_name: str,
     description: str,
     bbox: str,
     zip_path: str,
-    user_id: int | None,
-    update: bool = False,
-):
-    session: Session = next(get_db())
+    update: bool,
+    fingerprint: str | None,
+    cancel: Event | None = None,
+    source_zip_path: str | None = None,
+    package_format: PackageFormats = PackageFormats.ZIP,
+) -> BuildResult:
+    """
+    Builds a package's ZIP and meta JSON. This is the blocking part of create_package and runs
+    in the worker's package executor, so it only takes picklable arguments.
+
+    :param fingerprint: the fingerprint of the package's tiles at the last run.
+    :param cancel: stops building the ZIP once it's set.
+    :param source_zip_path: another job's package, which is linked instead if it still has
+        the same tiles.
+    :param package_format: tile_extract also writes the tiles as a tar Valhalla can memory-map.
 
+    :returns: the fingerprint of the package's tiles, whether they were unchanged, the
+        Valhalla build they're from, their raw and ZIP size, how long the ZIP took, the delta
+        to the previous build and the tile_extract tar
+    """
+    # get the active Valhalla instance
+    current_valhalla_dir = get_current_valhalla_dir()
+    if current_valhalla_dir is None:
+        raise HTTPException(
+            HTTP_500_INTERNAL_SERVER_ERROR,
+            "No Valhalla service online, check the Valhalla server's docker logs.",
+        )
+
+    # a failed first build removed the package's directory
+    os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+    # read the tiles from a pinned snapshot, so the build loop can recycle the directory meanwhile
+    try:
+        with pin_snapshot(current_valhalla_dir) as snapshot_dir:
+            if snapshot_dir is None:
+                raise HTTPException(
+                    404,
+                    f"No Valhalla tiles in {current_valhalla_dir} or no tile manifest, "
+                    "write it with cli.py manifest.",
+                )
+            result = _zip_tiles(
+                snapshot_dir,
+                bbox,
+                zip_path,
+                update,
+                fingerprint,
+                cancel,
+                ProgressReporter(job_id),
+                source_zip_path,
+                package_format,
+            )
+    except TimeoutError:
+        raise HTTPException(
+            HTTP_503_SERVICE_UNAVAILABLE, f"Valhalla tiles in {current_valhalla_dir} are being rebuilt."
+        )
+    # the previous build's snapshot goes away with its last job
+    collect_snapshots()
+
+    # Create the meta JSON
+    fname = os.path.basename(zip_path)
+    j = {
+        "job_id": job_id,
+        "filepath": fname,
+        "name": job_name,
+        "description": description,
+        "extent": bbox,
+        "last_modified": str(datetime.now(timezone.utc)),
+        "build_id": result.build_id,
+        "fingerprint": result.fingerprint,
+        "delta": result.delta,
+        "tile_extract": result.tile_extract,
+    }
+    dirname = os.path.dirname(zip_path)
+    fname_sanitized = fname.split(os.extsep, 1)[0]
+    with open(os.path.join(dirname, fname_sanitized + ".json"), "w", encoding="utf8") as f:
+        json.dump(j, f, indent=2, ensure_ascii=False)
+
+    return result
+
+
+def _start_job(session: Session, job_id: int, user_id: int | None, update: bool) -> Tuple[str, Job]:
+    """Looks up the job and its user and marks the job as compressing."""
     # Set up the logger where we have access to the user email
     # and only if there hasn't been one before
     if user_id is not None:
@@ -57,7 +366,6 @@ async def create_package(
             LOGGER.addHandler(handler)
     else:
         user_email = ""
-    log_extra = {"user": user_email, "job_id": job_id}
 
     statement = select(Job).where(Job.id == job_id)
     job = session.exec(statement).first()
@@ -69,91 +377,190 @@ async def create_package(
     job.status = Statuses.COMPRESSING
     job.last_started = datetime.now(timezone.utc)
     session.commit()
+    # load the committed job here, not on the event loop
+    session.refresh(job)
 
-    succeeded = False
-    try:
-        # TODO: gzipping is synchronous, maybe follow
-        #   https://arq-docs.helpmanual.io/#synchronous-jobs
-
-        # get the active Valhalla instance
-        current_valhalla_dir_str = ""
-        for port in (8002, 8003):
-            try:
-                status = requests.get(f"{SETTINGS.VALHALLA_URL}:{port}/status").status_code
-                # 301 is what the test "expects" due to the simple HTTP server
-                if status not in (HTTP_200_OK, HTTP_301_MOVED_PERMANENTLY):
-                    continue
-                current_valhalla_dir_str = SETTINGS.get_valhalla_path(port)
-                break
-            except ConnectionError:
-                pass
-
-        if not current_valhalla_dir_str:
-            raise HTTPException(
-                HTTP_500_INTERNAL_SERVER_ERROR,
-                "No Valhalla service online, check the Valhalla server's docker logs.",
-            )
+    return user_email, job
 
-        current_valhalla_dir = Path(current_valhalla_dir_str).resolve()
-        valhalla_tiles = sorted(current_valhalla_dir.rglob("*.gph"))
-        if not valhalla_tiles or not current_valhalla_dir_str:
-            raise HTTPException(404, f"No Valhalla tiles in {current_valhalla_dir.resolve()}")
 
-        # Gather Valhalla tile paths
-        tile_paths = get_tiles_with_bbox(valhalla_tiles, split_bbox(bbox), current_valhalla_dir)
-        if not tile_paths:
-            raise HTTPException(404, f"No Valhalla tiles in bbox {bbox}")
+def _finish_job(session: Session, job: Job, status: Statuses, result: BuildResult | None):
+    """Writes the job's final status and what it built."""
+    # always write the "last_finished" column
+    job.last_finished = datetime.now(timezone.utc)
+    job.status = status
+    if result is not None:
+        job.fingerprint = result.fingerprint
+        job.build_id = result.build_id
+        job.raw_size = result.raw_size
+        job.zip_size = result.zip_size
+        job.delta_size = result.delta["size"] if result.delta else None
+        # unchanged packages keep the duration of their last build
+        if result.duration is not None:
+            job.duration = result.duration
+    # failed updates are retried by the next cli.py run
+    if status == Statuses.FAILED and job.cadence != Cadences.ON_DEMAND:
+        job.next_due = job.last_finished
+    session.commit()
 
-        # zip up the tiles after locking the directory to not be updated right now
-        out_dir = SETTINGS.get_output_path()
-        lock = out_dir.joinpath(".lock")
-        lock.touch(exist_ok=False)
-        try:
-            make_zip(tile_paths, current_valhalla_dir, zip_path)
-        except Exception as e:
-            LOGGER.error(e)
-        finally:
-            lock.unlink(missing_ok=False)
-
-        # Create the meta JSON
-        fname = os.path.basename(zip_path)
-        j = {
-            "job_id": job_id,
-            "filepath": fname,
-            "name": job_name,
-            "description": description,
-            "extent": bbox,
-            "last_modified": str(datetime.now(timezone.utc)),
-        }
-        dirname = os.path.dirname(zip_path)
-        fname_sanitized = fname.split(os.extsep, 1)[0]
-        with open(os.path.join(dirname, fname_sanitized + ".json"), "w", encoding="utf8") as f:
-            json.dump(j, f, indent=2, ensure_ascii=False)
-
-        LOGGER.info(
-            f"Job {job_id} by {user_email} finished successfully. Find the new dataset in {zip_path}",
-            extra=log_extra,
+
+async def create_package(
+    ctx,
+    job_id: int,
+    job_name: str,
+    description: str,
+    bbox: str,
+    zip_path: str,
+    user_id: int | None,
+    update: bool = False,
+    source_zip_path: str | None = None,
+):
+    """
+    Orchestrates building a package, all blocking work runs in threads or the worker's package
+    executor, so the event loop stays free for heartbeats, timeouts, aborts and other jobs.
+    source_zip_path is an identical package, which post_job found for a new job.
+    """
+    # tests call this function directly with an empty context
+    ctx = ctx if isinstance(ctx, dict) else dict()
+    session_factory = ctx.get("session_factory") or make_session_factory()
+    with session_factory() as session:
+        await _create_package(
+            ctx,
+            session,
+            job_id,
+            job_name,
+            description,
+            bbox,
+            zip_path,
+            user_id,
+            update,
+            source_zip_path,
+        )
+
+
+async def _create_package(
+    ctx: dict,
+    session: Session,
+    job_id: int,
+    job_name: str,
+    description: str,
+    bbox: str,
+    zip_path: str,
+    user_id: int | None,
+    update: bool,
+    source_zip_path: str | None,
+):
+    user_email, job = await asyncio.to_thread(_start_job, session, job_id, user_id, update)
+    log_extra = {"user": user_email, "job_id": job_id}
+    db_job_name = job.name
+    # arq passes its Redis connection
+    redis = ctx.get("redis")
+    if redis is not None:
+        # forget the progress of the last run
+        await redis.delete(get_progress_key(job_id))
+    await publish_job_status(redis, job_id, Statuses.COMPRESSING)
+
+    succeeded = False
+    result = None
+    try:
+        cancel = ctx["package_manager"].Event() if "package_manager" in ctx else Event()
+        future = asyncio.get_running_loop().run_in_executor(
+            ctx.get("package_executor"),
+            build_package,
+            job_id,
+            job_name,
+            description,
+            bbox,
+            zip_path,
+            update,
+            job.fingerprint,
+            cancel,
+            source_zip_path,
+            job.package_format,
         )
+        try:
+            # the shield keeps the build running until it noticed the cancellation
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # arq aborted the job or it timed out
+            cancel.set()
+            with suppress(Exception):
+                await future
+            raise
+
+        msg = f"Job {job_id} by {user_email} finished successfully."
+        if result.unchanged:
+            msg += f" None of its tiles changed, the dataset in {zip_path} is still current."
+        else:
+            msg += f" Find the new dataset in {zip_path}."
+        msg += f" It was made from Valhalla build {result.build_id}."
+        LOGGER.info(msg, extra=log_extra)
         succeeded = True
     # catch all exceptions we're controlling
     except HTTPException as e:
-        LOGGER.critical(f"Job {job.name} failed with\n'{e.detail}'", extra=log_extra)
+        LOGGER.critical(f"Job {db_job_name} failed with\n'{e.detail}'", extra=log_extra)
         raise e
+    except asyncio.CancelledError:
+        LOGGER.critical(f"Job {db_job_name} by {user_email} was aborted.", extra=log_extra)
+        raise
     # any other exception is assumed to be a deleted job and will only be logged/email sent
     except Exception:  # pragma: no cover
-        msg = f"Job {job.name} by {user_email} was deleted."
+        msg = f"Job {db_job_name} by {user_email} was deleted."
         LOGGER.critical(msg, extra=log_extra)
         raise
     finally:
         final_status = Statuses.COMPLETED
         if not succeeded:
-            shutil.rmtree(os.path.dirname(zip_path))
+            # a failed update leaves the last package in place, it's still valid
+            if update:
+                await asyncio.to_thread(remove_tmp_files, Path(zip_path).parent)
+            else:
+                shutil.rmtree(os.path.dirname(zip_path), ignore_errors=True)
             final_status = Statuses.FAILED
 
-        # always write the "last_finished" column
-        job.last_finished = datetime.now(timezone.utc)
-        job.status = final_status
-        session.commit()
+        await asyncio.to_thread(_finish_job, session, job, final_status, result)
+        await publish_job_status(redis, job_id, final_status)
+
+
+def warm_up():
+    """Maps the active build's tile manifest, so the first job doesn't have to."""
+    try:
+        valhalla_dir = get_current_valhalla_dir()
+        if valhalla_dir is None:
+            return
+        with pin_snapshot(valhalla_dir) as snapshot_dir:
+            if snapshot_dir is not None:
+                get_manifest(snapshot_dir)
+    except Exception as e:  # pragma: no cover
+        LOGGER.warning(f"Couldn't warm up the tile manifest: {e}")
+
+
+async def startup(ctx):
+    """
+    Creates the resources which are shared by all jobs of this worker process: the DB session
+    factory and the executor which builds the packages off the event loop, with a warm tile index.
+    """
+    ctx["session_factory"] = make_session_factory()
+    if SETTINGS.PACKAGE_EXECUTOR == "process":
+        # each process keeps its own memory-mapped manifests
+        ctx["package_executor"] = ProcessPoolExecutor(
+            max_workers=SETTINGS.PACKAGE_MAX_JOBS, mp_context=PROCESS_CONTEXT, initializer=warm_up
+        )
+        # plain threading events can't be shared with other processes
+        ctx["package_manager"] = PROCESS_CONTEXT.Manager()
+    else:
+        ctx["package_executor"] = ThreadPoolExecutor(
+            max_workers=SETTINGS.PACKAGE_MAX_JOBS, thread_name_prefix="package"
+        )
+        await asyncio.to_thread(warm_up)
+
+
+async def shutdown(ctx):
+    """Waits for the running builds and releases the shared resources."""
+    ctx["package_executor"].shutdown(wait=True, cancel_futures=True)
+    if "package_manager" in ctx:
+        ctx["package_manager"].shutdown()
+    close_probe_session()
+    engine.dispose()
 
 
 class WorkerSettings:
@@ -163,3 +570,9 @@ class WorkerSettings:
 
     redis_settings = RedisSettings.from_dsn(SETTINGS.REDIS_URL)
     functions = [create_package]
+    queue_name = get_queue_name(SETTINGS.WORKER_QUEUE)
+    on_startup = startup
+    on_shutdown = shutdown
+    max_jobs = SETTINGS.PACKAGE_MAX_JOBS
+    job_timeout = SETTINGS.JOB_TIMEOUT
+    allow_abort_jobs = True
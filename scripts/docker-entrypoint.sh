@@ -4,7 +4,10 @@ cmd=${1}
 
 # either starts a worker or the app itself
 if [ "${cmd}" == 'worker' ]; then
-  # Start the worker
+  # Start the worker, optionally for a single queue: "interactive" (default) or "bulk"
+  if [ -n "${2}" ]; then
+    export WORKER_QUEUE=${2}
+  fi
   exec /app/app_venv/bin/arq routing_packager_app.worker.WorkerSettings
 elif [ "${cmd}" == 'app' ]; then
   # SSL? Provided by .docker_env with path mapped in docker-compose.yml
@@ -26,5 +29,5 @@ elif [ "${cmd}" == 'app' ]; then
   . /app/app_venv/bin/activate
   exec /app/app_venv/bin/gunicorn --config gunicorn.py ${opts} main:app
 else
-  echo "Command '${cmd}' not recognized. Choose from 'worker' or 'app'"
+  echo "Command '${cmd}' not recognized. Choose from 'worker [interactive|bulk]' or 'app'"
 fi
@@ -5,7 +5,8 @@
 # License: MIT
 #
 # Rotationally build Valhalla tiles to 2 different directories (env vars from docker-compose.yml).
-# Respects a .lock file and waits for it to disappear before nuking the tileset.
+# Packaging jobs read from hardlinked snapshots of each tileset, so a tileset can be nuked while
+# they're running. Its .lock file is only held while a snapshot of it is being created.
 #
 # Note, that some variables here are sourced from the .env/.docker_env file.
 #
@@ -21,24 +22,6 @@ log_message() {
     echo "build_loop: $(date "+%Y-%m-%d %H:%M:%S") $1"
 }
 
-# watch the .lock file every 10 secs
-wait_for_lock() {
-  count=0
-  sleep=10
-  max=3600
-  while ! [[ $count == $max ]]; do
-    if ! [[ -f $1/.lock ]]; then
-     return
-    fi
-    echo "INFO: sleeping for $sleep seconds to wait for .lock file to disappear at $1"
-    sleep $sleep
-    count=$(( $count + $sleep ))
-  done
-
-  log_message "ERROR: max count reached"
-  exit 1
-}
-
 # reset config so we don't start the service with a valid graph
 # we only need the service to query the /status endpoint to decide
 # which instance to shut down/start up
@@ -120,22 +103,32 @@ while true; do
     --mjolnir-logging-type "" \
     > "${valhalla_config}" || exit 1
 
-  # wait until there's no .lock file anymore
-  wait_for_lock "$CURRENT_VALHALLA_DIR"
-
   # If it's the first start and a graph already exists, continue with next build
   if [[ -z $OLD_PORT && -d $CURRENT_VALHALLA_DIR ]]; then
     # remove the reference to tiles_dir so the service doesn't actually load the tiles
     reset_config
-    exec valhalla_service "$valhalla_config" 1 &
-    OLD_PID=$!
+    # publish it as the active build, the descriptor may still point at the other directory,
+    #   which is rebuilt next
+    OLD_PID=$(python3 /app/cli.py activate "$valhalla_config" "$CURRENT_PORT" --no-update) || exit 1
     log_message "INFO: Started Valhalla the first time with config $valhalla_config on with PID $OLD_PID"
-    sleep 10
     echo ""
     echo ""
     continue
   fi
 
+  # wait for snapshots of this tileset to be completed, then keep new ones from being
+  # created until the new graph and its manifest are complete
+  exec 9>"$CURRENT_VALHALLA_DIR/.lock"
+  if ! flock -x -w 3600 9; then
+    log_message "ERROR: Timed out waiting for the packaging jobs reading $CURRENT_VALHALLA_DIR"
+    exit 1
+  fi
+
+  # the old tiles may be hardlinked into snapshots, so remove them instead of letting the
+  # build overwrite them in place; the old manifest doesn't describe the new graph anymore
+  rm -rf "$CURRENT_VALHALLA_DIR"/0 "$CURRENT_VALHALLA_DIR"/1 "$CURRENT_VALHALLA_DIR"/2
+  rm -f "$CURRENT_VALHALLA_DIR/tiles.manifest"
+
   log_message "INFO: Building initial graph with $PBF..."
   valhalla_build_tiles -c "${valhalla_config}" -s initialize -e build "$PBF" || exit 1
 
@@ -147,19 +140,22 @@ while true; do
   log_message "INFO: Enhancing initial tiles with elevation..."
   valhalla_build_tiles -c "${valhalla_config}" -s enhance -e cleanup "$PBF" || exit 1
 
+  log_message "INFO: Writing the tile manifest to $CURRENT_VALHALLA_DIR..."
+  python3 /app/cli.py manifest "$CURRENT_VALHALLA_DIR" || exit 1
+
+  log_message "INFO: Snapshotting $CURRENT_VALHALLA_DIR for packaging..."
+  python3 /app/cli.py snapshot "$CURRENT_VALHALLA_DIR" || exit 1
+
+  # release the exclusive lease
+  exec 9>&-
+
   # reset config so the service won't load the graph
   reset_config
 
-  log_message "INFO: Updating the registered packages with $(which python3)"
-  python3 /app/cli.py
-
-  # shut down the old service and launch the new one
-  log_message "INFO: Killing Valhalla on port $OLD_PORT with PID $OLD_PID"
-  kill -9 $OLD_PID
-  exec valhalla_service "$valhalla_config" 1 &
-  OLD_PID=$!
-  log_message "INFO: Started Valhalla on port $CURRENT_PORT with PID $OLD_PID"
-  sleep 10
+  # serve the new graph right away, the packages are updated against it in the background
+  log_message "INFO: Activating Valhalla on port $CURRENT_PORT, replacing PID $OLD_PID"
+  OLD_PID=$(python3 /app/cli.py activate "$valhalla_config" "$CURRENT_PORT" --old-pid "$OLD_PID") || exit 1
+  log_message "INFO: Started Valhalla on port $CURRENT_PORT with PID $OLD_PID, updating the packages in the background"
 
   echo ""
   echo ""
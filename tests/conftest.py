@@ -95,6 +95,14 @@ def create_key_header(get_client: TestClient, basic_auth_header: dict):
         raise RuntimeError(f"Error while deleting test api keys: {e}")
 
 
+@pytest.fixture(scope="function")
+def tile_dir(tmp_path):
+    """A copy of the Andorra tiles, which tests can change and write manifests to."""
+    tile_dir = tmp_path.joinpath("tiles")
+    shutil.copytree(SETTINGS.get_data_dir().joinpath("andorra_tiles"), tile_dir)
+    yield tile_dir
+
+
 # Creates needed directories and removes them after the test function
 @pytest.fixture(scope="session", autouse=True)
 def handle_dirs():
@@ -6,6 +6,7 @@ from sqlmodel import Session, select
 
 from routing_packager_app import SETTINGS
 from routing_packager_app.api_v1.models import Job
+from routing_packager_app.utils.tile_manifest import write_manifest
 
 
 # alter the default port for the HTTP test server:
@@ -37,5 +38,7 @@ def delete_dirs():
 def copy_valhalla_tiles():
     for dir_ in SETTINGS.get_output_path().parent.joinpath("andorra_tiles").iterdir():
         copytree(dir_, SETTINGS.get_valhalla_path(8002).joinpath(dir_.stem))
+    # the build loop writes it with cli.py manifest
+    write_manifest(SETTINGS.get_valhalla_path(8002))
     yield
     rmtree(SETTINGS.get_valhalla_path(8002))
@@ -1,14 +1,21 @@
 from copy import deepcopy
+import json
 from pathlib import Path
 import shutil
+from unittest.mock import patch
 from zipfile import ZipFile
 
 import pytest
 from pytest_httpserver import HTTPServer
 from starlette.exceptions import HTTPException
+from sqlmodel import Session
 from starlette.testclient import TestClient
 
 from routing_packager_app import SETTINGS
+from routing_packager_app.api_v1.models import Job
+from routing_packager_app.constants import Statuses
+from routing_packager_app.utils.file_utils import read_tile_extract_index
+from routing_packager_app.utils.package_manifest import read_package_manifest
 from routing_packager_app.worker import create_package
 
 from ..utils_ import create_new_job, create_package_params
@@ -89,3 +96,160 @@ async def test_fail_no_tiles_in_bbox(
 
     assert e.value.status_code == 404
     assert "No Valhalla tiles in bbox" in e.value.detail
+
+
+@pytest.mark.asyncio
+async def test_update_unchanged(
+    get_client: TestClient,
+    httpserver: HTTPServer,
+    basic_auth_header,
+    copy_valhalla_tiles,
+    get_session: Session,
+):
+    httpserver.expect_request("/status").respond_with_json({})
+
+    args = deepcopy(DEFAULT_ARGS)
+    args["bbox"] = "1.486630,42.608695,1.534706,42.646334"
+    new_job = create_new_job(get_client, args, basic_auth_header)
+    shutil.rmtree(Path(new_job.json()["zip_path"]).parent)
+    params = create_package_params(new_job.json())
+
+    await create_package(*params)
+
+    job = get_session.get(Job, new_job.json()["id"])
+    first_finished = job.last_finished
+    assert job.fingerprint
+    out_fp = Path(new_job.json()["zip_path"])
+    meta_fp = out_fp.with_suffix(".json")
+    zip_mtime = out_fp.stat().st_mtime_ns
+    first_meta = json.loads(meta_fp.read_text())
+    assert job.build_id and first_meta["build_id"] == job.build_id
+    assert read_package_manifest(out_fp, job.build_id)["build_id"] == job.build_id
+    assert job.raw_size > 0 and job.zip_size == out_fp.stat().st_size
+    first_duration = job.duration
+    assert first_duration is not None
+    # only updates to a new build have a delta
+    assert first_meta["delta"] is None and job.delta_size is None
+
+    # nothing changed in the bbox, so the update only refreshes the meta data
+    with patch("routing_packager_app.worker.make_zip") as make_zip_mock:
+        await create_package(*params, True)
+        make_zip_mock.assert_not_called()
+
+    get_session.refresh(job)
+    assert job.status == Statuses.COMPLETED
+    assert job.last_finished > first_finished
+    assert job.duration == first_duration
+    assert out_fp.stat().st_mtime_ns == zip_mtime
+    assert json.loads(meta_fp.read_text())["last_modified"] != first_meta["last_modified"]
+    assert job.delta_size is None and not out_fp.with_suffix(".delta.zip").exists()
+
+
+@pytest.mark.asyncio
+async def test_update_fail_zip(
+    get_client: TestClient,
+    httpserver: HTTPServer,
+    basic_auth_header,
+    copy_valhalla_tiles,
+    get_session: Session,
+):
+    httpserver.expect_request("/status").respond_with_json({})
+
+    args = deepcopy(DEFAULT_ARGS)
+    args["bbox"] = "1.486630,42.608695,1.534706,42.646334"
+    new_job = create_new_job(get_client, args, basic_auth_header)
+    shutil.rmtree(Path(new_job.json()["zip_path"]).parent)
+    params = create_package_params(new_job.json())
+
+    await create_package(*params)
+    job = get_session.get(Job, new_job.json()["id"])
+    build_id = job.build_id
+    out_fp = Path(new_job.json()["zip_path"])
+    zip_bytes = out_fp.read_bytes()
+    # left behind by a build process which died
+    tmp_fp = out_fp.with_name(f".{out_fp.name}.abc.tmp")
+    tmp_fp.touch()
+
+    # the old ZIP mustn't pass for the update
+    with (
+        patch("routing_packager_app.worker.get_fingerprint", return_value="changed"),
+        patch("routing_packager_app.worker.make_zip", side_effect=OSError("No space left on device")),
+        pytest.raises(HTTPException) as e,
+    ):
+        await create_package(*params, True)
+
+    assert e.value.status_code == 500
+    assert "No space left on device" in e.value.detail
+    get_session.refresh(job)
+    assert job.status == Statuses.FAILED
+    assert job.build_id == build_id
+    # the last package is still valid
+    assert out_fp.read_bytes() == zip_bytes
+    assert read_package_manifest(out_fp, build_id) is not None
+    assert not tmp_fp.exists()
+
+    # and the next update succeeds
+    await create_package(*params, True)
+    get_session.refresh(job)
+    assert job.status == Statuses.COMPLETED
+
+
+@pytest.mark.asyncio
+async def test_tile_extract(
+    get_client: TestClient, httpserver: HTTPServer, basic_auth_header, copy_valhalla_tiles
+):
+    httpserver.expect_oneshot_request("/status").respond_with_json({})
+
+    args = deepcopy(DEFAULT_ARGS)
+    args["bbox"] = "1.486630,42.608695,1.534706,42.646334"
+    args["package_format"] = "tile_extract"
+    new_job = create_new_job(get_client, args, basic_auth_header)
+    assert new_job.json()["package_format"] == "tile_extract"
+    shutil.rmtree(Path(new_job.json()["zip_path"]).parent)
+    params = create_package_params(new_job.json())
+
+    await create_package(*params)
+
+    # the tar comes with the ZIP, which serves manifests, tiles and deltas
+    out_fp = Path(new_job.json()["zip_path"])
+    tar_fp = out_fp.with_suffix(".tar")
+    with ZipFile(out_fp) as archive:
+        assert len(read_tile_extract_index(str(tar_fp))) == len(archive.namelist())
+    tile_extract = json.loads(out_fp.with_suffix(".json").read_text())["tile_extract"]
+    assert tile_extract == {"filepath": tar_fp.name, "size": tar_fp.stat().st_size, "zstd": None}
+
+
+@pytest.mark.asyncio
+async def test_duplicate_linked(
+    get_client: TestClient,
+    httpserver: HTTPServer,
+    basic_auth_header,
+    copy_valhalla_tiles,
+    get_session: Session,
+):
+    httpserver.expect_request("/status").respond_with_json({})
+
+    args = deepcopy(DEFAULT_ARGS)
+    args["bbox"] = "1.486630,42.608695,1.534706,42.646334"
+    first_job = create_new_job(get_client, args, basic_auth_header).json()
+    shutil.rmtree(Path(first_job["zip_path"]).parent)
+    await create_package(*create_package_params(first_job))
+
+    args["name"] = "test_duplicate"
+    second_job = create_new_job(get_client, args, basic_auth_header).json()
+    shutil.rmtree(Path(second_job["zip_path"]).parent)
+    # post_job found the first job's package for the same tiles
+    with patch("routing_packager_app.worker.make_zip") as make_zip_mock:
+        await create_package(*create_package_params(second_job), False, first_job["zip_path"])
+        make_zip_mock.assert_not_called()
+
+    first_fp, second_fp = Path(first_job["zip_path"]), Path(second_job["zip_path"])
+    assert first_fp.samefile(second_fp)
+    first_meta = json.loads(first_fp.with_suffix(".json").read_text())
+    second_meta = json.loads(second_fp.with_suffix(".json").read_text())
+    assert second_meta["job_id"] == second_job["id"]
+    assert second_meta["fingerprint"] == first_meta["fingerprint"]
+
+    job = get_session.get(Job, second_job["id"])
+    assert job.status == Statuses.COMPLETED
+    assert job.fingerprint == second_meta["fingerprint"]
@@ -0,0 +1,128 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+import pytest
+
+import cli
+
+
+class FakeArqJob:
+    def __init__(self, pool, job_id: int):
+        self.pool = pool
+        self.job_id = job_id
+
+    async def result(self, timeout, poll_delay):
+        try:
+            await asyncio.sleep(0.01)
+            if self.job_id in self.pool.fail_result:
+                raise RuntimeError("Valhalla is gone")
+            return True
+        finally:
+            self.pool.in_flight -= 1
+
+
+class FakePool:
+    def __init__(self, fail_enqueue=(), fail_result=()):
+        self.fail_enqueue = fail_enqueue
+        self.fail_result = fail_result
+        self.enqueued = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def enqueue_job(self, function, job_id, *args, **kwargs):
+        if job_id in self.fail_enqueue:
+            raise ConnectionError("Redis is gone")
+        self.enqueued.append(job_id)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return FakeArqJob(self, job_id)
+
+    async def aclose(self):
+        pass
+
+
+class FakeWaiter:
+    def __init__(self, pool=None):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def expect(self, job_id: int):
+        pass
+
+    async def wait(self, job_id: int):
+        # only the result finishes the fake jobs
+        await asyncio.Event().wait()
+
+
+def make_job(job_id: int):
+    return SimpleNamespace(
+        id=job_id,
+        arq_id=f"job_{job_id}",
+        name=f"job_{job_id}",
+        description="",
+        bbox=b"",
+        zip_path=f"/tmp/job_{job_id}.zip",
+        user_id=1,
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_job_schedules_on_enqueue():
+    run_start = datetime.now(timezone.utc)
+    previous_due = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    pool = FakePool(fail_enqueue=(2,))
+    semaphore = asyncio.Semaphore(1)
+
+    with (
+        patch("cli.wkbe_to_str", lambda bbox: "0,0,1,1"),
+        patch("cli._set_next_due", Mock(return_value=previous_due)) as set_next_due,
+    ):
+        assert await cli._update_job(pool, make_job(1), "", semaphore, FakeWaiter(), run_start)
+        # the due date is only advanced for jobs which were enqueued
+        set_next_due.assert_called_once_with(1, run_start)
+
+        set_next_due.reset_mock()
+        with pytest.raises(ConnectionError):
+            await cli._update_job(pool, make_job(2), "", semaphore, FakeWaiter(), run_start)
+        assert [c.args for c in set_next_due.call_args_list] == [(2, run_start), (2, None, previous_due)]
+
+        # explicitly requested updates keep their schedule
+        set_next_due.reset_mock()
+        assert await cli._update_job(pool, make_job(3), "", semaphore, FakeWaiter())
+        set_next_due.assert_not_called()
+
+    assert pool.enqueued == [1, 3]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency", (1, 3))
+async def test_update_jobs_concurrency(concurrency):
+    pool = FakePool(fail_result=(2,))
+
+    async def create_pool(settings):
+        return pool
+
+    with (
+        patch("cli.wkbe_to_str", lambda bbox: "0,0,1,1"),
+        patch("cli.create_pool", create_pool),
+        patch("cli.JobStatusWaiter", FakeWaiter),
+        patch("cli.LOGGER") as logger,
+    ):
+        await cli.update_jobs([make_job(job_id) for job_id in range(1, 8)], "", concurrency)
+
+    # never more than "concurrency" updates in flight, they start in order
+    assert pool.max_in_flight == concurrency
+    assert pool.enqueued == list(range(1, 8))
+    assert pool.in_flight == 0
+    # the failed update didn't cancel the others
+    logger.critical.assert_called_once_with(
+        "Updating job job_2 failed with 'Valhalla is gone'", extra={"user": "", "job_id": 2}
+    )
+    assert logger.warning.call_args.args[0].startswith("Updated 6 of 7 packages")
@@ -0,0 +1,136 @@
+import json
+import re
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from routing_packager_app.middlewares import GZipMiddleware
+from routing_packager_app.utils.download_utils import (
+    accepts_encoding,
+    etag_matches,
+    open_package,
+    parse_ranges,
+)
+
+CONTENT = bytes(range(256)) * 64
+
+
+@pytest.fixture(scope="function")
+def client(tmp_path):
+    zip_path = tmp_path.joinpath("test.zip")
+    zip_path.write_bytes(CONTENT)
+    zip_path.with_suffix(".json").write_text(
+        json.dumps({
+            "last_modified": "2024-05-01 12:00:00.123456+00:00",
+            "build_id": "abc",
+            "fingerprint": "def",
+        })
+    )
+
+    async def download(request):
+        return open_package(zip_path)
+
+    app = Starlette(routes=[Route("/package", download, methods=["GET", "HEAD"])])
+    app.add_middleware(GZipMiddleware, minimum_size=10, exclude_paths=[r"/package"])
+    yield TestClient(app)
+
+
+@pytest.mark.parametrize(
+    "http_range,expected",
+    (
+        ("bytes=0-99", [(0, 100)]),
+        ("bytes=100-", [(100, 1000)]),
+        ("bytes=-100", [(900, 1000)]),
+        ("bytes=0-5000", [(0, 1000)]),
+        # sorted and coalesced
+        ("bytes=500-599, 0-99, 50-149, 600-", [(0, 150), (500, 1000)]),
+        ("bytes=1000-", []),
+        ("bytes=5-1", None),
+        ("items=0-99", None),
+        ("bytes=a-b", None),
+    ),
+)
+def test_parse_ranges(http_range, expected):
+    assert parse_ranges(http_range, 1000) == expected
+
+
+@pytest.mark.parametrize(
+    "if_none_match, expected",
+    [
+        ('"abc-1"', True),
+        ('W/"abc-1"', True),
+        ('"def", "abc-1"', True),
+        ("*", True),
+        ('"abc-10"', False),
+        ('"abc-1-2", "xabc-1"', False),
+        ("", False),
+    ],
+)
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, '"abc-1"') is expected
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        ("gzip", True),
+        ("deflate, GZIP;q=0.5", True),
+        ("br, *", True),
+        ("gzip;q=0", False),
+        ("gzip; q=0.000, *", False),
+        ("*;q=0", False),
+        ("x-gzip", True),
+        ("gzipped", False),
+        ("gzip;q=abc", False),
+        ("", False),
+    ],
+)
+def test_accepts_encoding(accept_encoding, expected):
+    assert accepts_encoding(accept_encoding, "gzip") is expected
+
+
+def test_download(client):
+    res = client.get("/package", headers={"Accept-Encoding": "gzip"})
+    assert res.status_code == 200
+    assert res.content == CONTENT
+    assert "content-encoding" not in res.headers
+    assert res.headers["content-type"] == "application/zip"
+    assert res.headers["last-modified"] == "Wed, 01 May 2024 12:00:00 GMT"
+
+    etag = res.headers["etag"]
+    assert client.get("/package", headers={"If-None-Match": etag}).status_code == 304
+    last_modified = res.headers["last-modified"]
+    assert client.get("/package", headers={"If-Modified-Since": last_modified}).status_code == 304
+
+    res = client.head("/package")
+    assert res.status_code == 200 and res.headers["content-length"] == str(len(CONTENT))
+    assert not res.content
+
+
+def test_download_ranges(client):
+    res = client.get("/package", headers={"Range": "bytes=100-199"})
+    assert res.status_code == 206
+    assert res.content == CONTENT[100:200]
+    assert res.headers["content-range"] == f"bytes 100-199/{len(CONTENT)}"
+
+    # a resumed download of a changed package gets the whole package
+    res = client.get("/package", headers={"Range": "bytes=100-", "If-Range": '"other"'})
+    assert res.status_code == 200 and res.content == CONTENT
+    etag = client.head("/package").headers["etag"]
+    res = client.get("/package", headers={"Range": "bytes=100-", "If-Range": etag})
+    assert res.status_code == 206 and res.content == CONTENT[100:]
+
+    res = client.get("/package", headers={"Range": f"bytes={len(CONTENT)}-"})
+    assert res.status_code == 416
+    assert res.headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+    res = client.get("/package", headers={"Range": "bytes=0-9,-10"})
+    assert res.status_code == 206
+    boundary = re.fullmatch(r"multipart/byteranges; boundary=(\w+)", res.headers["content-type"])[1]
+    assert len(res.content) == int(res.headers["content-length"])
+    parts = res.content.split(f"--{boundary}".encode())
+    assert parts[0] == b"" and parts[-1] == b"--\r\n"
+    assert parts[1].endswith(b"\r\n\r\n" + CONTENT[:10] + b"\r\n")
+    assert parts[2].endswith(b"\r\n\r\n" + CONTENT[-10:] + b"\r\n")
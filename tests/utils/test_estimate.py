@@ -0,0 +1,38 @@
+import pytest
+
+from routing_packager_app import SETTINGS
+from routing_packager_app.api_v1.dependencies import split_bbox
+from routing_packager_app.utils.estimate_utils import estimate_package
+from routing_packager_app.utils.tile_manifest import get_manifest, write_manifest
+from routing_packager_app.utils.valhalla_utils import write_active_build
+
+
+@pytest.fixture(scope="function")
+def active_dir(tmp_path, tile_dir, monkeypatch):
+    monkeypatch.setattr(SETTINGS, "TMP_DATA_DIR", tmp_path)
+    monkeypatch.setattr(SETTINGS, "VALHALLA_URL", "http://localhost:1")
+    write_manifest(tile_dir)
+    write_active_build(tile_dir, 8002, get_manifest(tile_dir).build_id)
+    yield tile_dir
+
+
+def test_estimate_package(active_dir, monkeypatch):
+    bbox = split_bbox("1.486630,42.608695,1.534706,42.646334")
+    estimate = estimate_package(bbox, (0.5, 1000))
+    assert estimate["tiles"] > 0
+    assert estimate["zip_size"] == round(estimate["raw_size"] * 0.5)
+    assert estimate["duration"] == estimate["raw_size"] / 1000
+    assert estimate["build_id"] == get_manifest(active_dir).build_id
+    assert estimate["admitted"]
+
+    monkeypatch.setattr(SETTINGS, "MAX_JOB_BYTES", 1)
+    assert not estimate_package(bbox)["admitted"]
+
+    # no tiles at all in Switzerland
+    assert estimate_package(split_bbox("5.9559,45.818,10.4921,47.8084"))["raw_size"] == 0
+
+
+def test_estimate_no_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(SETTINGS, "TMP_DATA_DIR", tmp_path)
+    monkeypatch.setattr(SETTINGS, "VALHALLA_URL", "http://localhost:1")
+    assert estimate_package(split_bbox("1.5,42.5,1.75,42.75")) is None
@@ -0,0 +1,238 @@
+import os
+import sys
+import tarfile
+import zlib
+from threading import Event
+from unittest.mock import patch
+from zipfile import ZipFile
+
+import pytest
+
+from routing_packager_app import SETTINGS
+from routing_packager_app.utils.file_utils import (
+    RAW_WRITE_VERSIONS,
+    TILE_EXTRACT_ALIGNMENT,
+    TILE_EXTRACT_INDEX_NAME,
+    ZipCancelled,
+    _can_write_raw,
+    _get_deflate_pool,
+    compress_zstd,
+    deflate_file,
+    make_tile_extract,
+    make_tmp_path,
+    make_zip,
+    read_tile_extract_index,
+    remove_tmp_files,
+)
+from routing_packager_app.utils.tile_cache import ENTRY_HEADER, TileCache
+from routing_packager_app.utils.tile_manifest import (
+    TileManifest,
+    get_manifest,
+    hash_tile,
+    write_manifest,
+)
+
+ANDORRA_TILES = SETTINGS.get_data_dir().joinpath("andorra_tiles").resolve()
+
+
+@pytest.mark.parametrize("workers", (2, 4))
+def test_make_zip_parallel(tmp_path, workers):
+    tile_paths = set(ANDORRA_TILES.rglob("*.gph"))
+    serial_fp = tmp_path.joinpath("serial.zip")
+    parallel_fp = tmp_path.joinpath("parallel.zip")
+
+    make_zip(tile_paths, ANDORRA_TILES, str(serial_fp))
+    make_zip(tile_paths, ANDORRA_TILES, str(parallel_fp), workers=workers)
+
+    assert serial_fp.read_bytes() == parallel_fp.read_bytes()
+    with ZipFile(parallel_fp) as archive:
+        assert archive.testzip() is None
+        assert len(archive.namelist()) == len(tile_paths)
+        for tile_path in tile_paths:
+            arcname = "valhalla_tiles/" + str(tile_path.relative_to(ANDORRA_TILES))
+            assert archive.read(arcname) == tile_path.read_bytes()
+
+    # the next package reuses the process pool
+    pool = _get_deflate_pool(workers)
+    make_zip(tile_paths, ANDORRA_TILES, str(tmp_path.joinpath("next.zip")), workers=workers)
+    assert _get_deflate_pool(workers) is pool
+
+
+def test_write_deflated_fallback(tmp_path):
+    tile_paths = set(ANDORRA_TILES.rglob("*.gph"))
+    serial_fp = tmp_path.joinpath("serial.zip")
+    fallback_fp = tmp_path.joinpath("fallback.zip")
+    make_zip(tile_paths, ANDORRA_TILES, str(serial_fp))
+
+    with ZipFile(fallback_fp, "w") as archive:
+        # the supported versions write the raw stream, the others recompress it
+        assert _can_write_raw(archive) == (
+            RAW_WRITE_VERSIONS[0] <= sys.version_info[:2] <= RAW_WRITE_VERSIONS[1]
+        )
+    with patch("routing_packager_app.utils.file_utils.RAW_WRITE_VERSIONS", ((0, 0), (0, 0))):
+        make_zip(tile_paths, ANDORRA_TILES, str(fallback_fp), workers=2)
+
+    assert serial_fp.read_bytes() == fallback_fp.read_bytes()
+
+
+def test_make_zip_cache(tmp_path, tile_dir):
+    write_manifest(tile_dir)
+    tile_paths = set(tile_dir.rglob("*.gph"))
+    cache = TileCache(tile_dir, get_manifest(tile_dir), 10 * 1024**2)
+
+    serial_fp = tmp_path.joinpath("serial.zip")
+    make_zip(tile_paths, tile_dir, str(serial_fp))
+    for idx in range(2):
+        cached_fp = tmp_path.joinpath(f"cached_{idx}.zip")
+        make_zip(tile_paths, tile_dir, str(cached_fp), cache=cache)
+        assert cached_fp.read_bytes() == serial_fp.read_bytes()
+        assert all(cache.contains(p) for p in tile_paths)
+
+    # the entries keep the CRC and size next to the raw deflate stream
+    some_tile = sorted(tile_paths)[0]
+    crc, file_size, data = cache.get(some_tile)
+    assert crc == hash_tile(some_tile)[0]
+    assert file_size == some_tile.stat().st_size
+    assert zlib.decompress(data, -15) == some_tile.read_bytes()
+
+
+def test_tile_cache_evict(tmp_path, tile_dir):
+    write_manifest(tile_dir)
+    tile_paths = sorted(tile_dir.rglob("*.gph"))
+    cache = TileCache(tile_dir, get_manifest(tile_dir), 0)
+    make_zip(set(tile_paths), tile_dir, str(tmp_path.joinpath("test.zip")), cache=cache)
+
+    # the most recently used entry survives
+    last_size = len(cache.get(tile_paths[-1])[2]) + ENTRY_HEADER.size
+    cache.max_bytes = last_size
+    assert cache.evict() == len(tile_paths) - 1
+    assert cache.contains(tile_paths[-1])
+    assert not any(cache.contains(p) for p in tile_paths[:-1])
+
+    # a new build invalidates the cache
+    # jobs of both builds run on their own snapshot, get_manifest would unmap the old manifest
+    new_cache = TileCache(tile_dir, TileManifest(write_manifest(tile_dir)), 10 * 1024**2)
+    assert not new_cache.contains(tile_paths[-1])
+    assert not cache.cache_dir.exists()
+
+    # a job of the old build keeps going without caching
+    cache.put(tile_paths[0], *deflate_file(tile_paths[0]))
+    assert cache.get(tile_paths[0]) is None
+    new_cache.put(tile_paths[0], *deflate_file(tile_paths[0]))
+    assert new_cache.contains(tile_paths[0])
+
+
+def test_make_zip_incremental(tmp_path, tile_dir):
+    tile_paths = sorted(tile_dir.rglob("*.gph"))
+    zip_fp = tmp_path.joinpath("test.zip")
+    write_manifest(tile_dir)
+    previous_hashes = {entry.path: f"{entry.hash:016x}" for entry in get_manifest(tile_dir)}
+    make_zip(set(tile_paths), tile_dir, str(zip_fp))
+
+    # change a tile and drop another one for the new build
+    changed_tile = tile_paths[0]
+    changed_tile.write_bytes(changed_tile.read_bytes()[::-1])
+    tile_paths[1].unlink()
+    tile_paths = tile_paths[:1] + tile_paths[2:]
+    write_manifest(tile_dir)
+    # same CRC32 and size, but another content hash
+    collided_tile = tile_paths[-1]
+    previous_hashes[str(collided_tile.relative_to(tile_dir))] = "0" * 16
+
+    with patch("routing_packager_app.utils.file_utils.deflate_file", wraps=deflate_file) as deflate:
+        manifest = get_manifest(tile_dir)
+        make_zip(
+            set(tile_paths),
+            tile_dir,
+            str(zip_fp),
+            manifest=manifest,
+            previous_fp=str(zip_fp),
+            previous_hashes=previous_hashes,
+        )
+        assert sorted(c.args[0] for c in deflate.call_args_list) == [changed_tile, collided_tile]
+
+    full_fp = tmp_path.joinpath("full.zip")
+    make_zip(set(tile_paths), tile_dir, str(full_fp))
+    assert zip_fp.read_bytes() == full_fp.read_bytes()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_make_zip_cancel(tmp_path, workers):
+    out_fp = tmp_path.joinpath("cancelled.zip")
+    cancel = Event()
+    cancel.set()
+
+    with pytest.raises(ZipCancelled):
+        make_zip(set(ANDORRA_TILES.rglob("*.gph")), ANDORRA_TILES, str(out_fp), workers, cancel=cancel)
+
+    # neither the package nor its temporary file are left behind
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_make_zip_progress(tmp_path, workers):
+    tile_paths = set(ANDORRA_TILES.rglob("*.gph"))
+    out_fp = tmp_path.joinpath("progress.zip")
+    reports = list()
+
+    make_zip(tile_paths, ANDORRA_TILES, str(out_fp), workers, progress=reports.append)
+
+    assert [r.tiles_done for r in reports] == list(range(1, len(tile_paths) + 1))
+    assert all(r.tiles_total == len(tile_paths) for r in reports)
+    assert reports[-1].bytes_read == sum(p.stat().st_size for p in tile_paths)
+    # the central directory comes after the last member
+    assert reports[-1].bytes_written < out_fp.stat().st_size
+    assert all(a.bytes_written < b.bytes_written for a, b in zip(reports, reports[1:]))
+
+
+def test_make_tile_extract(tmp_path, tile_dir):
+    write_manifest(tile_dir)
+    entries = list(get_manifest(tile_dir))
+    tar_fp = tmp_path.joinpath("test.tar")
+
+    assert make_tile_extract(entries, tile_dir, str(tar_fp)) == tar_fp.stat().st_size
+
+    # Valhalla reads the index first and then maps the tiles at their offsets
+    with tarfile.open(tar_fp) as archive:
+        assert archive.getnames()[0] == TILE_EXTRACT_INDEX_NAME
+        assert {e.path for e in entries} <= set(archive.getnames())
+    tar_bytes = tar_fp.read_bytes()
+    index = read_tile_extract_index(str(tar_fp))
+    assert len(index) == len(entries)
+    for (offset, graph_id, size), entry in zip(index, entries):
+        assert offset % TILE_EXTRACT_ALIGNMENT == 0
+        assert (graph_id & 0x7, graph_id >> 3) == (entry.level, entry.tile_id)
+        assert tar_bytes[offset : offset + size] == tile_dir.joinpath(entry.path).read_bytes()
+
+    # the tiles changed since the manifest was written
+    tile_dir.joinpath(entries[0].path).write_bytes(b"changed")
+    with pytest.raises(ValueError):
+        make_tile_extract(entries, tile_dir, str(tar_fp))
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_make_tmp_path(tmp_path):
+    out_fp = str(tmp_path.joinpath("test.zip"))
+    # e.g. two updates of the same package
+    tmp_fps = {make_tmp_path(out_fp), make_tmp_path(out_fp)}
+    assert len(tmp_fps) == 2
+    for tmp_fp in tmp_fps:
+        assert os.path.dirname(tmp_fp) == str(tmp_path)
+        assert os.path.basename(tmp_fp).startswith(".test.zip.") and tmp_fp.endswith(".tmp")
+        assert os.stat(tmp_fp).st_mode & 0o777 == 0o644
+
+    tmp_path.joinpath("manifests").mkdir()
+    make_tmp_path(str(tmp_path.joinpath("manifests", "abc.json")))
+    assert remove_tmp_files(tmp_path) == 3
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_compress_zstd(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    in_fp = tmp_path.joinpath("test.tar")
+    in_fp.write_bytes(b"tiles" * 1000)
+    out_fp = tmp_path.joinpath("test.tar.zst")
+
+    assert compress_zstd(str(in_fp), str(out_fp), 3) == out_fp.stat().st_size
+    assert zstandard.ZstdDecompressor().decompress(out_fp.read_bytes()) == in_fp.read_bytes()
@@ -0,0 +1,21 @@
+import pytest
+
+from routing_packager_app.utils.lease_utils import read_lease, write_lease
+
+
+def test_read_leases_shared(tmp_path):
+    with read_lease(tmp_path), read_lease(tmp_path, timeout=0):
+        pass
+
+
+def test_write_lease_waits_for_readers(tmp_path):
+    with read_lease(tmp_path):
+        with pytest.raises(TimeoutError):
+            with write_lease(tmp_path, timeout=0):
+                pass
+
+    # the reader returned its lease
+    with write_lease(tmp_path, timeout=0):
+        with pytest.raises(TimeoutError):
+            with read_lease(tmp_path, timeout=0):
+                pass
@@ -0,0 +1,180 @@
+import gzip
+import json
+import zlib
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import pytest
+
+from routing_packager_app.utils.file_utils import gzip_deflated, make_zip
+from routing_packager_app.utils.package_manifest import (
+    DELTA_INFO_NAME,
+    KEEP_PACKAGE_MANIFESTS,
+    TILES_PREFIX,
+    diff_package_manifests,
+    find_package_tile,
+    get_package_delta_path,
+    get_package_manifests_dir,
+    make_package_manifest,
+    read_package_manifest,
+    read_package_tile,
+    write_package_delta,
+    write_package_manifest,
+)
+from routing_packager_app.utils.tile_manifest import get_manifest, hash_tile, write_manifest
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_package_manifest(tmp_path, tile_dir, workers):
+    write_manifest(tile_dir)
+    tile_manifest = get_manifest(tile_dir)
+    tile_paths = set(tile_dir.rglob("*.gph"))
+    zip_path = tmp_path.joinpath("test.zip")
+    members = make_zip(tile_paths, tile_dir, str(zip_path), workers=workers)
+    manifest = make_package_manifest(members, tile_manifest)
+    assert manifest["build_id"] == tile_manifest.build_id
+
+    # the same as reading the finished ZIP's central directory
+    with ZipFile(zip_path) as archive:
+        assert make_package_manifest(archive.infolist(), tile_manifest, zip_path) == manifest
+
+    assert len(manifest["tiles"]) == len(tile_paths)
+    zip_bytes = zip_path.read_bytes()
+    for tile in manifest["tiles"]:
+        tile_path = tile_dir.joinpath(tile["path"])
+        tile_bytes = tile_path.read_bytes()
+        assert tile["size"] == len(tile_bytes) and tile["crc32"] == zlib.crc32(tile_bytes)
+        assert tile["hash"] == f"{hash_tile(tile_path)[1]:016x}"
+        # clients can fetch a single tile with a range request into the ZIP
+        data = zip_bytes[tile["offset"] : tile["offset"] + tile["compressed_size"]]
+        assert zlib.decompress(data, -15) == tile_bytes
+
+    write_package_manifest(zip_path, manifest)
+    assert read_package_manifest(zip_path, tile_manifest.build_id) == manifest
+    assert read_package_manifest(zip_path, "def") is None
+    assert read_package_manifest(zip_path, "../abc") is None
+
+
+def test_package_manifest_zip64_offsets(tmp_path, tile_dir):
+    write_manifest(tile_dir)
+    tile_paths = sorted(tile_dir.rglob("*.gph"))[:3]
+    zip_path = tmp_path.joinpath("test.zip")
+    with open(zip_path, "wb") as f:
+        # a sparse prefix puts the members beyond 4 GiB, the central directory then has zip64
+        #   offsets, which their local headers don't
+        f.seek(5 * 1024**3)
+        with ZipFile(f, "w", ZIP_DEFLATED) as archive:
+            for tile_path in tile_paths:
+                archive.write(tile_path, TILES_PREFIX + str(tile_path.relative_to(tile_dir)))
+
+    with ZipFile(zip_path) as archive:
+        members = archive.infolist()
+    assert all(zinfo.header_offset > 4 * 1024**3 for zinfo in members)
+    manifest = make_package_manifest(members, get_manifest(tile_dir), zip_path)
+    with open(zip_path, "rb") as f:
+        for tile, tile_path in zip(manifest["tiles"], tile_paths):
+            f.seek(tile["offset"])
+            assert zlib.decompress(f.read(tile["compressed_size"]), -15) == tile_path.read_bytes()
+
+
+def test_package_manifest_diff(tmp_path):
+    def tile(path, crc32, hash_="0"):
+        return {
+            "path": path,
+            "size": 10,
+            "crc32": crc32,
+            "hash": hash_,
+            "offset": 0,
+            "compressed_size": 5,
+        }
+
+    old = {
+        "build_id": "a",
+        "tiles": [tile("0/1.gph", 1), tile("1/2.gph", 2), tile("2/3.gph", 3), tile("2/5.gph", 5)],
+    }
+    new = {
+        "build_id": "b",
+        "tiles": [tile("0/1.gph", 1), tile("1/2.gph", 5), tile("2/4.gph", 4), tile("2/5.gph", 5, "1")],
+    }
+    diff = diff_package_manifests(old, new)
+
+    assert (diff["from_build_id"], diff["to_build_id"]) == ("a", "b")
+    assert diff["added"] == [tile("2/4.gph", 4)]
+    # the CRC32 collided
+    assert diff["changed"] == [tile("1/2.gph", 5), tile("2/5.gph", 5, "1")]
+    assert diff["removed"] == ["2/3.gph"]
+
+
+def test_package_delta(tmp_path, tile_dir):
+    write_manifest(tile_dir)
+    tile_paths = sorted(tile_dir.rglob("*.gph"))
+    changed_path, removed_path, added_path = tile_paths[0], tile_paths[1], tile_paths[-1]
+    zip_path = tmp_path.joinpath("test.zip")
+
+    old_members = make_zip(set(tile_paths[:-1]), tile_dir, str(zip_path))
+    old = make_package_manifest(old_members, get_manifest(tile_dir))
+    changed_path.write_bytes(changed_path.read_bytes() + b"changed")
+    write_manifest(tile_dir)
+    new_paths = set(tile_paths) - {removed_path}
+    new = make_package_manifest(make_zip(new_paths, tile_dir, str(zip_path)), get_manifest(tile_dir))
+
+    delta_size = write_package_delta(zip_path, old, new)
+    delta_path = get_package_delta_path(zip_path)
+    assert delta_path.name == "test.delta.zip"
+    assert delta_size == delta_path.stat().st_size < zip_path.stat().st_size
+
+    def arcname(p):
+        return TILES_PREFIX + str(p.relative_to(tile_dir))
+
+    with ZipFile(delta_path) as delta:
+        assert delta.testzip() is None
+        assert sorted(delta.namelist()) == sorted([
+            arcname(changed_path),
+            arcname(added_path),
+            DELTA_INFO_NAME,
+        ])
+        assert delta.read(arcname(changed_path)) == changed_path.read_bytes()
+        info = json.loads(delta.read(DELTA_INFO_NAME))
+    assert info == {
+        "from_build_id": old["build_id"],
+        "to_build_id": new["build_id"],
+        "removed": [str(removed_path.relative_to(tile_dir))],
+    }
+
+
+def test_package_manifest_prune(tmp_path):
+    zip_path = tmp_path.joinpath("test.zip")
+    for build in range(KEEP_PACKAGE_MANIFESTS + 2):
+        write_package_manifest(zip_path, {"build_id": f"build{build}", "tiles": []})
+
+    manifest_paths = list(get_package_manifests_dir(zip_path).glob("*.json"))
+    assert len(manifest_paths) == KEEP_PACKAGE_MANIFESTS
+    assert read_package_manifest(zip_path, "build0") is None
+    assert read_package_manifest(zip_path, f"build{KEEP_PACKAGE_MANIFESTS + 1}") is not None
+
+
+def test_package_tile(tmp_path, tile_dir):
+    write_manifest(tile_dir)
+    tile_paths = sorted(tile_dir.rglob("*.gph"))
+    zip_path = tmp_path.joinpath("test.zip")
+    tile_manifest = get_manifest(tile_dir)
+    build_id = tile_manifest.build_id
+    write_package_manifest(
+        zip_path,
+        make_package_manifest(make_zip(set(tile_paths), tile_dir, str(zip_path)), tile_manifest),
+    )
+
+    tile_path = str(tile_paths[-1].relative_to(tile_dir))
+    tile = find_package_tile(zip_path, build_id, tile_path)
+    assert tile["path"] == tile_path
+    assert find_package_tile(zip_path, "def", tile_path) is None
+    assert find_package_tile(zip_path, build_id, "0/000/000.gph") is None
+
+    data = read_package_tile(zip_path, tile)
+    assert (
+        gzip.decompress(gzip_deflated(data, tile["crc32"], tile["size"])) == tile_paths[-1].read_bytes()
+    )
+
+    # the package was rebuilt without the tile
+    make_zip(set(tile_paths[:-1]), tile_dir, str(zip_path))
+    with pytest.raises(ValueError):
+        read_package_tile(zip_path, tile)
@@ -0,0 +1,19 @@
+from routing_packager_app import SETTINGS
+from routing_packager_app.constants import Queues
+from routing_packager_app.utils.queue_utils import choose_queue, get_queue_name
+
+
+def test_choose_queue(monkeypatch):
+    monkeypatch.setattr(SETTINGS, "INTERACTIVE_MAX_BYTES", 100)
+    interactive, bulk = get_queue_name(Queues.INTERACTIVE), get_queue_name(Queues.BULK)
+    assert interactive != bulk
+
+    assert choose_queue(100) == interactive
+    assert choose_queue(101) == bulk
+    # without an estimate, e.g. no active Valhalla build
+    assert choose_queue(None) == interactive
+    # package updates never compete with new packages
+    assert choose_queue(1, scheduled=True) == bulk
+
+    monkeypatch.setattr(SETTINGS, "INTERACTIVE_MAX_BYTES", 0)
+    assert choose_queue(10**12) == interactive
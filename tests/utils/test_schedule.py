@@ -0,0 +1,26 @@
+import pytest
+
+from routing_packager_app.utils.schedule_utils import estimate_makespan, sort_longest_first
+
+
+def test_sort_longest_first():
+    jobs = ["small", "huge", "medium"]
+    sizes = {"small": 1, "huge": 100, "medium": 10}
+
+    assert sort_longest_first(jobs, sizes.get) == [(100, "huge"), (10, "medium"), (1, "small")]
+
+
+@pytest.mark.parametrize(
+    "costs,workers,expected",
+    [
+        ([], 2, 0),
+        ([5, 3, 2], 1, 10),
+        ([5, 3, 2], 2, 5),
+        ([5, 3, 2], 10, 5),
+        # shortest first leaves the biggest job to the end
+        ([1, 1, 1, 1, 4], 2, 6),
+        ([4, 1, 1, 1, 1], 2, 4),
+    ],
+)
+def test_estimate_makespan(costs, workers, expected):
+    assert estimate_makespan(costs, workers) == expected
@@ -0,0 +1,40 @@
+import shutil
+
+from routing_packager_app.utils.snapshot_utils import collect_snapshots, make_snapshot, pin_snapshot
+from routing_packager_app.utils.tile_manifest import MANIFEST_NAME, get_manifest, write_manifest
+
+
+def test_snapshot_survives_rebuild(tile_dir, tmp_path):
+    snapshots_dir = tmp_path.joinpath("snapshots")
+    tile_paths = sorted(p.relative_to(tile_dir) for p in tile_dir.rglob("*.gph"))
+    contents = {p: tile_dir.joinpath(p).read_bytes() for p in tile_paths}
+    write_manifest(tile_dir)
+
+    with pin_snapshot(tile_dir, snapshots_dir) as snapshot_dir:
+        assert snapshot_dir.name == get_manifest(tile_dir).build_id
+        # the build loop recycles the directory while the snapshot is pinned
+        for level in ("0", "1", "2"):
+            shutil.rmtree(tile_dir.joinpath(level))
+        assert collect_snapshots(snapshots_dir, keep=set()) == 0
+
+        assert snapshot_dir.joinpath(MANIFEST_NAME).is_file()
+        for p in tile_paths:
+            assert snapshot_dir.joinpath(p).read_bytes() == contents[p]
+
+    # nobody pins the old build anymore
+    assert collect_snapshots(snapshots_dir, keep=set()) == 1
+    assert not snapshot_dir.exists()
+
+
+def test_snapshot_per_build(tile_dir, tmp_path):
+    snapshots_dir = tmp_path.joinpath("snapshots")
+    write_manifest(tile_dir)
+    first = make_snapshot(tile_dir, snapshots_dir)
+    assert make_snapshot(tile_dir, snapshots_dir) == first
+
+    write_manifest(tile_dir)
+    second = make_snapshot(tile_dir, snapshots_dir)
+    assert second != first
+
+    assert collect_snapshots(snapshots_dir, keep={second.name}) == 1
+    assert [p.name for p in snapshots_dir.iterdir() if p.is_dir()] == [second.name]
@@ -0,0 +1,106 @@
+import gc
+import os
+import weakref
+from shutil import copytree
+
+import pytest
+
+from routing_packager_app.api_v1.dependencies import split_bbox
+from routing_packager_app.utils.tile_manifest import (
+    MANIFEST_NAME,
+    MAX_CACHED_MANIFESTS,
+    get_fingerprint,
+    get_manifest,
+    hash_tile,
+    write_manifest,
+)
+from routing_packager_app.utils.valhalla_utils import get_tiles_in_bbox
+
+
+def test_write_manifest(tile_dir):
+    manifest_path = write_manifest(tile_dir)
+    assert manifest_path == tile_dir.joinpath(MANIFEST_NAME)
+
+    manifest = get_manifest(tile_dir)
+    tile_paths = sorted(tile_dir.rglob("*.gph"))
+    assert len(manifest) == len(tile_paths) == 7
+    assert sorted(tile_dir.joinpath(entry.path) for entry in manifest) == tile_paths
+
+    for entry in manifest:
+        tile_path = tile_dir.joinpath(entry.path)
+        assert entry.size == tile_path.stat().st_size
+        assert entry.mtime_ns == tile_path.stat().st_mtime_ns
+        assert (entry.crc32, entry.hash) == hash_tile(tile_path)
+
+    assert manifest.find(2, 763926).path == "2/000/763/926.gph"
+    assert manifest.find(2, 763928) is None
+
+
+@pytest.mark.parametrize(
+    "bbox",
+    (
+        "1.486630,42.608695,1.534706,42.646334",
+        "1.5,42.5,1.75,42.75",
+        "1.6,42.4,1.61,42.41",
+        "5.9559,45.818,10.4921,47.8084",
+    ),
+)
+def test_manifest_tiles_in_bbox(tile_dir, bbox):
+    write_manifest(tile_dir)
+    manifest = get_manifest(tile_dir)
+    tile_paths = {tile_dir.joinpath(entry.path) for entry in manifest.get_tiles(split_bbox(bbox))}
+
+    assert tile_paths == get_tiles_in_bbox(split_bbox(bbox), tile_dir)
+
+
+def test_manifest_cache(tile_dir, tmp_path):
+    # only cli.py manifest writes it, not the first request or job
+    assert get_manifest(tile_dir) is None
+    assert not tile_dir.joinpath(MANIFEST_NAME).exists()
+
+    write_manifest(tile_dir)
+    manifest = get_manifest(tile_dir)
+    assert get_manifest(tile_dir) is manifest
+
+    # a new build writes a new manifest, the old one stays usable while it's referenced
+    bbox = split_bbox("1.5,42.5,1.75,42.75")
+    tiles = manifest.get_tiles(bbox)
+    write_manifest(tile_dir)
+    new_manifest = get_manifest(tile_dir)
+    assert new_manifest is not manifest
+    assert new_manifest.build_id != manifest.build_id
+    assert manifest.get_tiles(bbox) == tiles
+    # and unmapped once it isn't anymore
+    manifest_ref = weakref.ref(manifest)
+    del manifest
+    gc.collect()
+    assert manifest_ref() is None
+
+    # the least recently used manifests are dropped, too
+    for idx in range(MAX_CACHED_MANIFESTS):
+        other_dir = tmp_path.joinpath(f"other_{idx}")
+        copytree(tile_dir, other_dir)
+        write_manifest(other_dir)
+        get_manifest(other_dir)
+    assert get_manifest(tile_dir) is not new_manifest
+    assert new_manifest.get_tiles(bbox) == tiles
+
+
+def test_manifest_no_tiles(tmp_path):
+    assert get_manifest(tmp_path) is None
+    assert not os.listdir(tmp_path)
+
+
+def test_fingerprint(tile_dir):
+    write_manifest(tile_dir)
+    entries = get_manifest(tile_dir).get_tiles(split_bbox("1.5,42.5,1.75,42.75"))
+    fingerprint = get_fingerprint(entries)
+    assert fingerprint == get_fingerprint(reversed(entries))
+    assert fingerprint != get_fingerprint(entries[1:])
+
+    # changing a tile's content changes the fingerprint
+    changed_tile = tile_dir.joinpath(entries[0].path)
+    changed_tile.write_bytes(changed_tile.read_bytes()[::-1])
+    write_manifest(tile_dir)
+    new_entries = get_manifest(tile_dir).get_tiles(split_bbox("1.5,42.5,1.75,42.75"))
+    assert get_fingerprint(new_entries) != fingerprint
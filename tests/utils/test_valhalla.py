@@ -1,9 +1,26 @@
 import os
 from math import floor
 from pathlib import Path
+from shutil import copytree
+from unittest.mock import patch
 
+import pytest
+
+from routing_packager_app import SETTINGS
 from routing_packager_app.api_v1.dependencies import split_bbox
-from routing_packager_app.utils.valhalla_utils import TILE_SIZES, get_tiles_with_bbox
+from routing_packager_app.utils.valhalla_utils import (
+    TILE_SIZES,
+    get_current_valhalla_dir,
+    get_tile_level_id,
+    get_tile_path,
+    get_tiles_in_bbox,
+    get_tiles_with_bbox,
+    read_active_build,
+    write_active_build,
+)
+from routing_packager_app.utils.tile_manifest import MANIFEST_NAME, get_manifest, write_manifest
+
+ANDORRA_TILES = SETTINGS.get_data_dir().joinpath("andorra_tiles").resolve()
 
 TAR_PATH_LENGTHS = [6, 6, 9]  # how many leading 0's do we need as tar file name?
 
@@ -13,9 +30,9 @@ def tile_base_to_path(base_x: int | float, base_y: int | float, level: int, fake
     tile_size = TILE_SIZES[level]
 
     # assert we got no bogus tile base..
-    assert (base_x + 180) % tile_size == 0 and (
-        base_y + 90
-    ) % tile_size == 0, f"{base_x}, {base_y} on level {level} failed"
+    assert (base_x + 180) % tile_size == 0 and (base_y + 90) % tile_size == 0, (
+        f"{base_x}, {base_y} on level {level} failed"
+    )
 
     row = floor((base_y + 90) / tile_size)
     col = floor((base_x + 180) / tile_size)
@@ -66,3 +83,63 @@ def test_tile_intersects_bbox():
     ]
     out_paths = get_tiles_with_bbox(input_paths, split_bbox(bbox), tile_dir)
     assert out_paths == set()
+
+
+def test_tile_path():
+    for tile_path in ANDORRA_TILES.rglob("*.gph"):
+        rel_path = str(tile_path.relative_to(ANDORRA_TILES))
+        level, tile_id = [int(x.replace("/", "")) for x in get_tile_level_id(rel_path)]
+        assert get_tile_path(level, tile_id) == rel_path
+
+
+@pytest.mark.parametrize(
+    "bbox",
+    (
+        "1.486630,42.608695,1.534706,42.646334",  # the usual test bbox
+        "1.5,42.5,1.75,42.75",  # exactly on level 2 tile edges
+        "1.0,42.0,1.25,42.5",  # touching tiles from the outside
+        "1.6,42.4,1.61,42.41",  # within a single level 2 tile
+        "0,0,2,2",  # level 0 & 1 tiles only
+        "5.9559,45.818,10.4921,47.8084",  # no tiles at all
+        "-180,-90,180,90",  # the whole world
+    ),
+)
+def test_tiles_in_bbox_equals_scan(bbox):
+    all_tiles = sorted(ANDORRA_TILES.rglob("*.gph"))
+    expected = get_tiles_with_bbox(all_tiles, split_bbox(bbox), ANDORRA_TILES)
+
+    assert get_tiles_in_bbox(split_bbox(bbox), ANDORRA_TILES) == expected
+
+
+def test_active_build(tmp_path, tile_dir, monkeypatch):
+    monkeypatch.setattr(SETTINGS, "TMP_DATA_DIR", tmp_path)
+    # neither a descriptor nor a service
+    monkeypatch.setattr(SETTINGS, "VALHALLA_URL", "http://localhost:1")
+    assert read_active_build() is None
+    assert get_current_valhalla_dir() is None
+
+    write_manifest(tile_dir)
+    build_id = get_manifest(tile_dir).build_id
+    write_active_build(tile_dir, 8003, build_id)
+    assert read_active_build()["build_id"] == build_id
+    assert get_current_valhalla_dir() == tile_dir.resolve()
+
+    # the next build replaces the descriptor
+    valhalla_dir = SETTINGS.get_valhalla_path(8002)
+    copytree(tile_dir, valhalla_dir, dirs_exist_ok=True)
+    write_manifest(valhalla_dir)
+    write_active_build(valhalla_dir, 8002, get_manifest(valhalla_dir).build_id)
+    assert read_active_build()["port"] == 8002
+    assert get_current_valhalla_dir() == valhalla_dir.resolve()
+
+    # the build loop restarted and is rebuilding the descriptor's directory
+    valhalla_dir.joinpath(MANIFEST_NAME).unlink()
+    assert get_current_valhalla_dir() is None
+    write_manifest(valhalla_dir)
+    assert get_current_valhalla_dir() is None
+
+    # a descriptor without a build ID is only trusted while its service is up
+    write_active_build(tile_dir, 8003, None)
+    assert get_current_valhalla_dir() is None
+    with patch("routing_packager_app.utils.valhalla_utils._probe_port", return_value=True):
+        assert get_current_valhalla_dir() == tile_dir.resolve()